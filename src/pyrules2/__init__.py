@@ -1,6 +1,7 @@
 from .expression import when
 from .rules import rule, RuleBook, no, person, anything
 from .route_gmaps import Driving
-from .route import place, RESET, reroute, limit
+from .route import place, RESET, reroute, limit, optimize, improve
+from .search import ROUND_ROBIN, DEPTH_FIRST, best_first
 
 # flake8: noqa
@@ -0,0 +1,126 @@
+from time import monotonic
+
+__author__ = 'nhc'
+
+COMPLETE = 'complete'
+'''Status of a query that found every answer.'''
+LIMIT = 'limit'
+'''Status of a query that stopped because it found as many answers as requested.'''
+TIMEOUT = 'timeout'
+'''Status of a query that stopped because it ran out of time.'''
+MAX_SCENARIOS = 'max_scenarios'
+'''Status of a query that stopped because it derived as many Scenarios as allowed.'''
+MAX_GENERATIONS = 'max_generations'
+'''Status of a query that stopped because it computed as many Generations as allowed.'''
+ERROR = 'error'
+'''Status of a query that stopped because a rule raised an exception.'''
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised by a Budget to abandon the fixed-point step in progress.
+    """
+    def __init__(self, status):
+        """
+        :param status: The reason, e.g. TIMEOUT
+        """
+        super().__init__(status)
+        self.status = status
+
+
+class Budget(object):
+    """
+    Limits the work done by one query, see RuleBook.query().
+    The RuleBook calls start_generation() before every step of the fixed-point
+    iteration, and passes every Scenario derived in the step through count().
+    Both raise BudgetExceeded when a limit is reached, so a step is abandoned
+    midway, and the Generation it was computing is never stored.
+    When b is a Budget,
+      - b.scenarios is the number of Scenarios derived so far
+      - b.generations is the number of Generations computed so far
+    """
+    def __init__(self, timeout=None, max_scenarios=None, max_generations=None):
+        """
+        :param timeout: None, or the number of seconds the query may take, e.g. 2.5
+        :param max_scenarios: None, or the number of Scenarios the query may derive,
+        across every step and rule, e.g. 100000
+        :param max_generations: None, or the number of Generations the query may compute,
+        across every stratum, e.g. 10
+        """
+        self.started = monotonic()
+        self.deadline = None if timeout is None else self.started + timeout
+        self.max_scenarios = max_scenarios
+        self.max_generations = max_generations
+        self.scenarios = 0
+        self.generations = 0
+
+    def check(self):
+        """
+        :raises BudgetExceeded if the query ran out of time.
+        """
+        if self.deadline is not None and monotonic() >= self.deadline:
+            raise BudgetExceeded(TIMEOUT)
+
+    def start_generation(self):
+        """
+        Called before computing a Generation.
+        :raises BudgetExceeded if the query may not compute another Generation.
+        """
+        self.check()
+        if self.max_generations is not None and self.generations >= self.max_generations:
+            raise BudgetExceeded(MAX_GENERATIONS)
+        self.generations += 1
+
+    def count(self, scenarios):
+        """
+        :param scenarios: An Iterable of Scenarios derived in a step.
+        :return: A generator yielding the same Scenarios.
+        :raises BudgetExceeded if the query derives too many Scenarios or runs out of time.
+        """
+        for scenario in scenarios:
+            self.scenarios += 1
+            if self.max_scenarios is not None and self.scenarios > self.max_scenarios:
+                raise BudgetExceeded(MAX_SCENARIOS)
+            self.check()
+            yield scenario
+
+    def elapsed(self):
+        """
+        :return: The number of seconds since this Budget was created.
+        """
+        return monotonic() - self.started
+
+
+class QueryResult(object):
+    """
+    The answers to a query, see RuleBook.query().
+    When r is a QueryResult,
+      - r.answers is a list of dicts, one per answer found, e.g. [{'x': 0}]
+      - r.status says why the query stopped, e.g. COMPLETE or TIMEOUT
+      - r.error is the exception raised by a rule if r.status is ERROR, otherwise None
+      - r.scenarios and r.generations are the number of Scenarios derived
+        and Generations computed by the query, see Budget
+      - r.elapsed is the number of seconds the query took
+    """
+    def __init__(self, answers, status, budget, error=None):
+        self.answers = answers
+        self.status = status
+        self.error = error
+        self.scenarios = budget.scenarios
+        self.generations = budget.generations
+        self.elapsed = budget.elapsed()
+
+    def is_complete(self):
+        """
+        :return: True if and only if the query found every answer.
+        """
+        return self.status == COMPLETE
+
+    def __iter__(self):
+        return iter(self.answers)
+
+    def __len__(self):
+        return len(self.answers)
+
+    def __repr__(self):
+        return '<{} {} answers, {}>'.format(self.__class__.__name__, len(self.answers), self.status)
@@ -0,0 +1,162 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from threading import Thread, Lock
+from time import sleep, monotonic
+from zlib import crc32
+import json
+from pyrules2.route_gmaps import _distance_matrix, _new_client, MAX_ELEMENTS, MAX_ORIGINS, MAX_DESTINATIONS
+
+__author__ = 'nhc'
+
+'''
+A local stand-in for the Google Maps Distance Matrix API, for tests and for benchmarking
+the fetching in pyrules2.route_gmaps offline. Run this module to benchmark, e.g.
+  python -m pyrules2.distance_matrix_server
+'''
+
+PATH = '/maps/api/distancematrix/json'
+'''The path of the Distance Matrix API.'''
+KEY = 'AIza-made-up-key'
+'''An API key that googlemaps.Client accepts, for clients of a DistanceMatrixServer.'''
+
+
+def made_up_costs(origin, destination):
+    """
+    :param origin: An address, e.g. 'Copenhagen, Denmark'
+    :param destination: An address, e.g. 'Berlin, Germany'
+    :return: A pair (distance, duration), the same every time for the same addresses.
+    """
+    if origin == destination:
+        return 0, 0
+    distance = 1000 + crc32('{}|{}'.format(origin, destination).encode()) % 100000
+    return distance, distance // 20
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTPServer handling each request in a daemon thread, like http.server.ThreadingHTTPServer,
+    which is not available before Python 3.7.
+    """
+    daemon_threads = True
+
+
+class DistanceMatrixServer(object):
+    """
+    An HTTP server answering Distance Matrix requests with made_up_costs(),
+    after a configurable latency, in a thread per request.
+    Like Google Maps, it refuses requests beyond the element limits.
+    When s is a DistanceMatrixServer,
+      - s.url is its base URL, e.g. 'http://127.0.0.1:41234'
+      - s.requests is the number of requests answered so far
+      - s.connections is the set of client addresses, one per connection opened so far
+    Use it as a context manager, with a googlemaps.Client:
+      with DistanceMatrixServer(latency=0.05) as server:
+          client = _new_client(KEY, base_url=server.url)
+    """
+    def __init__(self, latency=0.0, failures=0, failure='UNKNOWN_ERROR', port=0):
+        """
+        :param latency: The number of seconds to wait before answering a request, e.g. 0.05
+        :param failures: The number of requests to answer with the status failure
+        before answering properly, to exercise retries.
+        :param failure: A Distance Matrix status, e.g. 'OVER_QUERY_LIMIT'
+        :param port: The port to listen on, or 0 for any free port.
+        """
+        self.latency = latency
+        self.failures = failures
+        self.failure = failure
+        self.requests = 0
+        self.connections = set()
+        self._lock = Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep connections alive
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != PATH:
+                    self.send_error(404)
+                    return
+                with server._lock:
+                    server.connections.add(self.client_address)
+                body = json.dumps(server.answer(parse_qs(url.query))).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._http_server = _ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self._http_server.server_address[1])
+        self._thread = None
+
+    def answer(self, query):
+        """
+        :param query: The parsed query string of a request, e.g. {'origins': ['A|B'], 'destinations': ['C']}
+        :return: The response, as the Distance Matrix API would give it.
+        """
+        sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if self.failures > 0:
+                self.failures -= 1
+                return {'status': self.failure, 'rows': []}
+        origins = query['origins'][0].split('|')
+        destinations = query['destinations'][0].split('|')
+        if len(origins) > MAX_ORIGINS or len(destinations) > MAX_DESTINATIONS \
+                or len(origins) * len(destinations) > MAX_ELEMENTS:
+            return {'status': 'MAX_ELEMENTS_EXCEEDED', 'rows': []}
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                distance, duration = made_up_costs(origin, destination)
+                elements.append({'status': 'OK', 'distance': {'value': distance}, 'duration': {'value': duration}})
+            rows.append({'elements': elements})
+        return {'status': 'OK', 'origin_addresses': origins, 'destination_addresses': destinations, 'rows': rows}
+
+    def start(self):
+        self._thread = Thread(target=self._http_server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def benchmark(places=40, latency=0.05, workers=(1, 2, 4, 8)):
+    """
+    Fetches a places x places matrix from a DistanceMatrixServer with each number of workers.
+    :param places: The number of places.
+    :param latency: The latency of the server, in seconds.
+    :param workers: The numbers of workers to try.
+    :return: A list of triples (workers, seconds, elements per second).
+    """
+    addresses = ['Place {}'.format(i) for i in range(places)]
+    results = []
+    with DistanceMatrixServer(latency=latency) as server:
+        client = _new_client(KEY, base_url=server.url)
+        for max_workers in workers:
+            started = monotonic()
+            costs = _distance_matrix(client, 'driving', [(addresses, addresses)], max_workers=max_workers)
+            seconds = monotonic() - started
+            assert len(costs) == places * places
+            results.append((max_workers, seconds, len(costs) / seconds))
+    return results
+
+
+if __name__ == '__main__':
+    for max_workers, seconds, rate in benchmark():
+        print('{:2} workers: {:6.2f} s, {:8.0f} elements/s'.format(max_workers, seconds, rate))
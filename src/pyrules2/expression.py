@@ -1,4 +1,4 @@
-from pyrules2.scenario import Scenario
+from pyrules2.scenario import Scenario, Schema, Relation
 from pyrules2.util import lazy_product, round_robin
 from types import GeneratorType
 from collections import Mapping, Iterable
@@ -18,6 +18,24 @@ class Expression(object):
         """
         raise NotImplementedError()
 
+    def through(self, references):
+        """
+        Restricts this Expression to the derivations that use a Scenario
+        from at least one of the given ReferenceExpressions.
+        Example: (when(x=0) | r).through({r}) generates the Scenarios of r only.
+        Subclasses that have subexpressions must override this.
+        :param references: A set of ReferenceExpressions.
+        :returns An Expression, or EMPTY if no derivation uses the references.
+        """
+        return EMPTY
+
+    def relation(self):
+        """
+        :returns The Relation of Scenarios generated by this Expression if it simply wraps one
+        (so the Relation can be probed instead of scanned), otherwise None.
+        """
+        return None
+
     def all_dicts(self):
         """
         Generates every scenario for this Expression as a dict.
@@ -125,16 +143,175 @@ class AndExpression(AggregateExpression):
     of Scenarios from its subexpressions when these are compatible (i.e.
     do not define different values for the same key).
     """
+    def through(self, references):
+        """
+        A combination uses the references if one of its Scenarios does.
+        """
+        alternatives = []
+        for index, sub_expr in enumerate(self.subexpressions):
+            restricted = sub_expr.through(references)
+            if restricted is not EMPTY:
+                subexpressions = list(self.subexpressions)
+                subexpressions[index] = restricted
+                alternatives.append(AndExpression(*subexpressions))
+        if len(alternatives) == 0:
+            return EMPTY
+        return alternatives[0] if len(alternatives) == 1 else OrExpression(*alternatives)
+
     def scenarios(self):
         """
         Yields a number of Scenarios based on this object's subexpressions.
-        """
-        scenario_generators = (sub_expr.scenarios() for sub_expr in self.subexpressions)
-        for prod in lazy_product(*scenario_generators):
+        The subexpressions are combined pairwise from left to right by hash joins
+        on the keys they share, see _hash_join(). A subexpression that can be
+        looked up in a Relation is probed instead, see _index_join().
+        """
+        if len(self.subexpressions) == 0:
+            return
+        joined = self.subexpressions[0].scenarios()
+        for sub_expr in self.subexpressions[1:]:
+            relation, lookup = _lookup(sub_expr)
+            if relation is None:
+                joined = _hash_join(joined, sub_expr.scenarios())
+            else:
+                joined = _index_join(joined, relation, lookup)
+        for scenario in joined:
+            yield scenario
+
+
+class _JoinInput(object):
+    """
+    One input of _hash_join(): Every distinct Scenario seen so far, grouped by
+    its Schema, plus hash indexes that are built when first needed.
+    """
+    def __init__(self):
+        self.seen = set()
+        self.by_schema = {}
+        self.indexes = {}
+        self.join_keys = {}
+
+    def add(self, scenario):
+        """
+        :param scenario: A Scenario from this input.
+        :return: False if the Scenario was seen before, otherwise True.
+        """
+        if scenario in self.seen:
+            return False
+        self.seen.add(scenario)
+        schema = scenario.schema
+        self.by_schema.setdefault(schema, []).append(scenario)
+        for (indexed_schema, _), (positions, index) in self.indexes.items():
+            if indexed_schema is schema:
+                index.setdefault(_values_at(scenario, positions), []).append(scenario)
+        return True
+
+    def matches(self, scenario):
+        """
+        :param scenario: A Scenario from the other input.
+        :return: A generator yielding every Scenario seen so far that is
+        compatible with the given one, i.e. agrees on every key they share.
+        """
+        schema = scenario.schema
+        for other_schema, scenarios in list(self.by_schema.items()):
+            join_keys = self._join_keys(schema, other_schema)
+            if len(join_keys) == 0:  # No shared keys: Cross product
+                for other in scenarios:
+                    yield other
+                continue
+            if (other_schema, join_keys) not in self.indexes:
+                positions = tuple(other_schema.positions[key] for key in join_keys)
+                index = {}
+                for other in scenarios:
+                    index.setdefault(_values_at(other, positions), []).append(other)
+                self.indexes[(other_schema, join_keys)] = (positions, index)
+            _, index = self.indexes[(other_schema, join_keys)]
+            for other in index.get(scenario.project(join_keys), ()):
+                yield other
+
+    def _join_keys(self, schema, other_schema):
+        """
+        :return: A tuple of the keys shared by two Schemas, in a fixed order. Cached.
+        """
+        if (schema, other_schema) not in self.join_keys:
+            self.join_keys[(schema, other_schema)] = tuple(key for key in other_schema.keys
+                                                           if key in schema.positions)
+        return self.join_keys[(schema, other_schema)]
+
+
+def _values_at(scenario, positions):
+    """
+    :param scenario: A Scenario
+    :param positions: A tuple of indexes into scenario.values
+    :return: A tuple of the values at the given positions.
+    """
+    values = scenario.values
+    return tuple(values[position] for position in positions)
+
+
+def _hash_join(left, right):
+    """
+    Symmetric hash join of two streams of Scenarios, see
+    https://en.wikipedia.org/wiki/Symmetric_Hash_Join
+    The inputs are polled alternately, and every new Scenario is joined with
+    the compatible Scenarios seen so far from the other input, so this works
+    for infinite inputs too.
+    :param left: An iterator of Scenarios.
+    :param right: An iterator of Scenarios.
+    :return: A generator yielding the union of every compatible pair of Scenarios,
+    one from each input. Repeated Scenarios from an input are ignored.
+    """
+    iterators = [iter(left), iter(right)]
+    inputs = [_JoinInput(), _JoinInput()]
+    active = [0, 1]
+    while len(active) > 0:
+        for index in list(active):
             try:
-                yield Scenario.unite(prod)
-            except AssertionError:
-                pass
+                scenario = next(iterators[index])
+            except StopIteration:
+                active.remove(index)
+                if len(inputs[index].seen) == 0:
+                    return  # This input was empty, so the join is empty
+                continue
+            if inputs[index].add(scenario):
+                for other in inputs[1 - index].matches(scenario):
+                    yield Scenario.unite((scenario, other))
+
+
+def _lookup(expr):
+    """
+    :param expr: An Expression
+    :return: A pair (relation, lookup). If expr can be looked up in a Relation, relation
+    is that Relation, and lookup(scenario) yields every Scenario generated by expr that is
+    compatible with the given one. Otherwise, the pair is (None, None).
+    """
+    relation = expr.relation()
+    if relation is not None:
+        return relation, relation.compatible
+    if isinstance(expr, SelectProjectExpression):
+        relation = expr.expr.relation()
+        if relation is not None:
+            return relation, expr.matching
+    return None, None
+
+
+def _index_join(left, relation, lookup):
+    """
+    Index nested loop join of a stream of Scenarios with a Relation: Every
+    Scenario from the stream is looked up in the indexes of the Relation.
+    :param left: An iterator of Scenarios.
+    :param relation: The Relation behind lookup.
+    :param lookup: A function mapping a Scenario to the compatible Scenarios
+    from the right input, see _lookup().
+    :return: A generator yielding the same Scenarios as _hash_join().
+    """
+    if len(relation) == 0:
+        return
+    seen = set()
+    for scenario in left:
+        if scenario in seen:
+            continue
+        seen.add(scenario)
+        for other in lookup(scenario):
+            yield Scenario.unite((scenario, other))
 
 
 class OrExpression(AggregateExpression):
@@ -142,17 +319,36 @@ class OrExpression(AggregateExpression):
     An aggregate Expression which generates every Scenario
      generated by its subexpressions.
     """
+    def __init__(self, *subexpressions, strategy=None):
+        """
+        :param subexpressions: The subexpressions to combine.
+        :param strategy: None, or a pyrules2.search.SearchStrategy deciding the order
+        in which Scenarios are taken from the subexpressions. If None, they are
+        taken fairly by round_robin.
+        """
+        super().__init__(*subexpressions)
+        self.strategy = strategy
+
     def __or__(self, other):
         assert isinstance(other, Expression)  # TODO: If other is OrExpression, merge
         self.subexpressions.append(other)
         return self
 
+    def through(self, references):
+        restricted = [sub_expr.through(references) for sub_expr in self.subexpressions]
+        restricted = [sub_expr for sub_expr in restricted if sub_expr is not EMPTY]
+        if len(restricted) == 0:
+            return EMPTY
+        return OrExpression(*restricted, strategy=self.strategy)
+
     def scenarios(self):
         """
         Yields all dicts generated by this object's subexpressions.
         """
         iterables = [e.scenarios() for e in self.subexpressions]
-        return round_robin(*iterables)
+        if self.strategy is None:
+            return round_robin(*iterables)
+        return self.strategy.merge(iterables)
 
 
 class ReferenceExpression(Expression):
@@ -190,6 +386,15 @@ class ReferenceExpression(Expression):
         assert self.ref is not None
         return self.ref.scenarios()
 
+    def through(self, references):
+        """
+        Note that the referred Expression is not searched for references.
+        """
+        return self if self in references else EMPTY
+
+    def relation(self):
+        return None if self.ref is None else self.ref.relation()
+
     def set_name(self, name):
         self.name = name
 
@@ -230,11 +435,23 @@ class FilterEqExpression(Expression):
         Yields every Scenario generated by this object's subexpression,
         if that Scenario passes the specified filter
         """
-        for scenario in self.expr.scenarios():
-            if (self.key, self.expected_value) in scenario:
-                yield scenario
+        relation = self.expr.relation()
+        if relation is None:
+            candidates = self.expr.scenarios()
+        else:  # Skip the Scenarios with other values
+            candidates = relation.compatible(Scenario({self.key: self.expected_value}))
+        for scenario in candidates:
+            if self.key in scenario:
+                if scenario[self.key] == self.expected_value:
+                    yield scenario
             else:
-                assert self.key in scenario.as_dict()
+                assert False, '{!r} is not defined in {!r}'.format(self.key, scenario)
+
+    def through(self, references):
+        restricted = self.expr.through(references)
+        if restricted is EMPTY:
+            return EMPTY
+        return FilterEqExpression(self.key, self.expected_value, restricted)
 
     def __repr__(self):
         return '{}({!r},{!r},{!r})'.format(self.__class__.__name__,
@@ -280,12 +497,20 @@ class RenameExpression(Expression):
             if len(self.map) == 0:
                 yield Scenario({})
             else:
-                try:
-                    d = scenario.as_dict()
-                    new_scenarios = [Scenario({new_key: d[old_key]}) for old_key, new_key in self.map.items()]
-                    yield Scenario.unite(new_scenarios)
-                except AssertionError:
-                    pass
+                renamed = {}
+                for old_key, new_key in self.map.items():
+                    value = scenario[old_key]
+                    if new_key in renamed and renamed[new_key] != value:
+                        break  # Clash
+                    renamed[new_key] = value
+                else:
+                    yield Scenario(renamed)
+
+    def through(self, references):
+        restricted = self.expr.through(references)
+        if restricted is EMPTY:
+            return EMPTY
+        return RenameExpression(restricted, **self.map)
 
     def __repr__(self):
         return '{}({!r},{!r})'.format(self.__class__.__name__,
@@ -297,6 +522,145 @@ class RenameExpression(Expression):
                + '\n{}'.format(self.expr.__str__(indent=indent+'  '))
 
 
+class SelectProjectExpression(Expression):
+    """
+    An Expression that does the work of a chain of FilterEqExpressions
+    and a RenameExpression in one pass over the Scenarios generated by its subexpression.
+    For example,
+      SelectProjectExpression(when(x=0, y=1), {'x': 0}, {'y': 'a'})
+    generates Scenario({'a': 1}), just like
+      RenameExpression(FilterEqExpression('x', 0, when(x=0, y=1)), y='a')
+    """
+    def __init__(self, expr, constants, renames=None, required=None):
+        """
+        :param expr: Subexpression, e.g. when(x=0)
+        :param constants: A dict mapping keys to the values they must have, e.g. {'x': 0}.
+        Scenarios where one of these keys maps to another value are skipped.
+        :param renames: A dict mapping keys of the subexpression to keys of this Expression, like for
+        RenameExpression, e.g. {'y': 'a'}. If None, Scenarios are not renamed.
+        :param required: A set of keys from constants that must be defined by every Scenario,
+        like for FilterEqExpression. If None, every key in constants is required.
+        A constant for a key that is not required only applies if the key is defined.
+        """
+        assert isinstance(expr, Expression)
+        assert isinstance(constants, dict)
+        assert renames is None or isinstance(renames, dict)
+        self.expr = expr
+        self.constants = constants
+        self.renames = renames
+        self.required = frozenset(constants) if required is None else frozenset(required)
+        assert self.required.issubset(constants)
+        self._probes = {}
+
+    def scenarios(self):
+        """
+        :return: Yields one filtered and renamed Scenario per Scenario generated by the subexpression,
+        but only if it has the required constants and there are no clashes.
+        """
+        relation = self.expr.relation()
+        if relation is None:
+            candidates = self.expr.scenarios()
+        else:  # Skip the Scenarios with other values for the constants
+            candidates = relation.compatible(Scenario(self.constants))
+        for scenario in candidates:
+            output = self._output(scenario)
+            if output is not None:
+                yield output
+
+    def matching(self, scenario):
+        """
+        Like scenarios(), but only yields the Scenarios that are compatible with the given one.
+        The Relation generated by the subexpression is probed instead of scanned.
+        :param scenario: A Scenario, e.g. Scenario({'a': 1})
+        :return: A generator yielding distinct Scenarios.
+        """
+        if scenario.schema not in self._probes:
+            self._probes[scenario.schema] = self._probe_plan(scenario.schema)
+        probe_schema, sources, checks = self._probes[scenario.schema]
+        values = scenario.values
+        for position, value in checks:
+            if values[position] != value:
+                return
+        probe = Scenario.from_values(probe_schema, tuple(value if position is None else values[position]
+                                                         for position, value in sources))
+        outputs = set()
+        for candidate in self.expr.relation().compatible(probe):
+            output = self._output(candidate)
+            if output is not None and output not in outputs:
+                outputs.add(output)
+                yield output
+
+    def _probe_plan(self, schema):
+        """
+        Prepares matching() for Scenarios with the given Schema by translating them
+        to the keys of the subexpression.
+        :param schema: A Schema
+        :return: A triple (probe_schema, sources, checks). probe_schema has the keys to look up.
+        sources has one (position, constant) pair per key of probe_schema, where position is
+        the index of the value in the given Scenario, or None if the value is the constant.
+        checks has one (position, constant) pair per given value that must equal a constant.
+        """
+        renames = self.renames if self.renames is not None else {key: key for key in schema.keys}
+        sources = {key: (None, value) for key, value in self.constants.items()}
+        checks = []
+        for old_key, new_key in renames.items():
+            if new_key in schema.positions:
+                if old_key in self.constants:
+                    checks.append((schema.positions[new_key], self.constants[old_key]))
+                else:
+                    sources[old_key] = (schema.positions[new_key], None)
+        probe_schema = Schema.of(sources)
+        return probe_schema, tuple(sources[key] for key in probe_schema.keys), tuple(checks)
+
+    def _output(self, scenario):
+        """
+        :param scenario: A Scenario generated by the subexpression.
+        :return: The filtered and renamed Scenario, or None if it is skipped.
+        """
+        if not self._selects(scenario):
+            return None
+        if self.renames is None:
+            return scenario
+        renamed = {}
+        for old_key, new_key in self.renames.items():
+            value = scenario[old_key]
+            if new_key in renamed and renamed[new_key] != value:
+                return None  # Clash
+            renamed[new_key] = value
+        return Scenario(renamed)
+
+    def _selects(self, d):
+        """
+        :param d: A Scenario
+        :return: True if d agrees with every constant.
+        :raises AssertionError if d does not define a required key.
+        """
+        for key, value in self.constants.items():
+            if key in d:
+                if d[key] != value:
+                    return False
+            else:
+                assert key not in self.required, '{!r} is not defined in {!r}'.format(key, d)
+        return True
+
+    def through(self, references):
+        restricted = self.expr.through(references)
+        if restricted is EMPTY:
+            return EMPTY
+        return SelectProjectExpression(restricted, self.constants, self.renames, self.required)
+
+    def __repr__(self):
+        return '{}({!r},{!r},{!r},{!r})'.format(self.__class__.__name__,
+                                                self.expr,
+                                                self.constants,
+                                                self.renames,
+                                                self.required)
+
+    def __str__(self, indent=''):
+        return '{}<{} {!r} {!r}>'.format(indent, self.__class__.__name__, self.constants, self.renames) \
+               + '\n{}'.format(self.expr.__str__(indent=indent+'  '))
+
+
 def bind(callee_expr, callee_key_to_constant, callee_key_to_caller_key):
     """
     Utility for building FilterEqExpression and RenameExpressions
@@ -335,26 +699,31 @@ class ApplyExpression(Expression):
     If a callable returns a generator, a Scenario will be generated
     per generated value.
     """
-    def __init__(self, callable_expression, input_expression):
+    def __init__(self, callable_expression, input_expression, strategy=None):
         """
         :param callable_expression: Subexpression generating callables,
         e.g. when(f=lambda x: x)
         :param input_expression: Subexpression generating input values
         for the above, e.g. when(x=42)
+        :param strategy: None, or a pyrules2.search.SearchStrategy deciding the order
+        in which Scenarios are taken from the subexpressions, see lazy_product().
         """
         assert isinstance(callable_expression, Expression)
         self.callable_expression = callable_expression
         assert isinstance(input_expression, Expression)
         self.input_expression = input_expression
+        self.strategy = strategy
 
     def scenarios(self):
         """
         :return: Yields return values as described above.
         """
-        # Each combination of a Scenario from each of the two subexpressions gives rise to one call
+        # Each combination of a Scenario from each of the two subexpressions gives rise to one call.
+        # A Relation is passed as it is, so lazy_product() can use it without caching
         for callable_scenario, \
-            input_scenario in lazy_product(self.callable_expression.scenarios(),
-                                           self.input_expression.scenarios()):
+            input_scenario in lazy_product(_materialized(self.callable_expression),
+                                           _materialized(self.input_expression),
+                                           strategy=self.strategy):
             # Extract the callable value and the input for the call
             _, callable_value = callable_scenario.get_only_item()
             assert hasattr(callable_value, '__call__')
@@ -368,6 +737,18 @@ class ApplyExpression(Expression):
                 for generated_value in returned_value:
                     yield Scenario({key: generated_value})
 
+    def through(self, references):
+        alternatives = []
+        restricted = self.callable_expression.through(references)
+        if restricted is not EMPTY:
+            alternatives.append(ApplyExpression(restricted, self.input_expression, self.strategy))
+        restricted = self.input_expression.through(references)
+        if restricted is not EMPTY:
+            alternatives.append(ApplyExpression(self.callable_expression, restricted, self.strategy))
+        if len(alternatives) == 0:
+            return EMPTY
+        return alternatives[0] if len(alternatives) == 1 else OrExpression(*alternatives)
+
     def __repr__(self):
         return '{}({!r}, {!r})'.format(self.__class__.__name__,
                                        self.callable_expression,
@@ -380,6 +761,15 @@ class ApplyExpression(Expression):
                + '\n{}input:\n{}'.format(indent, self.input_expression.__str__(indent=indent+'  '))
 
 
+def _materialized(expr):
+    """
+    :param expr: An Expression
+    :return: The Relation generated by expr if it has one, otherwise a generator of its Scenarios.
+    """
+    relation = expr.relation()
+    return expr.scenarios() if relation is None else relation
+
+
 class IterableWrappingExpression(Expression):
     """
     An Expression that wraps a Scenario Iterable
@@ -400,6 +790,9 @@ class IterableWrappingExpression(Expression):
             assert isinstance(scenario, Scenario)
             yield scenario
 
+    def relation(self):
+        return self.scenario_iterable if isinstance(self.scenario_iterable, Relation) else None
+
     def __repr__(self):
         return '{}({!r})'.format(self.__class__.__name__, list(self.scenarios()))
 
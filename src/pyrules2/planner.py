@@ -0,0 +1,355 @@
+from collections import namedtuple, Sized
+from weakref import WeakKeyDictionary
+from pyrules2.expression import Expression, AndExpression, OrExpression, ReferenceExpression, \
+    FilterEqExpression, RenameExpression, ApplyExpression, ConstantExpression, IterableWrappingExpression, EMPTY, \
+    SelectProjectExpression
+
+__author__ = 'nhc'
+
+'''Assumed number of Scenarios for an Iterable that has no len(), e.g. a generator.'''
+UNKNOWN_SIZE = 1000
+
+'''An AndExpression with an OrExpression subexpression of at most this many
+subexpressions may be distributed over it, see plan().'''
+MAX_DISTRIBUTED_BRANCHES = 4
+
+
+class Estimate(namedtuple('Estimate', ['size', 'distinct'])):
+    """
+    Estimated statistics for the Scenarios generated by an Expression.
+    When e is an Estimate,
+      - e.size is the estimated number of Scenarios, e.g. 12.0
+      - e.distinct is a dict mapping every key the Scenarios are expected
+        to define to the estimated number of distinct values for it, e.g. {'x': 3.0}
+    """
+
+    def join(self, other):
+        """
+        Estimates the result of joining on the shared keys, assuming
+        that values are uniformly distributed, see
+        https://en.wikipedia.org/wiki/Query_optimization
+        :param other: An Estimate
+        :return: An Estimate for the join.
+        """
+        size = self.size * other.size
+        distinct = dict(self.distinct)
+        for key, count in other.distinct.items():
+            if key in distinct:
+                size /= max(distinct[key], count, 1)
+                distinct[key] = min(distinct[key], count)
+            else:
+                distinct[key] = count
+        return Estimate(size, {key: min(count, size) for key, count in distinct.items()})
+
+    def __str__(self):
+        return '~{:g}'.format(self.size)
+
+
+_statistics = WeakKeyDictionary()
+
+
+def _scenario_statistics(expression):
+    """
+    :param expression: An IterableWrappingExpression.
+    :return: An Estimate computed by going through every Scenario in the wrapped Iterable
+    if it has a len(). Cached per expression, so statistics for a Generation are only computed once.
+    """
+    if expression not in _statistics:
+        scenarios = expression.scenario_iterable
+        if not isinstance(scenarios, Sized):
+            _statistics[expression] = Estimate(UNKNOWN_SIZE, {})
+        else:
+            values = {}
+            for scenario in scenarios:
+                for key, value in zip(scenario.schema.keys, scenario.values):
+                    values.setdefault(key, set()).add(value)
+            _statistics[expression] = Estimate(len(scenarios),
+                                               {key: len(key_values) for key, key_values in values.items()})
+    return _statistics[expression]
+
+
+def estimate(expression):
+    """
+    Estimates the number of Scenarios generated by an Expression,
+    using statistics from the Scenarios it wraps or refers to.
+    :param expression: Any Expression.
+    :return: An Estimate.
+    """
+    assert isinstance(expression, Expression)
+    if expression is EMPTY:
+        return Estimate(0, {})
+    if isinstance(expression, ConstantExpression):
+        return Estimate(1, {key: 1 for key in expression.scenario})
+    if isinstance(expression, IterableWrappingExpression):
+        return _scenario_statistics(expression)
+    if isinstance(expression, ReferenceExpression):
+        return Estimate(UNKNOWN_SIZE, {}) if expression.ref is None else estimate(expression.ref)
+    if isinstance(expression, AndExpression):
+        if len(expression.subexpressions) == 0:
+            return Estimate(0, {})
+        result = estimate(expression.subexpressions[0])
+        for sub_expr in expression.subexpressions[1:]:
+            result = result.join(estimate(sub_expr))
+        return result
+    if isinstance(expression, OrExpression):
+        estimates = [estimate(sub_expr) for sub_expr in expression.subexpressions]
+        size = sum(e.size for e in estimates)
+        distinct = {}
+        for e in estimates:
+            for key, count in e.distinct.items():
+                distinct[key] = min(distinct.get(key, 0) + count, size)
+        return Estimate(size, distinct)
+    if isinstance(expression, FilterEqExpression):
+        sub_estimate = estimate(expression.expr)
+        size = sub_estimate.size / max(sub_estimate.distinct.get(expression.key, 1), 1)
+        distinct = {key: min(count, size) for key, count in sub_estimate.distinct.items()}
+        distinct[expression.key] = min(1, size)
+        return Estimate(size, distinct)
+    if isinstance(expression, RenameExpression):
+        return _renamed(estimate(expression.expr), expression.map)
+    if isinstance(expression, SelectProjectExpression):
+        sub_estimate = estimate(expression.expr)
+        size = sub_estimate.size
+        distinct = dict(sub_estimate.distinct)
+        for key in expression.constants:
+            if key in distinct or key in expression.required:
+                size /= max(distinct.get(key, 1), 1)
+                distinct[key] = 1
+        selected = Estimate(size, {key: min(count, size) for key, count in distinct.items()})
+        return selected if expression.renames is None else _renamed(selected, expression.renames)
+    if isinstance(expression, ApplyExpression):
+        callable_estimate = estimate(expression.callable_expression)
+        input_estimate = estimate(expression.input_expression)
+        size = callable_estimate.size * input_estimate.size
+        return Estimate(size, {key: size for key in input_estimate.distinct})
+    return Estimate(UNKNOWN_SIZE, {})
+
+
+def _renamed(sub_estimate, renames):
+    """
+    :param sub_estimate: An Estimate for the subexpression of a RenameExpression.
+    :param renames: A dict mapping old keys to new keys.
+    :return: An Estimate for the RenameExpression.
+    """
+    size = sub_estimate.size
+    distinct = {}
+    for old_key, new_key in renames.items():
+        count = sub_estimate.distinct.get(old_key, size)
+        if new_key in distinct:  # Two keys must agree
+            size /= max(distinct[new_key], count, 1)
+            count = min(distinct[new_key], count)
+        distinct[new_key] = count
+    return Estimate(size, {key: min(count, size) for key, count in distinct.items()})
+
+
+def push_down(expression, memo=None):
+    """
+    Rewrites an Expression into one that generates the same Scenarios, but filters them earlier:
+      - Every chain of a RenameExpression over FilterEqExpressions, as built by bind(),
+        is fused into one SelectProjectExpression, see _select_project().
+      - The constants of a SelectProjectExpression are pushed down through OrExpressions
+        and AndExpressions, and into ConstantExpressions and other SelectProjectExpressions.
+    ReferenceExpressions are not followed.
+    :param expression: Any Expression.
+    :param memo: Internal, used to preserve sharing of subexpressions.
+    :return: The rewritten Expression.
+    """
+    if memo is None:
+        memo = {}
+    if id(expression) in memo:
+        return memo[id(expression)]
+    if isinstance(expression, RenameExpression) or isinstance(expression, FilterEqExpression):
+        node = expression
+        renames = None
+        if isinstance(node, RenameExpression):
+            renames = dict(node.map)
+            node = node.expr
+        constants = {}
+        while isinstance(node, FilterEqExpression) and constants.get(node.key, node.expected_value) == \
+                node.expected_value:
+            constants[node.key] = node.expected_value
+            node = node.expr
+        result = _select_project(push_down(node, memo), constants, renames, frozenset(constants))
+    elif isinstance(expression, SelectProjectExpression):
+        result = _select_project(push_down(expression.expr, memo),
+                                 expression.constants, expression.renames, expression.required)
+    elif isinstance(expression, AndExpression):
+        result = AndExpression(*[push_down(sub_expr, memo) for sub_expr in expression.subexpressions])
+    elif isinstance(expression, OrExpression):
+        result = OrExpression(*[push_down(sub_expr, memo) for sub_expr in expression.subexpressions],
+                              strategy=expression.strategy)
+    elif isinstance(expression, ApplyExpression):
+        result = ApplyExpression(push_down(expression.callable_expression, memo),
+                                 push_down(expression.input_expression, memo),
+                                 expression.strategy)
+    else:
+        result = expression
+    memo[id(expression)] = result
+    return result
+
+
+def _select_project(expr, constants, renames, required):
+    """
+    :param expr: An Expression that push_down() has already been applied to.
+    :param constants: See SelectProjectExpression.
+    :param renames: See SelectProjectExpression.
+    :param required: See SelectProjectExpression.
+    :return: An Expression equivalent to SelectProjectExpression(expr, constants, renames, required),
+    with the constants pushed down as far as possible.
+    """
+    if len(constants) == 0 and renames is None:
+        return expr
+    if expr is EMPTY:
+        return EMPTY
+    if isinstance(expr, OrExpression):
+        return OrExpression(*[_select_project(sub_expr, constants, renames, required)
+                              for sub_expr in expr.subexpressions],
+                            strategy=expr.strategy)
+    if isinstance(expr, ConstantExpression) and required.issubset(expr.scenario.key_set()):
+        # Evaluate right away
+        for scenario in SelectProjectExpression(expr, constants, renames, required).scenarios():
+            return ConstantExpression(scenario)
+        return EMPTY
+    if isinstance(expr, SelectProjectExpression) and renames is None and len(required) == 0:
+        # Translate the constants to keys of the inner subexpression
+        translated = dict(expr.constants)
+        for key, value in constants.items():
+            old_keys = [key] if expr.renames is None else [old for old, new in expr.renames.items() if new == key]
+            for old_key in old_keys:
+                if translated.get(old_key, value) != value:
+                    return SelectProjectExpression(expr, constants, renames, required)
+                translated[old_key] = value
+        return _select_project(expr.expr, translated, expr.renames, expr.required)
+    if isinstance(expr, AndExpression) and len(constants) > 0:
+        # A combination can only match the constants if each of its Scenarios does
+        expr = AndExpression(*[_select_project(sub_expr, constants, None, frozenset())
+                               for sub_expr in expr.subexpressions])
+    return SelectProjectExpression(expr, constants, renames, required)
+
+
+def _order(subexpressions):
+    """
+    Orders the subexpressions of an AndExpression greedily: Start with the smallest,
+    then repeatedly add the subexpression that gives the smallest estimated join.
+    This avoids cross products where possible.
+    :param subexpressions: A list of Expressions.
+    :return: A list with the same Expressions, reordered.
+    """
+    remaining = [(sub_expr, estimate(sub_expr)) for sub_expr in subexpressions]
+    first = min(remaining, key=lambda pair: pair[1].size)
+    remaining.remove(first)
+    ordered = [first[0]]
+    joined = first[1]
+    while len(remaining) > 0:
+        best = min(remaining, key=lambda pair: joined.join(pair[1]).size)
+        remaining.remove(best)
+        ordered.append(best[0])
+        joined = joined.join(best[1])
+    return ordered
+
+
+def plan(expression):
+    """
+    Rewrites an Expression into one that generates the same set of Scenarios,
+    but with smaller intermediate results:
+      - Filters are fused and pushed down, see push_down().
+      - Nested AndExpressions are flattened into one.
+      - An AndExpression with a small OrExpression among its subexpressions
+        is distributed over it, so each branch becomes one flat join.
+      - The subexpressions of every AndExpression with three or more
+        subexpressions are ordered by estimated join size, see _order().
+    The rewritten Expression shares leaves, including ReferenceExpressions, with the original.
+    ReferenceExpressions are not followed.
+    :param expression: Any Expression.
+    :return: The rewritten Expression.
+    """
+    return _plan_joins(push_down(expression), {})
+
+
+def _plan_joins(expression, memo):
+    """
+    Does the work of plan() after push_down().
+    :param expression: Any Expression.
+    :param memo: Used to preserve sharing of subexpressions.
+    :return: The rewritten Expression.
+    """
+    if id(expression) in memo:
+        return memo[id(expression)]
+    if isinstance(expression, AndExpression):
+        result = _plan_and([_plan_joins(sub_expr, memo) for sub_expr in expression.subexpressions])
+    elif isinstance(expression, OrExpression):
+        result = OrExpression(*[_plan_joins(sub_expr, memo) for sub_expr in expression.subexpressions],
+                              strategy=expression.strategy)
+    elif isinstance(expression, FilterEqExpression):
+        result = FilterEqExpression(expression.key, expression.expected_value, _plan_joins(expression.expr, memo))
+    elif isinstance(expression, RenameExpression):
+        result = RenameExpression(_plan_joins(expression.expr, memo), **expression.map)
+    elif isinstance(expression, SelectProjectExpression):
+        result = SelectProjectExpression(_plan_joins(expression.expr, memo),
+                                         expression.constants, expression.renames, expression.required)
+    elif isinstance(expression, ApplyExpression):
+        result = ApplyExpression(_plan_joins(expression.callable_expression, memo),
+                                 _plan_joins(expression.input_expression, memo),
+                                 expression.strategy)
+    else:
+        result = expression
+    memo[id(expression)] = result
+    return result
+
+
+def _plan_and(subexpressions):
+    """
+    :param subexpressions: The already planned subexpressions of an AndExpression.
+    :return: A planned Expression equivalent to AndExpression(*subexpressions).
+    """
+    flat = []
+    for sub_expr in subexpressions:
+        if isinstance(sub_expr, AndExpression):
+            flat.extend(sub_expr.subexpressions)
+        else:
+            flat.append(sub_expr)
+    for index, sub_expr in enumerate(flat):
+        if isinstance(sub_expr, OrExpression) and 0 < len(sub_expr.subexpressions) <= MAX_DISTRIBUTED_BRANCHES:
+            others = flat[:index] + flat[index + 1:]
+            if len(others) > 0:
+                return OrExpression(*[_plan_and(others + [branch]) for branch in sub_expr.subexpressions],
+                                    strategy=sub_expr.strategy)
+    if len(flat) < 3:
+        return AndExpression(*flat)
+    return AndExpression(*_order(flat))
+
+
+def explain(expression, indent=''):
+    """
+    Describes an Expression, e.g. one returned by plan(), with an Estimate for each subexpression.
+    :param expression: Any Expression.
+    :param indent: Prefix for every line.
+    :return: A string with one line per subexpression.
+    """
+    if isinstance(expression, AndExpression) or isinstance(expression, OrExpression):
+        children = expression.subexpressions
+        label = expression.__class__.__name__
+    elif isinstance(expression, FilterEqExpression):
+        children = [expression.expr]
+        label = '{} {!r}=={!r}'.format(expression.__class__.__name__, expression.key, expression.expected_value)
+    elif isinstance(expression, RenameExpression):
+        children = [expression.expr]
+        label = '{} {!r}'.format(expression.__class__.__name__, expression.map)
+    elif isinstance(expression, SelectProjectExpression):
+        children = [expression.expr]
+        label = '{} {!r} {!r}'.format(expression.__class__.__name__, expression.constants, expression.renames)
+    elif isinstance(expression, ApplyExpression):
+        children = [expression.callable_expression, expression.input_expression]
+        label = expression.__class__.__name__
+    elif isinstance(expression, ReferenceExpression):
+        children = []
+        label = '{} {!r}'.format(expression.__class__.__name__, expression.name)
+    elif isinstance(expression, ConstantExpression):
+        children = []
+        label = repr(expression)
+    else:
+        children = []
+        label = expression.__class__.__name__
+    lines = ['{}{} {}'.format(indent, label, estimate(expression))]
+    lines.extend(explain(child, indent=indent + '  ') for child in children)
+    return '\n'.join(lines)
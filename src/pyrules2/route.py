@@ -1,8 +1,14 @@
-from collections import namedtuple
-from numbers import Number
+from collections import namedtuple, Mapping
+from numbers import Number, Integral
+from array import array
+from itertools import permutations, chain
+from heapq import nsmallest
+from bisect import bisect_right, insort
+from operator import itemgetter, add, le
+from time import monotonic
 from frozendict import frozendict
-from itertools import permutations, islice
 from pyrules2 import when
+from pyrules2.expression import ConstantExpression, OrExpression, ApplyExpression
 
 __author__ = 'nhc'
 
@@ -10,13 +16,132 @@ __author__ = 'nhc'
 Indicates that the named cost is set to 0 when the place is reached.'''
 RESET = 'RESET'
 
+
+class _Reroute(object):
+    """
+    The callable in reroute below: Maps a Route to its alternatives within the given bounds.
+    """
+    def __init__(self, bounds):
+        """
+        :param bounds: A dict mapping cost names to upper bounds, see Route.alternatives().
+        """
+        self.bounds = bounds
+
+    def __call__(self, route):
+        return route.alternatives(**self.bounds)
+
+    def bounded(self, item_limits):
+        """
+        :param item_limits: A dict mapping cost names to upper bounds, like for limit().
+        :return: A _Reroute only generating the alternatives within both these and its own bounds.
+        """
+        bounds = dict(self.bounds)
+        for cost_name, lim in item_limits.items():
+            bounds[cost_name] = min(lim, bounds[cost_name]) if cost_name in bounds else lim
+        return _Reroute(bounds)
+
+
 '''
 Example use: reroute(when(my_var=driving_roundtrip(*MY_PLACES)))
 Result is an expression generating scenarios where my_var is mapped
 to alternative routes to *MY_PLACES.
 Guarantee: If applied recursively, all possible alternatives will be generated.
 '''
-reroute = when(f=lambda x: x.alternatives())
+reroute = when(f=_Reroute({}))
+
+
+class _Optimize(object):
+    """
+    The callable in optimize() below: Maps a Route to its best reorderings.
+    """
+    def __init__(self, cost_name, k, bounds):
+        """
+        :param cost_name: Like for Route.best()
+        :param k: Like for Route.best()
+        :param bounds: Like for Route.best()
+        """
+        self.cost_name = cost_name
+        self.k = k
+        self.bounds = bounds
+
+    def __call__(self, route):
+        for best in route.best(self.cost_name, self.k, **self.bounds):
+            yield best
+
+
+def optimize(cost_name='distance', k=1, **bounds):
+    """
+    Example use: optimize('distance', k=3, milk=30)(when(my_var=driving_roundtrip(*MY_PLACES)))
+    Result is an expression generating scenarios where my_var is mapped to each of
+    the (at most) 3 shortest reorderings of the intermediate stops, which collect at most
+    30 milk between RESETs. Unlike reroute, it need not be applied recursively.
+    :param cost_name: The leg cost to minimize, e.g. 'distance'
+    :param k: The number of Routes wanted per Route.
+    :param bounds: Upper bounds for per-Place costs, or for cost_name, see Route.best().
+    :return: An Expression to apply to Expressions generating Routes.
+    """
+    return when(f=_Optimize(cost_name, k, bounds))
+
+
+class _Improve(object):
+    """
+    The callable in improve() below: Maps a Route to a stream of better Routes.
+    """
+    def __init__(self, cost_name, timeout, bounds):
+        """
+        :param cost_name: Like for Route.improvements()
+        :param timeout: Like for Route.improvements()
+        :param bounds: Like for Route.improvements()
+        """
+        self.cost_name = cost_name
+        self.timeout = timeout
+        self.bounds = bounds
+
+    def __call__(self, route):
+        return route.improvements(self.cost_name, self.timeout, **self.bounds)
+
+
+def improve(cost_name='distance', timeout=1.0, **bounds):
+    """
+    Example use: improve('distance', timeout=2, milk=30)(when(my_var=driving_roundtrip(*MY_PLACES)))
+    Result is an expression generating scenarios where my_var is mapped to successively
+    shorter reorderings of the intermediate stops, found by local search within 2 seconds,
+    which collect at most 30 milk between RESETs.
+    :param cost_name: The leg cost to minimize, e.g. 'distance'
+    :param timeout: The number of seconds to search per Route, or None for no limit.
+    :param bounds: Upper bounds for per-Place costs, or for cost_name, see Route.improvements().
+    :return: An Expression to apply to Expressions generating Routes.
+    """
+    return when(f=_Improve(cost_name, timeout, bounds))
+
+
+class _LimitExpression(ConstantExpression):
+    """
+    The Expression returned by limit(). When applied to reroute(...), it hands its
+    bounds to Route.alternatives() instead of filtering afterwards.
+    """
+    def __init__(self, item_limits):
+        def filter_fun(value):
+            bounds_ok = [getattr(value, cost_name) <= lim for cost_name, lim in list(item_limits.items())]
+            # Yield either 0 or 1 results
+            if all(bounds_ok):
+                yield value
+        super().__init__({'_': filter_fun})
+        self.item_limits = item_limits
+
+    def __call__(self, input_expression):
+        if isinstance(input_expression, OrExpression):
+            return OrExpression(*[self(sub_expr) for sub_expr in input_expression.subexpressions],
+                                strategy=input_expression.strategy)
+        if isinstance(input_expression, ApplyExpression) \
+                and isinstance(input_expression.callable_expression, ConstantExpression) \
+                and len(input_expression.callable_expression.scenario) == 1:
+            key, f = input_expression.callable_expression.scenario.get_only_item()
+            if isinstance(f, _Reroute):
+                return ApplyExpression(ConstantExpression({key: f.bounded(self.item_limits)}),
+                                       input_expression.input_expression,
+                                       input_expression.strategy)
+        return super().__call__(input_expression)
 
 
 def limit(**item_limits):
@@ -24,18 +149,15 @@ def limit(**item_limits):
     Creates an Expression to filter scenarios based on numeric bounds.
     Example limit(x=2, y=3)(when(x=1, y=3) | when(x=3, y=0) | when(x=-1, y=4))
      will generate only one Scenario, with {x:1, y:3}.
+    Applied to reroute(...), the bounds are passed on to Route.alternatives(),
+    so routes breaking them are never generated, see _LimitExpression.
     :param item_limits: One or more limit on the form some_var=30.
     The returned Expression will remove scenarios where some_var maps to
     values larger than 30.
     :return: An Expression which will filter away scenarios in which
     one or more limit is broken, leaving the remaining unchanged.
     """
-    def filter_fun(value):
-        bounds_ok = [getattr(value, cost_name) <= lim for cost_name, lim in list(item_limits.items())]
-        # Yield either 0 or 1 results
-        if all(bounds_ok):
-            yield value
-    return when(_=filter_fun)
+    return _LimitExpression(item_limits)
 
 
 def place(address, **kwargs):
@@ -77,6 +199,210 @@ class Place(namedtuple('Place', ['address', 'costs'])):
         return '<{}>'.format(self.address)
 
 
+class CostMatrix(Mapping):
+    """
+    The costs of moving between any two of a set of Places, e.g. distance and duration,
+    shared by every Route between these Places.
+    The Places are numbered 0, 1, ... in the order given, and for each cost name,
+    the costs are stored as one compact array per origin, indexed by destination.
+    A CostMatrix is also a Mapping from cost name to a Mapping from pairs of Places
+    to numbers, like the frozendicts it replaces, see Route.
+    """
+    def __init__(self, places, costs):
+        """
+        :param places: A sequence of Places. Repeated Places are numbered once.
+        :param costs: A dict mapping every cost name to a Mapping from every pair
+        of the Places to a number, e.g. {'distance': {(A, A): 0, (A, B): 7, (B, A): 8, (B, B): 0}}
+        """
+        self.places = tuple(dict.fromkeys(places))
+        self.indexes = {p: index for index, p in enumerate(self.places)}
+        self.rows = {}
+        for cost_name, pair_costs in costs.items():
+            values = [[pair_costs[(origin, destination)] for destination in self.places] for origin in self.places]
+            typecode = 'q' if all(isinstance(v, Integral) for row in values for v in row) else 'd'
+            self.rows[cost_name] = [array(typecode, row) for row in values]
+        self._hash = None
+
+    def index(self, p):
+        """
+        :param p: One of the Places in this CostMatrix.
+        :return: The number of the Place, e.g. 0
+        """
+        return self.indexes[p]
+
+    def total(self, cost_name, indexes):
+        """
+        :param cost_name: A cost name in this CostMatrix, e.g. 'distance'
+        :param indexes: A sequence of Place numbers, see index(), e.g. (0, 2, 1, 0)
+        :return: The sum of the costs of moving between consecutive Places.
+        """
+        rows = self.rows[cost_name]
+        return sum(rows[origin][destination] for origin, destination in zip(indexes, indexes[1:]))
+
+    def extended(self, places, costs):
+        """
+        Adds Places without touching the costs between the Places already here.
+        This CostMatrix is left unchanged, so the Routes sharing it and the costs
+        they have computed stay valid.
+        :param places: A sequence of Places. Those already in this CostMatrix are ignored.
+        :param costs: Like for __init__(), with the same cost names as this CostMatrix,
+        but only the pairs involving a new Place are needed.
+        :return: A CostMatrix with the Places of this one, numbered as here, followed by the new Places.
+        This CostMatrix if there are no new Places.
+        """
+        new_places = tuple(p for p in dict.fromkeys(places) if p not in self.indexes)
+        if len(new_places) == 0:
+            return self
+        assert set(costs) == set(self.rows)
+        matrix = CostMatrix.__new__(CostMatrix)
+        matrix.places = self.places + new_places
+        matrix.indexes = dict(self.indexes)
+        matrix.indexes.update((p, len(self.places) + index) for index, p in enumerate(new_places))
+        matrix.rows = {}
+        for cost_name, pair_costs in costs.items():
+            old_rows = self.rows[cost_name]
+            columns = [[pair_costs[(origin, destination)] for destination in new_places] for origin in self.places]
+            new_rows = [[pair_costs[(origin, destination)] for destination in matrix.places] for origin in new_places]
+            integral = all(row.typecode == 'q' for row in old_rows) and \
+                all(isinstance(v, Integral) for row in columns + new_rows for v in row)
+            typecode = 'q' if integral else 'd'
+            rows = []
+            for old_row, column in zip(old_rows, columns):
+                row = array(typecode, old_row)
+                row.extend(column)
+                rows.append(row)
+            rows.extend(array(typecode, row) for row in new_rows)
+            matrix.rows[cost_name] = rows
+        matrix._hash = None
+        return matrix
+
+    def __getitem__(self, cost_name):
+        return _PairCosts(self, self.rows[cost_name])
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, cost_name):
+        return cost_name in self.rows
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.places, frozenset(self.rows)))
+        return self._hash
+
+    def __eq__(self, other):
+        # Routes compare their CostMatrix, and share it, so identity is the common case
+        if self is other:
+            return True
+        if not isinstance(other, CostMatrix):
+            return Mapping.__eq__(self, other)
+        return self.places == other.places and self.rows == other.rows
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        # String hashes differ between processes, so do not keep the cached hash
+        state = dict(self.__dict__)
+        state['_hash'] = None
+        return state
+
+    def __repr__(self):
+        return '<{} {} places, costs {}>'.format(self.__class__.__name__, len(self.places), sorted(self.rows))
+
+
+def _undominated(entries, k):
+    """
+    :param entries: A list of entries (cost, loads, ...) sorted by cost, see Route.best()
+    :param k: The number of Routes wanted.
+    :return: The entries for which fewer than k earlier entries have loads at least as low.
+    """
+    kept = []
+    if len(entries[0][1]) == 1:  # One capacity: Count lower loads by bisection
+        kept_loads = []
+        for entry in entries:
+            running = entry[1][0]
+            if bisect_right(kept_loads, running) < k:
+                insort(kept_loads, running)
+                kept.append(entry)
+        return kept
+    for entry in entries:
+        loads = entry[1]
+        dominating = 0
+        for other in kept:
+            if all(a <= b for a, b in zip(other[1], loads)):
+                dominating += 1
+                if dominating == k:
+                    break
+        if dominating < k:
+            kept.append(entry)
+    return kept
+
+
+def _moves(seq, rows, forward, backward, order):
+    """
+    Generates the local search moves for Route.improvements().
+    :param seq: The Place numbers of the current Route, see CostMatrix.index()
+    :param rows: The rows of the CostMatrix for the cost minimized.
+    :param forward: forward[i] is the cost of the legs from seq[0] to seq[i].
+    :param backward: backward[i] is the cost of the same legs driven in reverse.
+    :param order: The current order, to be permuted by a move.
+    :return: A generator yielding pairs (delta, candidate), where delta is the change in cost
+    of a move, and candidate() computes the order after the move.
+    """
+    n = len(seq)
+    # 2-opt: Reverse seq[i..j]
+    for i in range(1, n - 2):
+        a, first = seq[i - 1], seq[i]
+        for j in range(i + 1, n - 1):
+            last, b = seq[j], seq[j + 1]
+            delta = rows[a][last] + rows[first][b] - rows[a][first] - rows[last][b] \
+                + (backward[j] - backward[i]) - (forward[j] - forward[i])
+            yield delta, lambda i=i, j=j: order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+    # Or-opt and relocate: Move seq[i..e] between seq[t - 1] and seq[t]
+    for length in (3, 2, 1):
+        for i in range(1, n - length):
+            e = i + length - 1
+            a, first, last, b = seq[i - 1], seq[i], seq[e], seq[e + 1]
+            removed = rows[a][b] - rows[a][first] - rows[last][b]
+            for t in chain(range(1, i), range(e + 2, n)):
+                c, d = seq[t - 1], seq[t]
+                delta = removed + rows[c][first] + rows[last][d] - rows[c][d]
+                yield delta, lambda i=i, e=e, t=t: _moved(order, i, e, t)
+
+
+def _moved(order, i, e, t):
+    """
+    :return: A copy of order with order[i..e] moved between order[t - 1] and order[t].
+    """
+    segment = order[i:e + 1]
+    rest = order[:i] + order[e + 1:]
+    position = t if t < i else t - len(segment)
+    return rest[:position] + segment + rest[position:]
+
+
+class _PairCosts(Mapping):
+    """
+    A view of one cost in a CostMatrix as a Mapping from pairs of Places to numbers.
+    """
+    def __init__(self, matrix, rows):
+        self.matrix = matrix
+        self.rows = rows
+
+    def __getitem__(self, pair):
+        origin, destination = pair
+        return self.rows[self.matrix.indexes[origin]][self.matrix.indexes[destination]]
+
+    def __iter__(self):
+        return ((origin, destination) for origin in self.matrix.places for destination in self.matrix.places)
+
+    def __len__(self):
+        return len(self.matrix.places) ** 2
+
+
 class Route(namedtuple('Route', ['places', 'leg_costs'])):
     """
     Represents a sequence of Places to be visited in order.
@@ -84,12 +410,17 @@ class Route(namedtuple('Route', ['places', 'leg_costs'])):
     like distance and duration.
     When r is a Route,
       - r.places should be a tuple of Places, e.g. (place('New York'), place('Chicago'), place('Boston'))
-      - r.leg_costs should be frozendict mapping from cost name to cost function.
+      - r.leg_costs should be a CostMatrix for (at least) the Places in r.places, or a
+        frozendict mapping from cost name to cost function.
         The cost function should itself be a frozendict mapping each pair of Places in r.places
         to a number.
         Example r.leg_costs:
           frozendict({'distance': di, 'duration': du}), where
           di = du = frozendict({(A,B): 7, (B,A): 8}) where r.places is (A,B)
+    Every cost of a Route, e.g. r.distance, is computed once, when first needed,
+    and then kept in the Route.
+    Two Routes are equal if they visit the same Places with the same costs for every leg,
+    even if their CostMatrixes differ for other Places.
     """
 
     def legs(self):
@@ -99,6 +430,26 @@ class Route(namedtuple('Route', ['places', 'leg_costs'])):
         """
         return list(zip(self.places[:-1], self.places[1:]))
 
+    def indexes(self):
+        """
+        :return: A tuple with the number of each Place of this Route in its CostMatrix,
+        e.g. (0, 2, 1, 0). Cached.
+        """
+        if '_indexes' not in self.__dict__:
+            indexes = self._cost_matrix().indexes
+            self.__dict__['_indexes'] = tuple(indexes[p] for p in self.places)
+        return self.__dict__['_indexes']
+
+    def _cost_matrix(self):
+        """
+        :return: self.leg_costs if it is a CostMatrix, otherwise a CostMatrix with the same costs. Cached.
+        """
+        if isinstance(self.leg_costs, CostMatrix):
+            return self.leg_costs
+        if '_matrix' not in self.__dict__:
+            self.__dict__['_matrix'] = CostMatrix(self.places, self.leg_costs)
+        return self.__dict__['_matrix']
+
     def __getattr__(self, cost_name):
         """
         Convenience method for computing one cost of this Route.
@@ -106,13 +457,21 @@ class Route(namedtuple('Route', ['places', 'leg_costs'])):
         r.fuel will return sum(l.distance for l in r.legs())
         Example: If every place in the Route r has a cost named 'fuel',
         r.fuel will return max(sum(p.fuel for p in subtrip) for subtrip in r.split(p.fuel==RESET))
+        The cost is stored as an ordinary attribute, so this is only called once per cost.
         :param cost_name: The name of the cost, e.g. 'fuel'
         :return: the computed cost.
         """
+        if cost_name.startswith('_'):  # Not a cost, e.g. __deepcopy__
+            raise AttributeError(cost_name)
         if cost_name in self.leg_costs:
-            return sum([self.leg_costs[cost_name][leg] for leg in self.legs()])
+            if isinstance(self.leg_costs, CostMatrix):
+                value = self.leg_costs.total(cost_name, self.indexes())
+            else:
+                value = sum([self.leg_costs[cost_name][leg] for leg in self.legs()])
         else:  # Must be per-Place cost
-            return max(self._compute_between_resets(cost_name))
+            value = max(self._compute_between_resets(cost_name))
+        self.__dict__[cost_name] = value
+        return value
 
     def _compute_between_resets(self, cost_name):
         """
@@ -131,16 +490,351 @@ class Route(namedtuple('Route', ['places', 'leg_costs'])):
         if len(current_subtrip) > 0:
             yield sum(current_subtrip)
 
+    def _leg_values(self):
+        """
+        :return: A tuple with one pair (cost name, tuple of the costs of each leg) per leg cost,
+        sorted by cost name. Cached.
+        """
+        if '_legs' not in self.__dict__:
+            if isinstance(self.leg_costs, CostMatrix):
+                rows = self.leg_costs.rows
+                indexes = self.indexes()
+                legs = list(zip(indexes, indexes[1:]))
+                values = ((cost_name, tuple(rows[cost_name][origin][destination] for origin, destination in legs))
+                          for cost_name in sorted(rows))
+            else:  # Only the costs of these legs are needed, so the mapping need not have the rest
+                legs = self.legs()
+                values = ((cost_name, tuple(self.leg_costs[cost_name][leg] for leg in legs))
+                          for cost_name in sorted(self.leg_costs))
+            self.__dict__['_legs'] = tuple(values)
+        return self.__dict__['_legs']
+
+    def fingerprint(self):
+        """
+        :return: A string representing this Route in RuleBook.fingerprint(), which depends only on
+        its Places and the costs of its legs, like ==, and not on the rest of its CostMatrix.
+        """
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self.places, self._leg_values())
+
+    def __eq__(self, other):
+        # Only the Places visited and the costs of the legs driven matter, not the rest of
+        # the CostMatrix, which may have grown with other Places since, see CostMatrix.extended()
+        if not isinstance(other, Route):
+            return tuple.__eq__(self, other)
+        if self.places != other.places:
+            return False
+        return self.leg_costs is other.leg_costs or self._leg_values() == other._leg_values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.places)
+
     def __str__(self):
         return '{} km: {}'.format(self.distance / 1000, ' --> '.join(str(p) for p in self.places))
 
-    def alternatives(self):
+    def alternatives(self, **bounds):
         """
-        Generates every alternative route for this Route.
+        Generates every alternative route for this Route, i.e. every distinct reordering
+        of the intermediate stops except this Route itself.
+        Given bounds, e.g. alternatives(milk=30, distance=400000), only the alternatives
+        with costs within the bounds are generated. The intermediate stops are placed
+        one at a time, and a partial route that already breaks a bound is not extended
+        (branch and bound), so most infeasible alternatives are never built.
+        Costs used in bounds must not be negative.
+        :param bounds: Upper bounds for leg costs or per-Place costs, by cost name.
         :return: Generator yielding Routes with the intermediate stops reordered.
+        The bounded costs are already computed and cached in these Routes.
+        """
+        places = self.places
+        last = len(places) - 1
+        if last < 1:
+            return
+        # Leg costs add up along the route; per-Place costs add up between RESETs
+        leg_bounds = [(name, lim) for name, lim in bounds.items() if name in self.leg_costs]
+        place_bounds = [(name, tuple(p.costs[name] for p in places), lim)
+                        for name, lim in bounds.items() if name not in self.leg_costs]
+        # Without leg bounds, no leg costs are needed, e.g. from a mapping with only the legs of this Route
+        if len(leg_bounds) > 0:
+            matrix = self._cost_matrix()
+            indexes = self.indexes()
+            leg_bounds = [(name, matrix.rows[name], lim) for name, lim in leg_bounds]
+            # The CostMatrix may be shared by many more Places, so only check the legs between these
+            numbers = set(indexes)
+            for _, rows, _ in leg_bounds:
+                assert all(rows[origin][destination] >= 0 for origin in numbers for destination in numbers)
+        for _, costs, _ in place_bounds:
+            assert all(cost == RESET or cost >= 0 for cost in costs)
+
+        def place_sums(sums, position):
+            """
+            :return: The (running sum, max subtrip sum) for each per-Place bound
+            after visiting the given position, or None if a bound is broken.
+            """
+            result = []
+            for (_, costs, lim), (running, highest) in zip(place_bounds, sums):
+                cost = costs[position]
+                running = 0 if cost == RESET else running + cost
+                if running > lim:
+                    return None
+                result.append((running, max(highest, running)))
+            return result
+
+        def leg_sums(sums, origin, destination):
+            """
+            :return: The sum for each leg bound after adding a leg, or None if a bound is broken.
+            """
+            result = []
+            for (_, rows, lim), total in zip(leg_bounds, sums):
+                total += rows[indexes[origin]][indexes[destination]]
+                if total > lim:
+                    return None
+                result.append(total)
+            return result
+
+        def extend(prefix, remaining, legs, stops):
+            if len(remaining) == 0:
+                legs = leg_sums(legs, prefix[-1], last)
+                stops = None if legs is None else place_sums(stops, last)
+                if stops is not None:
+                    yield prefix + (last,), legs, stops
+                return
+            tried = set()
+            for k, position in enumerate(remaining):
+                if places[position] in tried:  # Same Place, same alternatives
+                    continue
+                tried.add(places[position])
+                next_legs = leg_sums(legs, prefix[-1], position)
+                next_stops = None if next_legs is None else place_sums(stops, position)
+                if next_stops is not None:
+                    yield from extend(prefix + (position,), remaining[:k] + remaining[k + 1:],
+                                      next_legs, next_stops)
+
+        identity = tuple(range(last + 1))
+        if len(bounds) == 0 and len(set(places[1:-1])) == last - 1:
+            # Nothing to prune and no repeated stops, so itertools is faster
+            candidates = (((0,) + alt + (last,), [], []) for alt in permutations(range(1, last)))
+        else:
+            first_stops = place_sums([(0, 0)] * len(place_bounds), 0)
+            if first_stops is None:
+                return
+            candidates = extend((0,), tuple(range(1, last)), [0] * len(leg_bounds), first_stops)
+        for positions, legs, stops in candidates:
+            if positions == identity:
+                continue
+            route = Route(places=tuple([places[i] for i in positions]), leg_costs=self.leg_costs)
+            for (name, _, _), total in zip(leg_bounds, legs):
+                route.__dict__[name] = total
+            for (name, _, _), (_, highest) in zip(place_bounds, stops):
+                route.__dict__[name] = highest
+            yield route
+
+    def best(self, cost_name='distance', k=1, **bounds):
+        """
+        Finds the reorderings of the intermediate stops with the lowest total leg cost,
+        keeping the first and last Place fixed, by dynamic programming over the sets of
+        stops visited so far (Held-Karp), see
+        https://en.wikipedia.org/wiki/Held%E2%80%93Karp_algorithm
+        Repeated stops, e.g. a depot where a per-Place cost is RESET, are interchangeable,
+        so the DP decides where to put them. Per-Place bounds are capacities:
+        The cost summed since the last RESET is part of the DP state, and states breaking
+        a bound are dropped. This takes time exponential in the number of distinct stops
+        rather than factorial, e.g. a few seconds for 15 stops.
+        :param cost_name: The leg cost to minimize, e.g. 'duration'
+        :param k: The number of Routes wanted.
+        :param bounds: Upper bounds for per-Place costs, or for cost_name, e.g. milk=30
+        :return: A list of at most k distinct Routes, cheapest first. It may include this Route.
+        """
+        assert k >= 1
+        matrix = self._cost_matrix()
+        assert cost_name in matrix
+        for name in bounds:
+            assert name == cost_name or name not in matrix, 'Only {} can be bounded among leg costs'.format(cost_name)
+        rows = matrix.rows[cost_name]
+        cost_limit = bounds.get(cost_name)
+        places = self.places
+        if len(places) < 2:
+            return [self] if cost_limit is None or getattr(self, cost_name) <= cost_limit else []
+        # The distinct intermediate stops ("kinds") and how many times each must be visited
+        counts = {}
+        for p in places[1:-1]:
+            counts[p] = counts.get(p, 0) + 1
+        kinds = list(counts)
+        kind_indexes = [matrix.index(p) for p in kinds]
+        # A set of visits is encoded as one integer in a mixed radix, one digit per kind
+        weights = []
+        weight = 1
+        for p in kinds:
+            weights.append(weight)
+            weight *= counts[p] + 1
+        digits = [(weights[i], counts[p] + 1, counts[p]) for i, p in enumerate(kinds)]
+        capacities = [(name, lim) for name, lim in bounds.items() if name != cost_name]
+        limits = tuple(lim for _, lim in capacities)
+        for lim in limits:
+            assert lim >= 0
+
+        def place_costs(p):
+            """
+            :return: A tuple with p's cost for each capacity, None meaning RESET.
+            """
+            values = tuple(None if p.costs[name] == RESET else p.costs[name] for name, _ in capacities)
+            assert all(value is None or value >= 0 for value in values)
+            return values
+
+        def load(loads, p):
+            """
+            :return: The running per-Place costs after visiting p, or None if a capacity is exceeded.
+            """
+            values = place_costs(p)
+            result = tuple([0 if value is None else running + value for running, value in zip(loads, values)])
+            for running, lim in zip(result, limits):
+                if running > lim:
+                    return None
+            return result
+
+        # Common cases: Every per-Place cost is RESET, or none is
+        kind_values = [place_costs(p) for p in kinds]
+        kind_resets = [all(value is None for value in values) and len(values) > 0 for values in kind_values]
+        kind_values = [None if None in values else values for values in kind_values]
+        # Each layer maps a state (visits, last kind or -1 for the origin) to a list of
+        # entries (cost, loads, previous state, position of the entry there), cheapest first.
+        # An entry is dropped if k others in its state are as cheap and have loads as low,
+        # as every way to complete it would be beaten by k ways to complete those.
+        zeros = (0,) * len(capacities)
+        first_loads = load(zeros, places[0])
+        if first_loads is None:
+            return []
+        layers = [{(0, -1): [(0, first_loads, None, 0)]}]
+        origin_index = matrix.index(places[0])
+        for _ in range(len(places) - 2):
+            layer = {}
+            for state, entries in layers[-1].items():
+                visits, last = state
+                row = rows[origin_index if last < 0 else kind_indexes[last]]
+                for kind, (weight, radix, count) in enumerate(digits):
+                    if (visits // weight) % radix == count:
+                        continue
+                    step = row[kind_indexes[kind]]
+                    values = kind_values[kind]
+                    resets = kind_resets[kind]
+                    candidates = None
+                    for position, (cost, loads, _, _) in enumerate(entries):
+                        if cost_limit is not None and cost + step > cost_limit:
+                            break  # The entries are sorted by cost
+                        if len(limits) == 0:
+                            next_loads = loads
+                        elif resets:
+                            if position == k:  # Every load is reset, so only the k cheapest matter
+                                break
+                            next_loads = zeros
+                        elif values is None:
+                            next_loads = load(loads, kinds[kind])
+                            if next_loads is None:
+                                continue
+                        else:
+                            next_loads = tuple(map(add, loads, values))
+                            if not all(map(le, next_loads, limits)):
+                                continue
+                        if candidates is None:
+                            candidates = layer.setdefault((visits + weight, kind), [])
+                        candidates.append((cost + step, next_loads, state, position))
+            for state, candidates in layer.items():
+                candidates.sort(key=itemgetter(0))
+                if len(candidates) > k:
+                    layer[state] = _undominated(candidates, k)
+            layers.append(layer)
+        # Finally, the leg to the destination
+        destination_index = matrix.index(places[-1])
+        finals = []
+        for state, entries in layers[-1].items():
+            _, last = state
+            step = rows[origin_index if last < 0 else kind_indexes[last]][destination_index]
+            for position, (cost, loads, _, _) in enumerate(entries):
+                if (cost_limit is None or cost + step <= cost_limit) and load(loads, places[-1]) is not None:
+                    finals.append((cost + step, state, position))
+        routes = []
+        for cost, state, position in nsmallest(k, finals, key=itemgetter(0)):
+            stops = []
+            for layer in reversed(layers[1:]):
+                stops.append(kinds[state[1]])
+                _, _, state, position = layer[state][position]
+            route = Route(places=(places[0],) + tuple(reversed(stops)) + (places[-1],), leg_costs=self.leg_costs)
+            route.__dict__[cost_name] = cost
+            routes.append(route)
+        return routes
+
+    def improvements(self, cost_name='distance', timeout=None, **bounds):
         """
-        origin = self.places[0]
-        intermediate_stops = self.places[1:-1]
-        destination = self.places[-1]
-        for alt in islice(permutations(intermediate_stops), 2, None):
-            yield Route(places=tuple([origin] + list(alt) + [destination]), leg_costs=self.leg_costs)
+        Improves this Route by local search, see
+        https://en.wikipedia.org/wiki/2-opt
+        Every pass tries these moves of the intermediate stops, and makes the first that helps:
+          - 2-opt: Reverse a stretch of stops
+          - Or-opt: Move a stretch of 2 or 3 stops elsewhere
+          - Relocate: Move 1 stop elsewhere
+        The change in cost of a move is computed in constant time from the legs it
+        adds and removes, and prefix sums of the legs in both directions.
+        Per-Place bounds are capacities, like for best(). If this Route exceeds them,
+        moves are first made to reduce the excess, and then to reduce the cost.
+        :param cost_name: The leg cost to minimize, e.g. 'duration'
+        :param timeout: None, or the number of seconds to search, e.g. 0.5
+        :param bounds: Upper bounds for per-Place costs, or for cost_name, e.g. milk=30
+        :return: A generator yielding Routes within the bounds, each cheaper than the last,
+        until no move helps or the time is up. It does not yield this Route itself.
+        """
+        matrix = self._cost_matrix()
+        assert cost_name in matrix
+        for name in bounds:
+            assert name == cost_name or name not in matrix, 'Only {} can be bounded among leg costs'.format(cost_name)
+        rows = matrix.rows[cost_name]
+        cost_limit = bounds.get(cost_name)
+        capacities = [(name, lim) for name, lim in bounds.items() if name != cost_name]
+        places = self.places
+        n = len(places)
+        if n < 4:  # Fewer than 2 intermediate stops
+            return
+        deadline = None if timeout is None else monotonic() + timeout
+        indexes = [matrix.index(p) for p in places]
+        values = [[p.costs[name] for p in places] for name, _ in capacities]
+
+        def excess(order):
+            """
+            :return: How much the running per-Place costs exceed the capacities, summed.
+            """
+            total = 0
+            for costs, (_, lim) in zip(values, capacities):
+                running = 0
+                for position in order:
+                    cost = costs[position]
+                    running = 0 if cost == RESET else running + cost
+                    if running > lim:
+                        total += running - lim
+            return total
+
+        order = list(range(n))  # Positions in self.places
+        current_excess = excess(order)
+        current_cost = sum(rows[a][b] for a, b in zip(indexes, indexes[1:]))
+        improved = True
+        while improved:
+            improved = False
+            seq = [indexes[position] for position in order]
+            forward = [0]
+            backward = [0]
+            for a, b in zip(seq, seq[1:]):
+                forward.append(forward[-1] + rows[a][b])
+                backward.append(backward[-1] + rows[b][a])
+            for delta, candidate in _moves(seq, rows, forward, backward, order):
+                if deadline is not None and monotonic() >= deadline:
+                    return
+                if current_excess == 0 and delta >= 0:
+                    continue
+                new_order = candidate()
+                new_excess = excess(new_order) if len(capacities) > 0 else 0
+                if (new_excess, current_cost + delta) < (current_excess, current_cost):
+                    order, current_excess, current_cost = new_order, new_excess, current_cost + delta
+                    improved = True
+                    break
+            if improved and current_excess == 0 and (cost_limit is None or current_cost <= cost_limit):
+                route = Route(places=tuple([places[position] for position in order]), leg_costs=self.leg_costs)
+                route.__dict__[cost_name] = current_cost
+                yield route
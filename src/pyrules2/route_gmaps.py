@@ -1,14 +1,64 @@
-from frozendict import frozendict
-from os import environ
+from os import environ, makedirs, path
+from time import time, sleep
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from itertools import chain
+import sqlite3
 import googlemaps
-from pyrules2.route import Place, Route
+import googlemaps.exceptions
+import requests
+from pyrules2.route import Place, Route, CostMatrix
 
 __author__ = 'nhc'
 
+CACHE_DIR_VARIABLE = 'PYRULES2_CACHE_DIR'
+'''The environment variable naming the directory of the LegCostCache. Set it to '' to disable caching.'''
+CACHE_TTL_VARIABLE = 'PYRULES2_CACHE_TTL'
+'''The environment variable giving the number of seconds a cached leg cost is used for.'''
+DEFAULT_TTL = 30 * 24 * 3600
+'''Leg costs are cached for 30 days unless PYRULES2_CACHE_TTL says otherwise.'''
+MAX_ORIGINS = 25
+'''The maximal number of origins in one Distance Matrix request.'''
+MAX_DESTINATIONS = 25
+'''The maximal number of destinations in one Distance Matrix request.'''
+MAX_ELEMENTS = 100
+'''The maximal number of elements, i.e. origins times destinations, in one Distance Matrix request.'''
+MAX_WORKERS = 8
+'''The maximal number of Distance Matrix requests in flight at once.'''
+MAX_ATTEMPTS = 4
+'''The number of times a Distance Matrix request is tried before giving up.'''
+BACKOFF = 0.5
+'''The number of seconds to wait before retrying a Distance Matrix request. Doubles for every retry.'''
+RETRIED_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+'''Distance Matrix response statuses that make a request worth retrying.'''
+RETRIED_ERRORS = (googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError)
+'''Exceptions from googlemaps.Client that make a request worth retrying.'''
+CLIENT_RETRY_TIMEOUT = 5
+'''The number of seconds googlemaps.Client itself retries a request failing with HTTP status 5xx.'''
+
+
+def _new_client(key, **kwargs):
+    """
+    :param key: A Google Maps API key, e.g. 'AIza...'
+    :param kwargs: More arguments for googlemaps.Client, e.g. base_url='http://127.0.0.1:41234'
+    :return: A googlemaps.Client which keeps a connection open for each of MAX_WORKERS threads,
+    and leaves most retries to _fetch_tile(), so retries are not nested.
+    """
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
+    return googlemaps.Client(key=key,
+                             retry_timeout=CLIENT_RETRY_TIMEOUT,
+                             retry_over_query_limit=False,
+                             requests_session=session,
+                             **kwargs)
+
+
 # Read Google Maps API key from environment, and create a client object if the key was there
 try:
     key = environ['GOOGLE_MAPS_API_KEY']
-    _client_object = googlemaps.Client(key=key)
+    _client_object = _new_client(key)
 
     def _client_():
         return _client_object
@@ -28,40 +78,278 @@ class Driving(object):
         the given places in sequence,
         e.g. New York -> Chicago -> Los Angeles -> New York
         All distances and durations will be based on driving.
+        Every Route shares one CostMatrix, which grows as new Places are seen,
+        so only the legs to and from new Places are looked up, see SharedCostMatrix.
         """
         places_tuple = tuple(p if isinstance(p, Place) else Place(p) for p in places)
-        leg_costs = frozendict(_google_maps_leg_costs('driving', places_tuple))
-        return Route(places=places_tuple, leg_costs=leg_costs)
+        return Route(places=places_tuple, leg_costs=_driving.covering(places_tuple))
+
+
+class LegCostCache(object):
+    """
+    A persistent cache of the distances and durations looked up on Google Maps,
+    stored in an SQLite database in a directory of your choice, and keyed by
+    origin address, destination address and mode. An entry is used until it is
+    ttl seconds old, and expired entries are deleted by evict().
+    Every method opens its own connection, so a LegCostCache can be shared between
+    threads and processes.
+    """
+    def __init__(self, directory, ttl=DEFAULT_TTL):
+        """
+        :param directory: The directory for the database file. It is created if needed.
+        :param ttl: The number of seconds an entry is used for, e.g. 3600
+        """
+        makedirs(directory, exist_ok=True)
+        self.path = path.join(directory, 'leg_costs.sqlite')
+        self.ttl = ttl
+        with closing(self._connect()) as connection, connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS leg_costs (
+                                  origin TEXT, destination TEXT, mode TEXT,
+                                  distance INTEGER, duration INTEGER, fetched REAL,
+                                  PRIMARY KEY (origin, destination, mode))''')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, mode, pairs):
+        """
+        :param mode: A Google Maps mode, e.g. 'driving'.
+        :param pairs: An iterable of (origin address, destination address) pairs.
+        :return: A dict mapping each of the pairs with an entry that has not expired
+        to a pair (distance, duration).
+        """
+        wanted = set(pairs)
+        found = {}
+        oldest = time() - self.ttl
+        origins = sorted({origin for origin, _ in wanted})
+        with closing(self._connect()) as connection:
+            # One query per origin keeps the number of SQL variables small
+            for origin in origins:
+                for destination, distance, duration in connection.execute(
+                        '''SELECT destination, distance, duration FROM leg_costs
+                           WHERE origin = ? AND mode = ? AND fetched > ?''', (origin, mode, oldest)):
+                    if (origin, destination) in wanted:
+                        found[(origin, destination)] = (distance, duration)
+        return found
+
+    def put(self, mode, costs):
+        """
+        :param mode: A Google Maps mode, e.g. 'driving'.
+        :param costs: A dict mapping (origin address, destination address) pairs
+        to pairs (distance, duration).
+        """
+        now = time()
+        with closing(self._connect()) as connection, connection:
+            connection.executemany('''INSERT OR REPLACE INTO leg_costs VALUES (?, ?, ?, ?, ?, ?)''',
+                                   [(origin, destination, mode, distance, duration, now)
+                                    for (origin, destination), (distance, duration) in costs.items()])
+
+    def evict(self):
+        """
+        Deletes every expired entry.
+        :return: The number of entries deleted.
+        """
+        with closing(self._connect()) as connection, connection:
+            return connection.execute('''DELETE FROM leg_costs WHERE fetched <= ?''',
+                                      (time() - self.ttl,)).rowcount
+
+
+_cache_object = None
+_cache_lock = Lock()
+
+
+def _cache_():
+    """
+    :return: The LegCostCache in the directory named by the environment variable
+    PYRULES2_CACHE_DIR, or ~/.cache/pyrules2 if it is not set.
+    None if the variable is set to the empty string, which disables caching.
+    """
+    global _cache_object
+    with _cache_lock:  # Called from several threads
+        if _cache_object is None:
+            directory = environ.get(CACHE_DIR_VARIABLE, path.join(path.expanduser('~'), '.cache', 'pyrules2'))
+            if directory == '':
+                return None
+            _cache_object = LegCostCache(directory, float(environ.get(CACHE_TTL_VARIABLE, DEFAULT_TTL)))
+        return _cache_object
+
+
+class SharedCostMatrix(object):
+    """
+    The CostMatrix for one Google Maps mode, shared by the Routes made for that mode.
+    It grows as Routes with new Places are made, and only the legs to and from the new Places
+    are looked up, so adding a Place to N known Places looks up N + N + 1 legs, not (N + 1) * (N + 1).
+    Growing never changes a CostMatrix, but makes an extended one, see CostMatrix.extended(),
+    so the Routes made earlier and the costs they have computed stay valid.
+    When m is a SharedCostMatrix,
+      - m.matrix is the CostMatrix for every Place seen so far
+    """
+    def __init__(self, mode, cache=None, client=None):
+        """
+        :param mode: A Google Maps mode, e.g. 'driving'.
+        :param cache: A LegCostCache, or None to use the default, see _cache_().
+        :param client: An object with a distance_matrix() method like googlemaps.Client,
+        or None to use the default, see _client_().
+        """
+        self.mode = mode
+        self.cache = cache
+        self.client = client
+        self.matrix = CostMatrix((), {'distance': {}, 'duration': {}})
+        self._lock = Lock()
 
+    def covering(self, places):
+        """
+        :param places: A sequence of Places, e.g. (place('New York'), place('Chicago'))
+        :return: A CostMatrix for (at least) the given Places.
+        """
+        for waypoint in places:
+            assert isinstance(waypoint, Place)
+        matrix = self.matrix
+        if all(p in matrix.indexes for p in places):
+            return matrix
+        with self._lock:  # One lookup at a time, so no leg is looked up twice
+            matrix = self.matrix
+            new_places = [p for p in dict.fromkeys(places) if p not in matrix.indexes]
+            if len(new_places) == 0:
+                return matrix
+            # A new Place with a known address needs no lookup, its costs are those of a known Place
+            known = {p.address: p for p in matrix.places}
+            costs = _google_maps_costs(self.mode, [p.address for p in new_places], known, self.cache, self.client)
+            distance = dict()
+            duration = dict()
+            for origin in chain(matrix.places, new_places):
+                for destination in new_places:
+                    for pair in ((origin, destination), (destination, origin)):
+                        addresses = (pair[0].address, pair[1].address)
+                        if addresses in costs:
+                            distance[pair], duration[pair] = costs[addresses]
+                        else:
+                            pair_known = (known[addresses[0]], known[addresses[1]])
+                            distance[pair] = matrix['distance'][pair_known]
+                            duration[pair] = matrix['duration'][pair_known]
+            self.matrix = matrix.extended(new_places, {'distance': distance, 'duration': duration})
+            return self.matrix
+
+
+_driving = SharedCostMatrix('driving')
+'''The SharedCostMatrix of every Route made by Driving.route().'''
 
-def _google_maps_leg_costs(mode, places):
+
+def _google_maps_costs(mode, addresses, known, cache=None, client=None):
     """
-    Looks up distances and durations on Google Maps.
+    Looks up distances and durations on Google Maps for every pair of addresses,
+    except the pairs of known addresses.
+    Only the pairs that are not in the cache are looked up.
     :param mode: A Google Maps mode, e.g. 'driving'.
-    :param places: An iterable of Places.
-    :return: A dict mapping each of 'duration' and 'distance' to
-     a frozendict mapping Place pairs to relevant values.
-    """
-    for waypoint in places:
-        assert isinstance(waypoint, Place)
-    distance = dict()
-    duration = dict()
-    # Call Google Maps API
-    response = _client_().distance_matrix(origins=[p.address for p in places],
-                                          destinations=[p.address for p in places],
-                                          mode=mode,
-                                          units='metric')
+    :param addresses: An iterable of addresses, e.g. ['Copenhagen, Denmark']
+    :param known: An iterable of addresses whose costs between each other are not needed.
+    :param cache: A LegCostCache, or None to use the default, see _cache_().
+    :param client: An object with a distance_matrix() method like googlemaps.Client,
+    or None to use the default, see _client_().
+    :return: A dict mapping (origin address, destination address) pairs to pairs (distance, duration).
+    """
+    if cache is None:
+        cache = _cache_()
+    known = set(known)
+    addresses = list(dict.fromkeys(chain(known, addresses)))
+    pairs = [(origin, destination) for origin in addresses for destination in addresses
+             if origin not in known or destination not in known]
+    costs = {} if cache is None else cache.get(mode, pairs)
+    # Group the origins by the destinations they miss, and look up each group in one call
+    missing = {}
+    for origin in addresses:
+        destinations = tuple(d for d in addresses
+                             if (origin not in known or d not in known) and (origin, d) not in costs)
+        if len(destinations) > 0:
+            missing.setdefault(destinations, []).append(origin)
+    fetched = {}
+    if len(missing) > 0:
+        blocks = [(origins, destinations) for destinations, origins in missing.items()]
+        fetched = _distance_matrix(client or _client_(), mode, blocks)
+    if cache is not None and len(fetched) > 0:
+        cache.put(mode, fetched)
+    costs.update(fetched)
+    return costs
+
+
+def _distance_matrix(client, mode, blocks, max_workers=MAX_WORKERS, backoff=BACKOFF):
+    """
+    Calls the Google Maps Distance Matrix API for blocks of origins and destinations.
+    Every block is split into tiles within the element limits of the API, see _tiles(),
+    and the tiles are requested concurrently by a pool of threads sharing the client,
+    and so its pool of HTTP connections.
+    :param client: An object with a distance_matrix() method like googlemaps.Client
+    :param mode: A Google Maps mode, e.g. 'driving'.
+    :param blocks: A list of pairs (origins, destinations), each a sequence of addresses.
+    :param max_workers: The maximal number of requests in flight.
+    :param backoff: The number of seconds to wait before the first retry, see _fetch_tile().
+    :return: A dict mapping every (origin, destination) pair in the blocks to a pair (distance, duration).
+    """
+    tiles = [tile for origins, destinations in blocks for tile in _tiles(origins, destinations)]
+    costs = {}
+    if len(tiles) <= 1 or max_workers <= 1:
+        for origins, destinations in tiles:
+            costs.update(_fetch_tile(client, mode, origins, destinations, backoff))
+        return costs
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tiles))) as pool:
+        futures = [pool.submit(_fetch_tile, client, mode, origins, destinations, backoff)
+                   for origins, destinations in tiles]
+        for future in futures:
+            costs.update(future.result())
+    return costs
+
+
+def _tiles(origins, destinations):
+    """
+    :param origins: A sequence of addresses.
+    :param destinations: A sequence of addresses.
+    :return: A list of pairs (origins, destinations) covering every pair of an origin
+    and a destination once, each within MAX_ORIGINS, MAX_DESTINATIONS and MAX_ELEMENTS.
+    """
+    width = min(len(destinations), MAX_DESTINATIONS, MAX_ELEMENTS)
+    height = min(MAX_ORIGINS, MAX_ELEMENTS // max(width, 1))
+    return [(tuple(origins[i:i + height]), tuple(destinations[j:j + width]))
+            for i in range(0, len(origins), height)
+            for j in range(0, len(destinations), width)]
+
+
+def _fetch_tile(client, mode, origins, destinations, backoff=BACKOFF):
+    """
+    Calls the Google Maps Distance Matrix API once, retrying up to MAX_ATTEMPTS times
+    with exponential backoff if the call fails in a way that may be temporary.
+    :param client: A googlemaps.Client, see _new_client()
+    :param mode: A Google Maps mode, e.g. 'driving'.
+    :param origins: A sequence of addresses.
+    :param destinations: A sequence of addresses.
+    :param backoff: The number of seconds to wait before the first retry. Doubles for every retry.
+    :return: A dict mapping every (origin, destination) pair to a pair (distance, duration).
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        last_attempt = attempt == MAX_ATTEMPTS - 1
+        try:
+            response = client.distance_matrix(origins=list(origins),
+                                              destinations=list(destinations),
+                                              mode=mode,
+                                              units='metric')
+            break
+        except googlemaps.exceptions.ApiError as e:  # The client raises on any status but OK
+            if e.status not in RETRIED_STATUSES or last_attempt:
+                raise
+        except googlemaps.exceptions.HTTPError:  # E.g. 403, will not go away
+            raise
+        except RETRIED_ERRORS:
+            if last_attempt:
+                raise
+        sleep(backoff * 2 ** attempt)
     # Verify and parse response
-    assert response['status'] == 'OK'
+    assert response['status'] == 'OK', response['status']
     rows = response['rows']
-    assert len(rows) == len(places)
-    # Populate the dicts distance and duration
-    for row, origin in zip(rows, places):
+    assert len(rows) == len(origins)
+    costs = {}
+    for row, origin in zip(rows, origins):
         row_elements = row['elements']  # There's also data about exact addresses used
-        assert len(row_elements) == len(places)
-        for element, destination in zip(row_elements, places):
+        assert len(row_elements) == len(destinations)
+        for element, destination in zip(row_elements, destinations):
             assert element['status'] == 'OK'
-            duration[(origin, destination)] = element['duration']['value']
-            distance[(origin, destination)] = element['distance']['value']
-    # Construct and return the dict
-    return {'distance': frozendict(distance), 'duration': frozendict(duration)}
+            costs[(origin, destination)] = (element['distance']['value'], element['duration']['value'])
+    return costs
@@ -1,8 +1,25 @@
 import inspect
-from pyrules2.expression import ConstantExpression, Expression, bind, IterableWrappingExpression, EMPTY
-from functools import partial
-from itertools import chain
-from collections import Iterable
+import re
+from pyrules2.expression import ConstantExpression, Expression, bind, IterableWrappingExpression, EMPTY, \
+    ReferenceExpression, OrExpression
+from pyrules2.scenario import Scenario, Relation
+from pyrules2.util import strongly_connected_components
+from pyrules2 import planner
+from pyrules2.budget import Budget, BudgetExceeded, QueryResult, COMPLETE, LIMIT, ERROR
+from functools import partial, lru_cache
+from itertools import chain, count
+from collections import Iterable, Mapping
+import multiprocessing
+import queue
+import threading
+import weakref
+import os
+import pickle
+import gzip
+import hashlib
+
+MIN_SHARD_SIZE = 1000
+'''In parallel mode, a call to a rule is split into shards when it has at least this many Scenarios.'''
 
 
 class Var(object):
@@ -29,6 +46,27 @@ def no(variable):
     return ConstantExpression({variable.variable_name: None})
 
 
+@lru_cache(maxsize=None)
+def _signature(rule_method):
+    """
+    :param rule_method: A Python function object, e.g. a @rule method.
+    :return: The inspect.Signature of rule_method. Cached, since rule methods
+    are called with new arguments all the time but never change.
+    """
+    return inspect.signature(rule_method)
+
+
+def _arg_names(rule_method):
+    """
+    :param rule_method: A Python function object that used to be the method
+     of a RuleBook instance.
+    :return: A list of the names of the arguments of rule_method, except 'self'.
+    """
+    arg_names = list(_signature(rule_method).parameters)
+    assert arg_names[0] == 'self'
+    return arg_names[1:]
+
+
 def _bind_args_to_rule(rule_method, args, expression):
     """
     Translates the call
@@ -43,7 +81,9 @@ def _bind_args_to_rule(rule_method, args, expression):
     :return: An Expression which adds equality constraints to expression
     and picks/renames variables from its scenarios.
     """
-    call_args = inspect.getcallargs(rule_method, None, *args)
+    bound_args = _signature(rule_method).bind(None, *args)
+    bound_args.apply_defaults()
+    call_args = dict(bound_args.arguments)
     assert call_args['self'] is None
     del call_args['self']
     const_bindings = {}
@@ -84,6 +124,89 @@ class VirtualMethod(object):
                                       self.expression)
 
 
+class ReferencingMethod(object):
+    def __init__(self, rule_name, rule_method, references):
+        """
+        Constructs a callable to replace the given method.
+        Like VirtualMethod, except that every call gets its own
+        ReferenceExpression to represent the body of the rule_method.
+        The ReferenceExpressions are appended to the given list, in call order,
+        so the caller can point each call at a different Expression later.
+        :param rule_name: The name of the rule_method, e.g. 'f'
+        :param rule_method: A @rule method from a RuleBook
+        :param references: A list to which (rule_name, ReferenceExpression)
+        pairs are appended.
+        """
+        self.rule_name = rule_name
+        self.rule_method = rule_method
+        self.references = references
+
+    def __call__(self, *args):
+        reference = ReferenceExpression(self.rule_name)
+        self.references.append((self.rule_name, reference))
+        return _bind_args_to_rule(self.rule_method, args, reference)
+
+    def __repr__(self):
+        return '{}({!r},{!r})'.format(self.__class__.__name__,
+                                      self.rule_name,
+                                      self.rule_method)
+
+
+class RulePlan(object):
+    """
+    The body of one rule, parsed once and for all.
+    Every call to a rule in the body is represented by a ReferenceExpression
+    (see ReferencingMethod), so the plan can be evaluated in any environment
+    by pointing the references at the Expressions for that environment,
+    without running the Python code of the rule again.
+    Note that binding a RulePlan changes it, so an Expression returned by bind()
+    is only valid until the next call to bind().
+    """
+    def __init__(self, expression, references):
+        """
+        :param expression: The Expression representing the body of the rule.
+        :param references: A list of (rule_name, ReferenceExpression) pairs,
+        one per call to a rule in the body, in the order of the calls.
+        """
+        assert isinstance(expression, Expression)
+        self.expression = expression
+        self.references = references
+        self._through = {}
+
+    def rule_names(self):
+        """
+        :return A frozenset of the names of the rules called from the body.
+        """
+        return frozenset(rule_name for rule_name, _ in self.references)
+
+    def bind(self, environment):
+        """
+        :param environment: A dict mapping from rule names to Expressions,
+        e.g. {'f': when(x=0)}. It must contain every rule called by the rule.
+        :return The Expression for the body, with every call replaced by the
+        Expression from the environment.
+        """
+        for rule_name, reference in self.references:
+            reference.set_expression(environment[rule_name])
+        return self.expression
+
+    def through(self, indexes):
+        """
+        :param indexes: A tuple of indexes into self.references
+        :return The Expression for the body restricted to derivations through one of the
+        indexed calls, see Expression.through(). Cached.
+        """
+        if indexes not in self._through:
+            references = set(self.references[index][1] for index in indexes)
+            self._through[indexes] = self.expression.through(references)
+        return self._through[indexes]
+
+    def __repr__(self):
+        return '{}({!r},{!r})'.format(self.__class__.__name__,
+                                      self.expression,
+                                      self.references)
+
+
 class RuleBookMethod(object):
     """
     A callable object used to replace rules in a RuleBook.
@@ -142,26 +265,76 @@ class Generation(object):
     https://en.wikipedia.org/wiki/Knaster%E2%80%93Tarski_theorem
 
     Each Generation instance maps every function name to a frozenset
-    of the Scenarios (i.e. outputs) found so far. Every iteration
+    of the Scenarios (i.e. outputs) found so far. The frozensets are Relations,
+    so calls with constant arguments and joins can probe hash indexes
+    instead of scanning. Every iteration
     will fill a new Generation instance.
+    Alongside the full frozensets, a Generation keeps the deltas, i.e.
+    for every function name the Scenarios that were not in the previous
+    Generation. These drive semi-naive evaluation, see RuleBook.parse_delta.
+    For every function name, a Generation also keeps the number of Scenarios
+    and a content hash (the sum of their hashes), which is updated from the delta.
+    As the iteration is monotone, a fixed point is reached when no size grew, see grew().
     """
     def __init__(self, keys):
         self.keys = frozenset(keys)
         self.frozensets = {}
+        self.deltas = {}
+        self.sizes = {}
+        self.hashes = {}
         self.fixed_point = False
+        self._expressions = {}
 
-    def set(self, key, expression):
+    def set(self, key, expression, previous=None):
         """
         Assigns a frozenset of Scenarios to one function name.
         Retrieves and stores all Scenarios generated by the given Expression.
         :param key: The function name to map, e.g. 'f'
         :param expression: An Expression that generates all the Scenarios
         for key in this Generation, e.g. when(x=0)
+        :param previous: The previous Generation, or None if this is the first.
+        The delta for key is computed relative to this.
+        """
+        assert isinstance(expression, Expression), '{!r} should have been an Expression'.format(expression)
+        assert key in self.keys
+        assert key not in self.frozensets
+        self.frozensets[key] = Relation(expression.scenarios())
+        if previous is None:
+            self.deltas[key] = self.frozensets[key]
+        else:
+            self.deltas[key] = Relation(self.frozensets[key].difference(previous.frozensets[key]))
+        self.sizes[key] = len(self.frozensets[key])
+        self.hashes[key] = _content_hash(self.frozensets[key])
+
+    def extend(self, key, expression, previous):
+        """
+        Assigns a frozenset of Scenarios to one function name by adding
+        new Scenarios to the ones found in the previous Generation.
+        :param key: The function name to map, e.g. 'f'
+        :param expression: An Expression that generates (at least) every Scenario
+        for key that was not in the previous Generation.
+        :param previous: The previous Generation.
         """
         assert isinstance(expression, Expression), '{!r} should have been an Expression'.format(expression)
         assert key in self.keys
         assert key not in self.frozensets
-        self.frozensets[key] = frozenset(expression.scenarios())
+        old_scenarios = previous.frozensets[key]
+        self.deltas[key] = Relation(frozenset(expression.scenarios()).difference(old_scenarios))
+        self.frozensets[key] = Relation(old_scenarios.union(self.deltas[key]))
+        self.sizes[key] = previous.sizes[key] + len(self.deltas[key])
+        self.hashes[key] = _content_hash(self.deltas[key], previous.hashes[key])
+
+    def grew(self, previous):
+        """
+        Compares the number of Scenarios for every function name, which takes
+        O(number of function names) rather than O(number of Scenarios) like ==.
+        :param previous: The previous Generation in a monotone iteration, i.e. every
+        frozenset in previous is a subset of the one in this Generation.
+        :return False if and only if this Generation equals previous.
+        """
+        assert self.is_full()
+        assert previous.is_full()
+        return self.sizes != previous.sizes
 
     def __eq__(self, other):
         """
@@ -171,6 +344,8 @@ class Generation(object):
         assert isinstance(other, Generation)
         assert self.is_full()
         assert other.is_full()
+        if self.sizes != other.sizes or self.hashes != other.hashes:
+            return False
         return self.frozensets == other.frozensets
 
     def get_expression(self, key):
@@ -180,7 +355,21 @@ class Generation(object):
         in this Generation.
         """
         assert key in self.frozensets
-        return IterableWrappingExpression(self.frozensets[key])
+        if ('full', key) not in self._expressions:
+            # Reusing the Expression lets the planner reuse its statistics, see pyrules2.planner
+            self._expressions[('full', key)] = IterableWrappingExpression(self.frozensets[key])
+        return self._expressions[('full', key)]
+
+    def get_delta_expression(self, key):
+        """
+        :param key: The name of a function, e.g. 'f'.
+        :return An Expression that generates the Scenarios for key
+        that are new in this Generation.
+        """
+        assert key in self.deltas
+        if ('delta', key) not in self._expressions:
+            self._expressions[('delta', key)] = IterableWrappingExpression(self.deltas[key])
+        return self._expressions[('delta', key)]
 
     def as_environment(self):
         """
@@ -193,16 +382,28 @@ class Generation(object):
         assert self.is_full()
         return {key: self.get_expression(key) for key in self.keys}
 
-    def fill(self, callback):
+    def fill(self, callback, previous=None):
         """
         Computes one
         :param callback: A one-argument callback mapping each function name
         to an Expression that generates Scenarios for that function.
         Example: lambda fname: when(x=0)
+        :param previous: The previous Generation, or None if this is the first.
+        """
+        for key in self.keys:
+            if key not in self.frozensets:
+                self.set(key, callback(key), previous)
+
+    def fill_delta(self, callback, previous):
+        """
+        Computes one step of semi-naive evaluation.
+        :param callback: A one-argument callback mapping each function name
+        to an Expression that generates the new Scenarios for that function.
+        :param previous: The previous Generation.
         """
         for key in self.keys:
             if key not in self.frozensets:
-                self.set(key, callback(key))
+                self.extend(key, callback(key), previous)
 
     def is_full(self):
         """
@@ -211,6 +412,37 @@ class Generation(object):
         """
         return self.keys == set(self.frozensets.keys())
 
+    def pack(self, previous=None):
+        """
+        :param previous: None, or the Generation this one was computed from.
+        :return: A compact representation of this full Generation, see unpack().
+        Given previous, only the deltas are kept.
+        """
+        assert self.is_full()
+        deltas = {key: self.deltas[key].pack() for key in self.keys}
+        if previous is not None:
+            return tuple(self.keys), deltas, None
+        return tuple(self.keys), deltas, {key: self.frozensets[key].pack() for key in self.keys}
+
+    @staticmethod
+    def unpack(packed, previous=None):
+        """
+        :param packed: A compact representation from pack().
+        :param previous: The Generation given to pack(), if any.
+        :return: A Generation equal to the one packed, with the same deltas.
+        """
+        keys, deltas, frozensets = packed
+        gen = Generation(keys)
+        for key in keys:
+            gen.deltas[key] = Relation.unpack(deltas[key])
+            if frozensets is None:
+                gen.frozensets[key] = Relation(previous.frozensets[key].union(gen.deltas[key]))
+            else:
+                gen.frozensets[key] = Relation.unpack(frozensets[key])
+            gen.sizes[key] = len(gen.frozensets[key])
+            gen.hashes[key] = _content_hash(gen.frozensets[key])
+        return gen
+
     def __repr__(self):
         fixed = 'fixedpoint!' if self.fixed_point else '(not known fixedpoint)'
         if self.is_full():
@@ -235,77 +467,748 @@ class DIYIterable(Iterable):
         return self.my_iter()
 
 
+class GenerationStore(dict):
+    """
+    Maps every stratum of a RuleBook to its list of Generations, see RuleBook.generations.
+    The lock must be held while Generations are added or replaced.
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+        _stores[id(self)] = self
+
+
+_stores = weakref.WeakValueDictionary()
+'''Every GenerationStore, so that their locks can be replaced in forked processes.'''
+
+_shared_stores = {}
+'''Maps RuleBook subclasses to the GenerationStore shared by their instances, see RuleBook.__init__.'''
+
+_shared_stores_lock = threading.Lock()
+
+
+def _after_fork_in_child():
+    """
+    A forked process only has the thread that forked it, so a lock held
+    by another thread at the time would never be released. Replace them all.
+    """
+    global _shared_stores_lock, _forked_rulebook_lock
+    _shared_stores_lock = threading.Lock()
+    _forked_rulebook_lock = threading.Lock()
+    for store in list(_stores.values()):
+        store.lock = threading.RLock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 class RuleBook(object, metaclass=RuleBookMeta):
     """
     A RuleBook combines a number of rules, i.e. methods decorated with @rule,
     and answers queries to these. When an instance of the RuleBook is
-    constructed, every @rule is parsed
+    constructed, every @rule is parsed once to find out which rules it calls.
+    The rules are then grouped into strata, i.e. strongly connected
+    components of the call graph, see
+    https://en.wikipedia.org/wiki/Strongly_connected_component
+    Each stratum is iterated to its own fixed point, after every stratum
+    it calls has reached its fixed point, and only when a query needs it.
+    Queries may run concurrently in several threads: Exactly one thread computes
+    the next Generation while the others wait for it, see GenerationStore, and
+    Generations are never modified once they have been added, so every query
+    reads consistent snapshots.
     """
 
-    def __init__(self):
+    def __init__(self, semi_naive=True, plan_joins=True, processes=None, min_shard_size=MIN_SHARD_SIZE,
+                 shared=False, checkpoint=None, strategy=None):
         """
-        Creates and stores the initial Generation of the fixed-point
-        iteration (see Generation above).
+        Builds the call graph and strata of the rules, then creates and stores
+        the initial Generation of the fixed-point iteration (see Generation above)
+        for each stratum.
+        :param semi_naive: If True, every step after the first only joins
+        recursive calls against the Scenarios that are new in the latest
+        Generation, see parse_delta. If False, every step re-derives
+        all Scenarios from the full latest Generation. The results are the same.
+        :param plan_joins: If True, rule bodies are rewritten before every step
+        to join in the order that gives the smallest intermediate results,
+        according to statistics for the Scenarios found so far, see pyrules2.planner.
+        :param processes: If more than 1, every step of the fixed-point iteration is split
+        into tasks, which are evaluated by this many forked worker processes, see _evaluate_in_parallel.
+        The workers are forked for the first step and reused until close() is called.
+        If None, every step is evaluated in this process.
+        :param min_shard_size: In parallel mode, the work for a rule is split further into shards
+        when one of its calls has at least this many Scenarios, see _tasks.
+        :param shared: If True, the Generations are shared with every other instance of the same
+        RuleBook subclass created with shared=True, in every thread. So only the first query
+        for a rule computes its fixed point, and processes forked later inherit it.
+        Facts cannot be inserted or retracted in a shared RuleBook.
+        :param checkpoint: None, or the path of a file written by save(). If it exists and was
+        saved for the same rules and constants, the saved Generations are loaded, see load().
+        :param strategy: None, a pyrules2.search.SearchStrategy, or a dict mapping rule names to
+        SearchStrategies. Decides the order in which a query yields the Scenarios found in each
+        Generation, e.g. best_first(lambda scenario: scenario['rt'].distance) yields the shortest
+        routes first. Within a Generation the Scenarios are already known, so the order is exact;
+        Scenarios found in a later Generation still come after them. If None, the Scenarios
+        are yielded in no particular order.
         """
+        self.semi_naive = semi_naive
+        self.plan_joins = plan_joins
+        self.processes = processes
+        self.min_shard_size = min_shard_size
+        self._workers = None
+        self.shared = shared
+        self.strategy = strategy
         self.rules = self.__class__.__original_rules__.copy()
-        gen0 = Generation(list(self.rules.keys()))
+        self.plans = {key: RulePlan(*self._references_for(key)) for key in self.rules}
+        self.dependencies = {key: self.plans[key].rule_names() for key in self.rules}
+        self.strata = [frozenset(component) for component in strongly_connected_components(self.dependencies)]
+        self.stratum_of = {key: stratum for stratum in self.strata for key in stratum}
+        self.inserted_facts = {key: set() for key in self.rules}
+        self.retracted_facts = {key: set() for key in self.rules}
+        self._original_facts = {}
+        if shared:
+            with _shared_stores_lock:
+                if self.__class__ not in _shared_stores:
+                    _shared_stores[self.__class__] = GenerationStore()
+                self.generations = _shared_stores[self.__class__]
+        else:
+            self.generations = GenerationStore()
+        with self.generations.lock:
+            for stratum in self.strata:
+                if stratum not in self.generations:
+                    self._reset(stratum)
+        if checkpoint is not None:
+            self.load(checkpoint)
+
+    def _reset(self, stratum):
+        """
+        Discards every Generation computed for the given stratum, so that
+        its fixed-point iteration starts over from an empty Generation.
+        :param stratum: One of self.strata
+        """
+        gen0 = Generation(stratum)
         gen0.fill(lambda key: EMPTY)
-        self.generations = [gen0]
+        self.generations[stratum] = [gen0]
+
+    def save(self, path):
+        """
+        Saves the latest Generation of every stratum, and whether it is a fixed point,
+        to a compressed file, so that a later RuleBook can continue from it, see load().
+        :param path: The path of the file to write. It is replaced atomically.
+        """
+        with self.generations.lock:
+            strata = {}
+            for stratum in self.strata:
+                generations = self.generations[stratum]
+                if len(generations) > 1:  # Otherwise, there is nothing to save
+                    gen = generations[-1]
+                    strata[_stratum_id(stratum)] = (gen.fixed_point,
+                                                    {key: gen.frozensets[key].pack() for key in stratum})
+            checkpoint = {'fingerprint': self.fingerprint(), 'strata': strata}
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with gzip.open(temporary_path, 'wb') as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+    def load(self, path):
+        """
+        Replaces the Generations of this RuleBook with the ones saved by save().
+        Strata that were at their fixed point when saved are answered without any iteration,
+        the others continue the iteration from the saved Generation.
+        Note that the file is unpickled, so it must come from a trusted source.
+        :param path: The path of a file written by save().
+        :return True if the file was loaded, False if it does not exist or was saved
+        for another fingerprint, see fingerprint().
+        """
+        if not os.path.exists(path):
+            return False
+        with gzip.open(path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if checkpoint['fingerprint'] != self.fingerprint():
+            return False
+        with self.generations.lock:
+            for stratum in self.strata:
+                if _stratum_id(stratum) not in checkpoint['strata']:
+                    continue
+                fixed_point, packed = checkpoint['strata'][_stratum_id(stratum)]
+                self._reset(stratum)
+                gen0 = self.generations[stratum][0]
+                gen = Generation(stratum)
+                gen.fill(lambda key: IterableWrappingExpression(Relation.unpack(packed[key])), gen0)
+                gen.fixed_point = fixed_point
+                self.generations[stratum].append(gen)
+        return True
+
+    def fingerprint(self):
+        """
+        :return A hex digest of what the Generations of this RuleBook depend on:
+        The source code of the rules, the values of the constants they use (class attributes
+        and module-level variables, see _constants_used()), and the facts inserted or retracted.
+        :raises AssertionError if a constant has no representation that is the same in every process,
+        see _stable_repr().
+        """
+        digest = hashlib.sha256()
+        for key in sorted(self.rules):
+            rule_method = self.rules[key]
+            try:
+                source = inspect.getsource(rule_method)
+            except (OSError, TypeError):
+                source = repr(rule_method.__code__.co_code)
+            digest.update('{}\n{}\n'.format(key, source).encode())
+            for name, value in _constants_used(self.__class__, rule_method):
+                digest.update('{}={}\n'.format(name, _stable_repr(value)).encode())
+        for facts in (self.inserted_facts, self.retracted_facts):
+            for key in sorted(facts):
+                rows = sorted(repr(sorted(scenario.as_dict().items(), key=repr)) for scenario in facts[key])
+                digest.update('{}:{!r}\n'.format(key, rows).encode())
+        return digest.hexdigest()
 
-    def expression_for(self, key):
+    def query(self, rule_name, *args, limit=None, timeout=None, max_scenarios=None, max_generations=None):
+        """
+        Like calling a rule, e.g. self.f(x), but stops early when a limit is reached,
+        and returns the answers found so far. Steps of the fixed-point iteration are
+        abandoned midway if needed, so no Generation is stored half-computed, and an
+        exception raised by a rule is returned rather than raised.
+        In parallel mode (see __init__), the Scenarios are counted after every step.
+        :param rule_name: The name of a rule in this RuleBook, e.g. 'f'.
+        :param args: The arguments for the rule, e.g. self.x
+        :param limit: None, or the number of answers wanted, e.g. 10
+        :param timeout: None, or the number of seconds the query may take, e.g. 2.5
+        :param max_scenarios: None, or the number of Scenarios the query may derive, see Budget.
+        :param max_generations: None, or the number of Generations the query may compute, see Budget.
+        :return A QueryResult with the answers found, and a status saying why the query stopped.
+        """
+        assert rule_name in self.rules
+        budget = Budget(timeout, max_scenarios, max_generations)
+        answers = []
+        try:
+            if limit is not None and limit <= 0:
+                return QueryResult(answers, LIMIT, budget)
+            expression = _bind_args_to_rule(self.rules[rule_name], args, self.expression_for(rule_name, budget))
+            for scenario in expression.scenarios():
+                answers.append(scenario.as_dict())
+                if limit is not None and len(answers) >= limit:
+                    return QueryResult(answers, LIMIT, budget)
+        except BudgetExceeded as e:
+            return QueryResult(answers, e.status, budget)
+        except Exception as e:  # E.g. a RecursionError from a badly written rule
+            return QueryResult(answers, ERROR, budget, error=e)
+        return QueryResult(answers, COMPLETE, budget)
+
+    def expression_for(self, key, budget=None):
         """
         Internal entry point for getting scenarios for a rule.
         The returned Expression will lazily evaluate steps in the
         fixed-point iteration, see Generation above.
         :param key: The name of a rule in this RuleBook, e.g. 'f'.
-        :return An Expression generating every Scenario for the given rule.
+        :param budget: None, or a Budget limiting the steps computed, see query().
+        :return An Expression generating every Scenario for the given rule, each exactly once.
         """
+        strategy = self.strategy.get(key) if isinstance(self.strategy, dict) else self.strategy
+
         # Define an __iter__ function that calls _expressions_for, extracts scenarios and chains these
         def get_scenario_iterator():
-            expression_iterator = self._expressions_for(key)
-            scenario_iterator = chain.from_iterable(map(lambda e: e.scenarios(), expression_iterator))
-            return scenario_iterator
+            expression_iterator = self._expressions_for(key, budget)
+            if strategy is None:
+                return chain.from_iterable(map(lambda e: e.scenarios(), expression_iterator))
+            return chain.from_iterable(map(lambda e: strategy.order(e.scenarios()), expression_iterator))
         # Make the __iter__ function into an Expression via an Iterable
         scenario_iterable = DIYIterable(get_scenario_iterator)
         return IterableWrappingExpression(scenario_iterable)
 
-    def _expressions_for(self, key):
+    def _expressions_for(self, key, budget=None):
         """
         :param key: The name of a rule in this RuleBook, e.g. 'f'.
-        :return A generator yielding Expressions. The sets Scenarios generated
-         by the Expressions will overlap. To get all Scenarios generated
+        :param budget: None, or a Budget limiting the steps computed, see query().
+        :return A generator yielding Expressions. The first generates the Scenarios
+         in the latest Generation, and each of the others generates the Scenarios
+         that are new in a later Generation. So the sets of Scenarios generated
+         by the Expressions do not overlap, and to get all Scenarios generated
          by a rule, you need to take every Scenario generated by one of the
          yielded Expressions.
         """
-        # First: Yield from the latest generation we have
-        current_gen = self.generations[-1]
+        stratum = self.stratum_of[key]
+        # First: Make sure every stratum called from this one has reached its fixed point
+        for lower_stratum in self._strata_below(stratum):
+            self._complete(lower_stratum, budget)
+        # Then: Yield from the latest generation we have
+        generations = self.generations[stratum]
+        current_gen = generations[-1]
         yield current_gen.get_expression(key)
         # Then: While we have not reached a fixed point
         while not current_gen.fixed_point:
             # Check if someone computed a new Generation
-            next_gen = self.generations[-1]
-            if next_gen == current_gen:
+            generations = self.generations[stratum]
+            next_gen = generations[-1]
+            if next_gen is current_gen:
                 # No? Then we have to compute one and try again
-                if not next_gen.fixed_point:
-                    self._add_generation()
-                    # Note: In the next loop, this new generation will turn up in the branch below
+                with self.generations.lock:
+                    # ...unless someone else did while we waited for the lock
+                    if self.generations[stratum][-1] is current_gen and not current_gen.fixed_point:
+                        self._add_generation(stratum, budget)
+                # Note: In the next loop, this new generation will turn up in the branch below
             else:
-                # Yes? Yield from that and try again
-                yield next_gen.get_expression(key)
+                # Yes? Yield what is new since the last one we yielded from, and try again
+                yield self._new_since(key, generations, current_gen)
                 current_gen = next_gen
 
-    def _add_generation(self):
+    @staticmethod
+    def _new_since(key, generations, gen):
+        """
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param generations: The list of Generations for the stratum of key.
+        :param gen: A Generation that is older than generations[-1]
+        :return An Expression generating the Scenarios for key that are in
+        generations[-1], but not in gen.
+        """
+        for index, old_gen in enumerate(generations):
+            if old_gen is gen:
+                # The union of the deltas since gen
+                later = generations[index + 1:]
+                if len(later) == 1:
+                    return later[0].get_delta_expression(key)
+                return OrExpression(*[later_gen.get_delta_expression(key) for later_gen in later])
+        # The Generations were replaced, e.g. by insert(), so compare the sets
+        return IterableWrappingExpression(generations[-1].frozensets[key].difference(gen.frozensets[key]))
+
+    def _strata_below(self, stratum):
+        """
+        :param stratum: One of self.strata
+        :return A list of the strata that the rules in the given stratum call,
+        directly or indirectly, in the order they must be computed.
+        """
+        reachable = set()
+        pending = [stratum]
+        while pending:
+            for key in pending.pop():
+                for callee in self.dependencies[key]:
+                    callee_stratum = self.stratum_of[callee]
+                    if callee_stratum != stratum and callee_stratum not in reachable:
+                        reachable.add(callee_stratum)
+                        pending.append(callee_stratum)
+        return [s for s in self.strata if s in reachable]
+
+    def _is_recursive(self, stratum):
+        """
+        :param stratum: One of self.strata
+        :return True if and only if some rule in the given stratum calls
+        a rule in the same stratum.
+        """
+        return any(not self.dependencies[key].isdisjoint(stratum) for key in stratum)
+
+    def _complete(self, stratum, budget=None):
+        """
+        Computes steps of the fixed-point iteration for the given stratum
+        until its fixed point is reached.
+        :param stratum: One of self.strata
+        :param budget: None, or a Budget limiting the steps computed, see query().
+        """
+        while not self.generations[stratum][-1].fixed_point:
+            with self.generations.lock:
+                if not self.generations[stratum][-1].fixed_point:
+                    self._add_generation(stratum, budget)
+
+    def _relations_below(self, stratum):
+        """
+        :param stratum: One of self.strata. Every stratum it calls must
+        have reached its fixed point.
+        :return A dict mapping every rule called from the given stratum,
+        except the rules in the stratum itself, to the frozenset of Scenarios in its fixed point.
+        """
+        relations = {}
+        for key in stratum:
+            for callee in self.dependencies[key].difference(stratum):
+                fixed_gen = self.generations[self.stratum_of[callee]][-1]
+                assert fixed_gen.fixed_point
+                relations[callee] = fixed_gen.frozensets[callee]
+        return relations
+
+    def _generations_below(self, stratum):
+        """
+        :param stratum: One of self.strata. Every stratum it calls must
+        have reached its fixed point.
+        :return A dict mapping every rule called from the given stratum,
+        except the rules in the stratum itself, to the Generation of its fixed point.
+        """
+        generations = {}
+        for key in stratum:
+            for callee in self.dependencies[key].difference(stratum):
+                fixed_gen = self.generations[self.stratum_of[callee]][-1]
+                assert fixed_gen.fixed_point
+                generations[callee] = fixed_gen
+        return generations
+
+    def _environment_below(self, stratum):
+        """
+        :param stratum: One of self.strata. Every stratum it calls must
+        have reached its fixed point.
+        :return A dict mapping every rule called from the given stratum,
+        except the rules in the stratum itself, to an Expression for its fixed point.
+        """
+        return {callee: gen.get_expression(callee) for callee, gen in self._generations_below(stratum).items()}
+
+    @staticmethod
+    def _step_environments(stratum, below, last_gen, previous_gen=None):
+        """
+        :param stratum: One of self.strata
+        :param below: A dict mapping rules called from the stratum to Generations, see _generations_below().
+        :param last_gen: The latest Generation of the stratum.
+        :param previous_gen: None for a naive step, otherwise the Generation before last_gen.
+        :return A triple (environment, old_environment, delta_environment) for the next step,
+        like the arguments of parse_delta(). The last two are None for a naive step.
+        """
+        environment = {callee: gen.get_expression(callee) for callee, gen in below.items()}
+        environment.update(last_gen.as_environment())
+        if previous_gen is None:
+            return environment, None, None
+        old_environment = {callee: gen.get_expression(callee) for callee, gen in below.items()}
+        old_environment.update(previous_gen.as_environment())
+        delta_environment = {key: last_gen.get_delta_expression(key)
+                             for key in stratum if len(last_gen.deltas[key]) > 0}
+        return environment, old_environment, delta_environment
+
+    @staticmethod
+    def _watched(expression, budget):
+        """
+        :param expression: An Expression deriving facts for the next Generation.
+        :param budget: None, or a Budget.
+        :return: The expression, or with a budget, an Expression counting every Scenario against it.
+        """
+        if budget is None:
+            return expression
+        return IterableWrappingExpression(budget.count(expression.scenarios()))
+
+    def _add_generation(self, stratum, budget=None):
         """
-        Computes one step of the fixed-point iteration and appends it
-        to self.generations.
+        Computes one step of the fixed-point iteration for the given stratum
+        and appends it to self.generations[stratum].
+        :param stratum: One of self.strata. Every stratum it calls must
+        have reached its fixed point. The caller must hold self.generations.lock.
+        :param budget: None, or a Budget. Every Scenario derived is counted against it,
+        and if it raises BudgetExceeded, nothing is appended.
         """
-        last_gen = self.generations[-1]
-        next_gen = Generation(list(self.rules.keys()))
-        next_gen.fill(lambda key: self.parse(key, last_gen.as_environment()))
-        if last_gen == next_gen:
+        if budget is not None:
+            budget.start_generation()
+        generations = self.generations[stratum]
+        last_gen = generations[-1]
+        previous_gen = generations[-2] if self.semi_naive and len(generations) > 1 else None
+        below = self._generations_below(stratum)
+        next_gen = Generation(stratum)
+        if self._parallel():
+            results = self._evaluate_in_parallel(stratum, below, last_gen, previous_gen)
+            if previous_gen is None:
+                next_gen.fill(lambda key: self._watched(IterableWrappingExpression(results[key]), budget), last_gen)
+            else:
+                next_gen.fill_delta(lambda key: self._watched(IterableWrappingExpression(results[key]), budget),
+                                    last_gen)
+        else:
+            environment, old_environment, delta_environment = \
+                self._step_environments(stratum, below, last_gen, previous_gen)
+            if previous_gen is None:
+                next_gen.fill(lambda key: self._watched(self._parse_step(key, environment), budget), last_gen)
+            else:
+                next_gen.fill_delta(lambda key: self._watched(self.parse_delta(key, environment, old_environment,
+                                                                               delta_environment),
+                                                              budget),
+                                    last_gen)
+        if not next_gen.grew(last_gen):
+            assert last_gen == next_gen
             last_gen.fixed_point = True
         else:
-            self.generations.append(next_gen)
+            generations.append(next_gen)
+            if not self._is_recursive(stratum):
+                # The rules only call lower strata, so one step is all it takes
+                next_gen.fixed_point = True
+
+    def _parallel(self):
+        """
+        :return True if steps should be evaluated by worker processes, see _evaluate_in_parallel.
+        """
+        return self.processes is not None and self.processes > 1 \
+            and 'fork' in multiprocessing.get_all_start_methods()
+
+    def _evaluate_in_parallel(self, stratum, below, last_gen, previous_gen=None):
+        """
+        Evaluates one step of the fixed-point iteration for the given stratum in self.processes
+        worker processes, see _Workers. The workers are forked once and then reused for every step,
+        and only the Generations they have not seen yet, tasks and results are sent between processes.
+        :param stratum: One of self.strata
+        :param below: Like for _step_environments().
+        :param last_gen: Like for _step_environments().
+        :param previous_gen: Like for _step_environments().
+        :return A dict mapping every rule name in stratum to the frozenset of Scenarios
+        that _parse_step() (or parse_delta() for a semi-naive step) would generate.
+        """
+        environment, _, delta_environment = self._step_environments(stratum, below, last_gen, previous_gen)
+        tasks = self._tasks(stratum, environment, delta_environment)
+        if self._workers is None:
+            self._workers = _Workers(self, self.processes)
+            self._workers_finalizer = weakref.finalize(self, self._workers.close)
+        # The Generations a worker needs, each with the one before it, which its deltas are relative to
+        generations = []
+        for needed_stratum in [self.stratum_of[callee] for callee in sorted(below)] + [stratum]:
+            gens = self.generations[needed_stratum]
+            if needed_stratum is stratum and previous_gen is not None:
+                generations.append((gens[-2], gens[-3] if len(gens) > 2 else None))
+            generations.append((gens[-1], gens[-2] if len(gens) > 1 else None))
+        task_results = self._workers.run(generations, below, last_gen, previous_gen, tasks)
+        results = {key: set() for key in stratum}
+        for (key, _, _), scenarios in zip(tasks, task_results):
+            results[key].update(scenarios)
+        return {key: frozenset(scenarios) for key, scenarios in results.items()}
+
+    def close(self):
+        """
+        Stops the worker processes of a RuleBook in parallel mode, see __init__. Does nothing otherwise.
+        They are also stopped when the RuleBook is garbage collected, and when Python exits.
+        The RuleBook can still be used, and forks new workers when it needs them.
+        """
+        if self._workers is not None:
+            self._workers_finalizer()
+            self._workers = None
+
+    def _tasks(self, stratum, environment, delta_environment=None):
+        """
+        Splits one step of the fixed-point iteration for the given stratum into independent tasks.
+        For a semi-naive step, there is one task per call to a rule with new Scenarios, see parse_delta().
+        For a naive step, there is one task per rule.
+        A task is further split into shards when a call has at least self.min_shard_size Scenarios:
+        Shard n of N only uses the Scenarios for that call with hash(scenario) % N == n,
+        so the shards derive disjoint sets of Scenarios from that call.
+        :param stratum: One of self.strata
+        :param environment: Like for _evaluate_in_parallel().
+        :param delta_environment: Like for _evaluate_in_parallel().
+        :return A list of tasks (key, delta_index, shard) where delta_index is None for a naive step,
+        and shard is None or a triple (reference_index, n, N), see _shard().
+        """
+        tasks = []
+        for key in sorted(stratum):
+            references = self.plans[key].references
+            if delta_environment is None:
+                sizes = [(_size(environment[rule_name]), index) for index, (rule_name, _) in enumerate(references)]
+                calls = [(None, max(sizes) if len(sizes) > 0 else (0, None))]
+            else:
+                calls = [(index, (_size(delta_environment[rule_name]), index))
+                         for index, (rule_name, _) in enumerate(references) if rule_name in delta_environment]
+            for delta_index, (size, reference_index) in calls:
+                if size < self.min_shard_size:
+                    tasks.append((key, delta_index, None))
+                else:
+                    tasks.extend((key, delta_index, (reference_index, n, self.processes))
+                                 for n in range(self.processes))
+        return tasks
+
+    def _shard(self, key, shard):
+        """
+        Replaces one call to a rule in the bound RulePlan for key by a shard of its Scenarios.
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param shard: None (do nothing) or a triple (reference_index, n, N), meaning that the call
+        self.plans[key].references[reference_index] will only generate the Scenarios s
+        with hash(s) % N == n.
+        """
+        if shard is None:
+            return
+        reference_index, n, count = shard
+        _, reference = self.plans[key].references[reference_index]
+        relation = Relation(scenario for scenario in reference.scenarios() if hash(scenario) % count == n)
+        reference.set_expression(IterableWrappingExpression(relation))
+
+    def _parse_step(self, key, environment, shard=None):
+        """
+        Like parse(), but uses the RulePlan for key instead of running the rule
+        method again, and takes facts inserted or retracted since the RuleBook
+        was constructed into account, see insert() and retract().
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param environment: A dict mapping from rule names to Expressions, like for parse().
+        :param shard: Restricts one call to a shard of its Scenarios, see _shard().
+        :return An Expression generating every Scenario for key in one step
+        of the fixed-point iteration.
+        """
+        plan = self.plans[key]
+        plan.bind(environment)
+        self._shard(key, shard)
+        if len(self.inserted_facts[key]) == 0 and len(self.retracted_facts[key]) == 0:
+            return self._planned(plan.expression)
+        # Every Scenario that needs a call to a rule, plus the current facts
+        derived = plan.through(tuple(range(len(plan.references))))
+        return OrExpression(IterableWrappingExpression(self.facts(key)), self._planned(derived))
+
+    def _planned(self, expression):
+        """
+        :param expression: An Expression from a bound RulePlan.
+        :return The Expression rewritten by pyrules2.planner.plan() if self.plan_joins is True,
+        otherwise the Expression itself.
+        """
+        return planner.plan(expression) if self.plan_joins else expression
+
+    def explain(self, key):
+        """
+        Describes how the body of a rule will be evaluated in the next step
+        of the fixed-point iteration, with estimated numbers of Scenarios.
+        Does not compute any steps.
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :return A string with one line per subexpression, see pyrules2.planner.explain().
+        """
+        with self.generations.lock:  # The plan is rebound
+            environment = {callee: self.generations[self.stratum_of[callee]][-1].get_expression(callee)
+                           for callee in self.dependencies[key]}
+            return planner.explain(self._planned(self.plans[key].bind(environment)))
+
+    def facts(self, key):
+        """
+        The facts of a rule are the Scenarios it generates without calling any rules,
+        i.e. from the when(...) constants in its body, with the changes made
+        by insert() and retract().
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :return A frozenset of Scenarios.
+        """
+        with self.generations.lock:  # The plan is rebound
+            if key not in self._original_facts:
+                nothing = {rule_name: EMPTY for rule_name in self.dependencies[key]}
+                self._original_facts[key] = frozenset(self.plans[key].bind(nothing).scenarios())
+            return self._original_facts[key].union(self.inserted_facts[key]).difference(self.retracted_facts[key])
+
+    def insert(self, key, **fact):
+        """
+        Adds a fact to a rule, as if the rule body had an extra when(**fact).
+        Fixed points computed so far are updated incrementally, see _maintain().
+        Example: drf.insert('sibling', x='MARY', y='ANNA')
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param fact: A value for every argument of the rule.
+        """
+        assert not self.shared, 'Facts cannot be inserted in a shared RuleBook'
+        scenario = self._fact_scenario(key, fact)
+        with self.generations.lock:
+            self.close()  # The worker processes know the old facts
+            old_facts = self.facts(key)
+            self.retracted_facts[key].discard(scenario)
+            if scenario not in self._original_facts[key]:
+                self.inserted_facts[key].add(scenario)
+            self._maintain({key: (old_facts, self.facts(key))})
+
+    def retract(self, key, **fact):
+        """
+        Removes a fact from a rule, as if a when(**fact) was removed from the rule body.
+        Scenarios that can still be derived by calling rules remain.
+        Fixed points computed so far are updated incrementally, see _maintain().
+        Example: drf.retract('spouse', x='FRED', y='MARY')
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param fact: A value for every argument of the rule. Must be one of the rule's facts.
+        """
+        assert not self.shared, 'Facts cannot be retracted in a shared RuleBook'
+        scenario = self._fact_scenario(key, fact)
+        with self.generations.lock:
+            self.close()  # The worker processes know the old facts
+            old_facts = self.facts(key)
+            assert scenario in old_facts, '{!r} is not a fact of {}'.format(fact, key)
+            self.inserted_facts[key].discard(scenario)
+            if scenario in self._original_facts[key]:
+                self.retracted_facts[key].add(scenario)
+            self._maintain({key: (old_facts, self.facts(key))})
+
+    def _fact_scenario(self, key, fact):
+        """
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param fact: A dict mapping every argument of the rule to a value.
+        :return The fact as a Scenario.
+        """
+        arg_names = _arg_names(self.rules[key])
+        assert set(fact.keys()) == set(arg_names), '{} takes arguments {!r}'.format(key, arg_names)
+        return Scenario(fact)
+
+    def _maintain(self, fact_changes):
+        """
+        Updates every computed fixed point after some rules changed their facts,
+        using the DRed algorithm, see _maintain_stratum().
+        Strata that have not reached their fixed point yet are reset, so they start over
+        with the new facts when a query needs them.
+        :param fact_changes: A dict mapping rule names to (old_facts, new_facts) pairs.
+        """
+        added = {}
+        removed = {}
+        for stratum in self.strata:
+            called = set().union(*[self.dependencies[key] for key in stratum])
+            if stratum.isdisjoint(fact_changes) and called.isdisjoint(added) and called.isdisjoint(removed):
+                continue  # Nothing this stratum depends on has changed
+            if not self.generations[stratum][-1].fixed_point:
+                self._reset(stratum)
+            else:
+                self._maintain_stratum(stratum, fact_changes, added, removed)
+
+    def _maintain_stratum(self, stratum, fact_changes, added, removed):
+        """
+        Updates the fixed point of one stratum, see
+        Gupta, Mumick & Subrahmanian: Maintaining views incrementally (1993).
+        In short:
+          1) Find every Scenario derived from a removed Scenario (overdelete),
+          2) keep those that can be derived from the remaining Scenarios (rederive), and
+          3) add everything derived from added Scenarios (semi-naive).
+        :param stratum: One of self.strata, at its fixed point.
+        The strata it calls must already be updated.
+        :param fact_changes: A dict mapping rule names to (old_facts, new_facts) pairs.
+        :param added: A dict mapping rule names from lower strata to the
+        Scenarios added to their fixed point. Will be updated for this stratum.
+        :param removed: Like added, but for removed Scenarios.
+        """
+        old_relations = {key: self.generations[stratum][-1].frozensets[key] for key in stratum}
+        new_below = self._relations_below(stratum)
+        old_below = {callee: scenarios.difference(added.get(callee, frozenset())).union(removed.get(callee, ()))
+                     for callee, scenarios in new_below.items()}
+        removed_facts = {key: frozenset() for key in stratum}
+        added_facts = {key: frozenset() for key in stratum}
+        for key in stratum.intersection(fact_changes):
+            old_facts, new_facts = fact_changes[key]
+            removed_facts[key] = old_facts.difference(new_facts)
+            added_facts[key] = new_facts.difference(old_facts)
+        # 1) Overdelete, starting from removed facts and removed Scenarios in lower strata
+        old_environment = _as_environment(dict(old_below, **old_relations))
+        overdeleted = {key: set() for key in stratum}
+        pending = {key: removed_facts[key].intersection(old_relations[key]) for key in stratum}
+        pending_below = {callee: removed[callee] for callee in new_below if callee in removed}
+        while any(len(scenarios) > 0 for scenarios in pending.values()) or len(pending_below) > 0:
+            for key in stratum:
+                overdeleted[key].update(pending[key])
+            delta_environment = _as_environment(dict(pending_below, **pending))
+            pending = {key: frozenset(self.parse_delta(key, old_environment, old_environment,
+                                                       delta_environment).scenarios())
+                       .intersection(old_relations[key]).difference(overdeleted[key])
+                       for key in stratum}
+            pending_below = {}
+        # 2) Rederive overdeleted Scenarios that still follow in one step from what remains
+        current = {key: old_relations[key].difference(overdeleted[key]) for key in stratum}
+        environment = _as_environment(dict(new_below, **current))
+        delta = {key: frozenset(self._parse_step(key, environment).scenarios()).intersection(overdeleted[key])
+                 if len(overdeleted[key]) > 0 else frozenset()
+                 for key in stratum}
+        # 3) Add new facts and everything derived from added Scenarios in lower strata
+        added_below = _as_environment({callee: added[callee] for callee in new_below if callee in added})
+        for key in stratum:
+            delta[key] = delta[key].union(added_facts[key])
+            if len(added_below) > 0:
+                delta[key] = delta[key].union(self.parse_delta(key, environment, environment,
+                                                               added_below).scenarios())
+            delta[key] = delta[key].difference(current[key])
+        # ...and iterate semi-naively until nothing new is found
+        while any(len(scenarios) > 0 for scenarios in delta.values()):
+            previous = current
+            current = {key: current[key].union(delta[key]) for key in stratum}
+            environment = _as_environment(dict(new_below, **current))
+            old_environment = _as_environment(dict(new_below, **previous))
+            delta_environment = _as_environment({key: delta[key] for key in stratum if len(delta[key]) > 0})
+            delta = {key: frozenset(self.parse_delta(key, environment, old_environment,
+                                                     delta_environment).scenarios()).difference(current[key])
+                     for key in stratum}
+        # Store the new fixed point and report the changes to the strata above
+        self._reset(stratum)
+        gen0 = self.generations[stratum][0]
+        fixed_gen = Generation(stratum)
+        fixed_gen.fill(lambda key: IterableWrappingExpression(current[key]), gen0)
+        fixed_gen.fixed_point = True
+        self.generations[stratum].append(fixed_gen)
+        for key in stratum:
+            if current[key] != old_relations[key]:
+                added[key] = current[key].difference(old_relations[key])
+                removed[key] = old_relations[key].difference(current[key])
 
     def parse(self, key, environment):
         """
@@ -319,19 +1222,93 @@ class RuleBook(object, metaclass=RuleBookMeta):
         iterations, see Generation above.
         :param key: The name of a rule in this RuleBook, e.g. 'f'.
         :param environment: A dict mapping from rule names to Expressions,
-        e.g. {'f': when(x=0)}
+        e.g. {'f': when(x=0)}. It must contain every rule called by the rule for key.
+        """
+        return self._call_rule(key, {rule_name: VirtualMethod(self.rules[rule_name],
+                                                              environment[rule_name])
+                                     for rule_name in environment})
+
+    def parse_delta(self, key, environment, old_environment, delta_environment):
         """
-        # Create a virtual "self" object to represent a RuleBook for the given environment
+        Parses the rule for key for one step of semi-naive evaluation, see
+        https://en.wikipedia.org/wiki/Datalog#Evaluation
+        Every Scenario derived by the rule in environment, but not in old_environment,
+        must use at least one Scenario from delta_environment.
+        So for each call to a rule in delta_environment from the body of the rule
+        for key, the returned Expression evaluates the derivations through that call
+        (see Expression.through) with the call replaced by the delta, earlier calls
+        replaced by old_environment and later calls replaced by environment.
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param environment: A dict mapping from rule names to Expressions for
+        the latest Scenarios, like for parse().
+        :param old_environment: Like environment, but for the Scenarios before the latest step.
+        :param delta_environment: A dict mapping from some rule names to Expressions for the
+        Scenarios that are in environment but not in old_environment. Rules that are not
+        in this dict have no new Scenarios.
+        :return An Expression generating every Scenario that the rule for key
+        generates in environment, but not in old_environment.
+        It may also generate some of the latter Scenarios.
+        """
+        def delta_scenarios():
+            for index, (delta_name, _) in enumerate(self.plans[key].references):
+                if delta_name not in delta_environment:
+                    continue  # Nothing new can come from this call
+                expression = self._parse_delta_at(key, index, environment, old_environment, delta_environment)
+                for scenario in expression.scenarios():
+                    yield scenario
+        return IterableWrappingExpression(DIYIterable(delta_scenarios))
+
+    def _parse_delta_at(self, key, index, environment, old_environment, delta_environment, shard=None):
+        """
+        Parses the derivations through one call in the rule for key, see parse_delta().
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param index: The index of the call in self.plans[key].references.
+        The rule called must be in delta_environment.
+        :param shard: Restricts one call to a shard of its Scenarios, see _shard().
+        :return An Expression generating the derivations through the call.
+        """
+        plan = self.plans[key]
+        for other_index, (rule_name, reference) in enumerate(plan.references):
+            if other_index < index:
+                reference.set_expression(old_environment[rule_name])
+            elif other_index == index:
+                reference.set_expression(delta_environment[rule_name])
+            else:
+                reference.set_expression(environment[rule_name])
+        self._shard(key, shard)
+        return self._planned(plan.through((index,)))
+
+    def _references_for(self, key):
+        """
+        Parses the rule for key, replacing every call to a rule with its own
+        ReferenceExpression.
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :return A pair (expression, references) where expression represents the body
+        of the rule, and references is a list of (rule_name, ReferenceExpression) pairs,
+        one per call, in the order of the calls.
+        """
+        references = []
+        expression = self._call_rule(key, {rule_name: ReferencingMethod(rule_name,
+                                                                        self.rules[rule_name],
+                                                                        references)
+                                           for rule_name in self.rules})
+        return expression, references
+
+    def _call_rule(self, key, methods):
+        """
+        Calls the rule method for key on a virtual "self" object,
+        passing a Var for every non-self argument.
+        :param key: The name of a rule in this RuleBook, e.g. 'f'.
+        :param methods: A dict mapping rule names to callables
+        that the body of the rule for key will see as methods on self.
+        :return The Expression returned by the rule method.
+        """
+        # Create a virtual "self" object to represent a RuleBook with the given methods
         virtual_self = self.__class__.__new__(self.__class__)
-        for rule_name in self.rules:
-            setattr(virtual_self,
-                    rule_name,
-                    VirtualMethod(self.rules[rule_name],
-                                  environment[rule_name]))
+        for rule_name, method in methods.items():
+            setattr(virtual_self, rule_name, method)
         # Create an abstract variable for each non-self argument required
-        arg_names = inspect.getargspec(self.rules[key]).args
-        assert arg_names[0] == 'self'
-        vars_for_non_self_args = [Var(arg) for arg in arg_names[1:]]
+        vars_for_non_self_args = [Var(arg) for arg in _arg_names(self.rules[key])]
         # Call the rule method with the constructed arguments and return its result
         return self.rules[key](virtual_self, *vars_for_non_self_args)
 
@@ -340,10 +1317,263 @@ class RuleBook(object, metaclass=RuleBookMeta):
         Print out info on the fixed-point computation for the given rule.
         :param key: The name of a rule in this RuleBook, e.g. 'f'.
         """
-        for i, gen in enumerate(self.generations):
+        for i, gen in enumerate(self.generations[self.stratum_of[key]]):
             print('{}@{}: {}'.format(key, i, set(gen.get_expression(key).scenarios())))
 
 
+def _content_hash(scenarios, start=0):
+    """
+    :param scenarios: An Iterable of Scenarios.
+    :param start: The content hash of other Scenarios to add these to.
+    :return The sum of the hashes of the Scenarios and start, modulo 2**64.
+    As the sum does not depend on the order, the content hash of a union of
+    disjoint sets can be computed from their content hashes.
+    """
+    return (start + sum(hash(scenario) for scenario in scenarios)) % 2**64
+
+
+class _Workers(object):
+    """
+    The worker processes evaluating the tasks of every parallel step of one RuleBook,
+    see RuleBook._evaluate_in_parallel(). They are forked once, so they share the rules
+    with the RuleBook (copy-on-write). Before every step, each worker is sent the Generations
+    it needs and has not been sent yet, through its own pipe, as deltas where it has the
+    Generation before. So the facts found are sent to each worker once, and a step with
+    few new Scenarios sends little. The tasks are then taken from a shared queue.
+    """
+    def __init__(self, rulebook, processes):
+        """
+        :param rulebook: The RuleBook to evaluate tasks for.
+        :param processes: The number of worker processes to fork.
+        """
+        global _forked_rulebook
+        context = multiprocessing.get_context('fork')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.pipes = []
+        self.processes = []
+        with _forked_rulebook_lock:  # Other RuleBooks may be forking workers in other threads
+            # Not an argument of the Process, which would keep the RuleBook from being garbage collected
+            _forked_rulebook = rulebook
+            try:
+                for _ in range(processes):
+                    reader, writer = context.Pipe(duplex=False)
+                    process = context.Process(target=_work, args=(reader, self.tasks, self.results), daemon=True)
+                    process.start()
+                    reader.close()
+                    self.pipes.append(writer)
+                    self.processes.append(process)
+            finally:
+                _forked_rulebook = None
+        self.shipped = {}  # Maps id(gen) to (serial, gen) for the Generations the workers keep
+        self.serials = count()
+
+    def run(self, generations, below, last_gen, previous_gen, tasks):
+        """
+        :param generations: A list of pairs (gen, previous) of every Generation needed for the step
+        and the Generation before it, or None. The previous Generations come first.
+        :param below: Like for RuleBook._step_environments().
+        :param last_gen: Like for RuleBook._step_environments().
+        :param previous_gen: Like for RuleBook._step_environments().
+        :param tasks: A list of tasks, see RuleBook._tasks().
+        :return A list with the frozenset of Scenarios generated for each task.
+        """
+        shipped = {}
+        packed = []
+        for gen, previous in generations:
+            if id(gen) in shipped:
+                continue
+            if id(gen) in self.shipped:
+                shipped[id(gen)] = self.shipped[id(gen)]
+                continue
+            serial = next(self.serials)
+            base = self.shipped.get(id(previous)) or shipped.get(id(previous))
+            if base is None:
+                packed.append((serial, None, gen.pack()))
+            else:
+                packed.append((serial, base[0], gen.pack(previous)))
+            shipped[id(gen)] = (serial, gen)
+        self.shipped = shipped
+        layout = ({callee: shipped[id(gen)][0] for callee, gen in below.items()},
+                  shipped[id(last_gen)][0],
+                  None if previous_gen is None else shipped[id(previous_gen)][0])
+        for pipe in self.pipes:  # Every worker is waiting for this before taking tasks
+            pipe.send((packed, layout))
+        for index, task in enumerate(tasks):
+            self.tasks.put((index, task))
+        for _ in self.processes:
+            self.tasks.put(None)  # End of step: Each worker takes one and waits for the next step
+        # Wait for every worker to finish the step, so none takes a task of the next step too early
+        results = [None] * len(tasks)
+        finished = 0
+        while finished < len(self.processes):
+            try:
+                message = self.results.get(timeout=1)
+            except queue.Empty:
+                assert all(process.is_alive() for process in self.processes), 'A worker process died'
+                continue
+            if message is None:
+                finished += 1
+            else:
+                index, result = message
+                results[index] = result
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        for pipe in self.pipes:
+            try:
+                pipe.send(None)
+                pipe.close()
+            except OSError:  # The worker is gone already
+                pass
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self.tasks.close()
+        self.results.close()
+
+
+_forked_rulebook = None
+'''While _Workers forks: The RuleBook that the worker processes are for.'''
+
+_forked_rulebook_lock = threading.Lock()
+
+
+def _work(pipe, tasks, results):
+    """
+    The loop of a worker process forked by _Workers.
+    :param pipe: The end of a pipe receiving the Generations and layout for each step, see _Workers.run()
+    :param tasks: The queue of tasks, see RuleBook._tasks(), with one None at the end of each step.
+    :param results: The queue for a pair (index, frozenset of Scenarios or exception) per task,
+    and a None at the end of each step.
+    """
+    rulebook = _forked_rulebook
+    generations = {}
+    while True:
+        message = pipe.recv()
+        if message is None:
+            return
+        packed, (below, last, previous) = message
+        for serial, base, packed_gen in packed:
+            generations[serial] = Generation.unpack(packed_gen, generations.get(base))
+        kept = set(below.values()).union([last, previous])
+        for serial in list(generations):
+            if serial not in kept:
+                del generations[serial]
+        last_gen = generations[last]
+        environment, old_environment, delta_environment = RuleBook._step_environments(
+            last_gen.keys, {callee: generations[serial] for callee, serial in below.items()},
+            last_gen, None if previous is None else generations[previous])
+        for index, task in iter(tasks.get, None):
+            key, delta_index, shard = task
+            try:
+                if delta_index is None:
+                    expression = rulebook._parse_step(key, environment, shard)
+                else:
+                    expression = rulebook._parse_delta_at(key, delta_index, environment, old_environment,
+                                                          delta_environment, shard)
+                results.put((index, frozenset(expression.scenarios())))
+            except Exception as e:  # Raised in the RuleBook's process instead
+                results.put((index, _picklable(e)))
+        results.put(None)
+
+
+def _picklable(exception):
+    """
+    :param exception: An exception raised in a worker process.
+    :return The exception if it can be pickled, otherwise a RuntimeError describing it.
+    """
+    try:
+        pickle.dumps(exception)
+        return exception
+    except Exception:
+        return RuntimeError(repr(exception))
+
+
+def _stratum_id(stratum):
+    """
+    :param stratum: A frozenset of rule names.
+    :return A sorted tuple of the rule names, which is the same in every process.
+    """
+    return tuple(sorted(stratum))
+
+
+def _stable_repr(value):
+    """
+    :param value: A constant used by a rule, see _constants_used().
+    :return A string representing the value, which is the same in every process for equal values.
+    A class can say what its instances depend on by defining a method fingerprint() returning
+    such a string, e.g. Route does. Otherwise, containers are represented by their items,
+    in sorted order for sets and Mappings, and anything else by its repr.
+    :raises AssertionError if the repr includes a memory address, which differs between processes.
+    """
+    fingerprint = getattr(type(value), 'fingerprint', None)  # Not value.fingerprint, which may be an attribute
+    if callable(fingerprint):
+        return fingerprint(value)
+    if isinstance(value, Mapping):
+        items = sorted('{}: {}'.format(_stable_repr(key), _stable_repr(item)) for key, item in value.items())
+        return '{}({{{}}})'.format(type(value).__name__, ', '.join(items))
+    if isinstance(value, (set, frozenset)):
+        return '{}({{{}}})'.format(type(value).__name__, ', '.join(sorted(_stable_repr(item) for item in value)))
+    if isinstance(value, (tuple, list)):
+        return '{}([{}])'.format(type(value).__name__, ', '.join(_stable_repr(item) for item in value))
+    text = repr(value)
+    assert re.search(r' at 0x[0-9a-fA-F]+', text) is None, \
+        '{} has no stable representation for checkpoints, define fingerprint() for it'.format(text)
+    return text
+
+
+def _constants_used(rule_book_class, rule_method):
+    """
+    :param rule_book_class: A subclass of RuleBook
+    :param rule_method: One of its rules.
+    :return A sorted list of (name, value) pairs for the names used in the rule method
+    (or functions defined in it) that refer to class attributes, module-level variables
+    or closure variables that are not callables or modules.
+    """
+    names = set()
+    pending = [rule_method.__code__]
+    while pending:
+        code = pending.pop()
+        names.update(code.co_names)
+        pending.extend(const for const in code.co_consts if inspect.iscode(const))
+    constants = {}
+    for name in names:
+        if hasattr(rule_book_class, name):
+            constants[name] = getattr(rule_book_class, name)
+        elif name in rule_method.__globals__:
+            constants[name] = rule_method.__globals__[name]
+    for name, cell in zip(rule_method.__code__.co_freevars, rule_method.__closure__ or ()):
+        constants[name] = cell.cell_contents
+    return sorted((name, value) for name, value in constants.items()
+                  if not callable(value) and not inspect.ismodule(value))
+
+
+def _size(expression):
+    """
+    :param expression: An Expression from an environment.
+    :return The number of Scenarios it generates, or 0 if it is not a Relation.
+    """
+    relation = expression.relation()
+    return 0 if relation is None else len(relation)
+
+
+def _as_environment(relations):
+    """
+    :param relations: A dict mapping rule names to Iterables of Scenarios.
+    :return A dict mapping the same rule names to Expressions generating the Scenarios.
+    """
+    return {key: IterableWrappingExpression(scenarios if isinstance(scenarios, Relation) else Relation(scenarios))
+            for key, scenarios in relations.items()}
+
+
 def rule(func):
     """
     Example usage:
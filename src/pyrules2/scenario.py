@@ -1,23 +1,134 @@
+from collections import Mapping
+
 __author__ = 'nhc'
 
 
-class Scenario(frozenset):
+class Schema(object):
     """
-    A Scenario is essentially a frozendict, see http://stackoverflow.com/a/9997296/1095455
-    It is an immutable and hashable dict.
-    TODO: Make into a collections.Mapping, see
-    http://stackoverflow.com/questions/3387691/python-how-to-perfectly-override-a-dict
-    http://stackoverflow.com/questions/3385269/how-to-wrap-a-python-dict
+    The keys of a Scenario, in a fixed order.
+    Schemas are interned, see Schema.of(), so there is only one Schema
+    for each set of keys and all Scenarios with the same keys share it.
+    Schemas can then be compared and hashed by identity.
+    When s is a Schema,
+      - s.keys is a tuple of keys, e.g. ('a', 'b')
+      - s.key_set is a frozenset of the same keys
+      - s.positions is a dict mapping each key to its index in s.keys
     """
-    def __new__(cls, d):
+    __slots__ = ('keys', 'key_set', 'positions', '_unions')
+
+    _interned = {}
+
+    def __init__(self, keys):
+        """
+        Do not call this directly, use Schema.of()
+        :param keys: A tuple of distinct keys.
+        """
+        self.keys = keys
+        self.key_set = frozenset(keys)
+        self.positions = {key: index for index, key in enumerate(keys)}
+        self._unions = {}
+
+    @staticmethod
+    def of(keys):
+        """
+        :param keys: An iterable of distinct, hashable keys, e.g. ['a', 'b']
+        :return: The interned Schema for the set of keys.
+        """
+        keys = tuple(keys)
+        key_set = frozenset(keys)
+        schema = Schema._interned.get(key_set)
+        if schema is None:
+            schema = Schema._interned.setdefault(key_set, Schema(keys))
+        return schema
+
+    def union(self, other):
+        """
+        Prepares the union of Scenarios with this and another Schema, see Scenario.unite().
+        :param other: A Schema
+        :return: A triple (schema, sources, checks). schema is the Schema of the union.
+        sources has one (0, index) or (1, index) pair per key of schema, saying whether the value
+        comes from values[index] of a Scenario with this Schema or the other.
+        checks has one (index, other_index) pair per shared key. Cached.
+        """
+        if other not in self._unions:
+            keys = self.keys + tuple(key for key in other.keys if key not in self.positions)
+            schema = Schema.of(keys)
+            sources = tuple((0, self.positions[key]) if key in self.positions else (1, other.positions[key])
+                            for key in schema.keys)
+            checks = tuple((self.positions[key], other.positions[key])
+                           for key in other.keys if key in self.positions)
+            self._unions[other] = (schema, sources, checks)
+        return self._unions[other]
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.keys)
+
+
+class Scenario(Mapping):
+    """
+    A Scenario is an immutable and hashable dict.
+    To save memory, it is stored as a shared, interned Schema plus a tuple of values
+    in the same order, and its hash is computed once, when first needed.
+    When s is a Scenario,
+      - s.schema is the Schema of its keys, e.g. Schema(('a', 'b'))
+      - s.values is a tuple of its values, e.g. (0, 1)
+    """
+    __slots__ = ('schema', 'values', '_hash')
+
+    def __init__(self, d):
         """
-        Creates a frozenset of d.items()
-        :param cls: This class
         :param d: A dict with immutable, hashable values. Example: {'a': 'b'}
-        :return: The created frozenset
         """
         assert isinstance(d, dict)
-        return super(Scenario, cls).__new__(cls, list(d.items()))
+        self.schema = Schema.of(d)
+        self.values = tuple(d[key] for key in self.schema.keys)
+        self._hash = None
+
+    @staticmethod
+    def from_values(schema, values):
+        """
+        Creates a Scenario without going through a dict.
+        :param schema: A Schema, e.g. Schema.of(['a', 'b'])
+        :param values: A tuple of values, one per key in schema, e.g. (0, 1)
+        :return: The created Scenario.
+        """
+        scenario = Scenario.__new__(Scenario)
+        scenario.schema = schema
+        scenario.values = values
+        scenario._hash = None
+        return scenario
+
+    def __getitem__(self, key):
+        return self.values[self.schema.positions[key]]
+
+    def __iter__(self):
+        return iter(self.schema.keys)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.schema.positions
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.schema, self.values))
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, Scenario):
+            return self.schema is other.schema and self.values == other.values
+        return Mapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        # Schemas are interned per process, so pickle as a dict
+        return Scenario, (self.as_dict(),)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.as_dict())
 
     def get_only_item(self):
         """
@@ -26,8 +137,21 @@ class Scenario(frozenset):
         :raises AssertionError if len(self) != 1
         """
         assert len(self) == 1
-        for item in self:
-            return item
+        return self.schema.keys[0], self.values[0]
+
+    def key_set(self):
+        """
+        :return: A frozenset of the keys in this Scenario, e.g. frozenset(['a'])
+        """
+        return self.schema.key_set
+
+    def project(self, keys):
+        """
+        :param keys: A sequence of keys in this Scenario, e.g. ('a', 'b')
+        :return: A tuple of the values for the given keys, in the same order.
+        """
+        positions = self.schema.positions
+        return tuple(self.values[positions[key]] for key in keys)
 
     def as_dict(self):
         """
@@ -35,13 +159,12 @@ class Scenario(frozenset):
         :return: A dict equal to the one used to create this Scenario,
         e.g. {'a': 'b'}
         """
-        return dict(self)
+        return dict(zip(self.schema.keys, self.values))
 
     @staticmethod
     def unite(scenarios):
         """
         Computes the union of Scenarios.
-        Note: Should not be named union() because this would shadow frozenset.union
         :param scenarios A tuple or list of Scenarios
         :return The union of the Scenarios
         :raises AssertionError if two Scenarios defined different values for
@@ -49,9 +172,110 @@ class Scenario(frozenset):
         """
         assert len(scenarios) > 0
         assert all([isinstance(s, Scenario) for s in scenarios])
-        if len(scenarios) == 1:
-            return scenarios[0]
-        result_as_set = scenarios[0].union(*scenarios[1:])
-        keys = set((key for key, value in result_as_set))
-        assert len(keys) == len(result_as_set)
-        return Scenario(dict(result_as_set))
+        result = scenarios[0]
+        for scenario in scenarios[1:]:
+            schema, sources, checks = result.schema.union(scenario.schema)
+            for index, other_index in checks:
+                assert result.values[index] == scenario.values[other_index]
+            both = (result.values, scenario.values)
+            result = Scenario.from_values(schema, tuple(both[side][index] for side, index in sources))
+        return result
+
+
+class Relation(frozenset):
+    """
+    A frozenset of Scenarios that can find the Scenarios compatible with a given one
+    without a full scan, see compatible().
+    The Scenarios are grouped by Schema, and each group gets a hash index on
+    the keys it shares with the Scenarios looked up. Indexes are built when first
+    needed and kept, so every later lookup with the same keys reuses them.
+    """
+    __slots__ = ('_groups', '_indexes', '_plans')
+
+    def __init__(self, scenarios=()):
+        """
+        :param scenarios: An Iterable of Scenarios, e.g. [Scenario({'x': 42})]
+        """
+        self._groups = None
+        self._indexes = {}
+        self._plans = {}
+
+    def compatible(self, scenario):
+        """
+        :param scenario: A Scenario, e.g. Scenario({'x': 0})
+        :return: A generator yielding every Scenario in this Relation which agrees
+        with the given one on every key they share, e.g. Scenario({'x': 0, 'y': 1})
+        and Scenario({'y': 2}), but not Scenario({'x': 1, 'y': 1}).
+        """
+        values = scenario.values
+        for positions, index in self._plan(scenario.schema):
+            if positions is None:  # No shared keys
+                for other in index:
+                    yield other
+            else:
+                for other in index.get(tuple(values[position] for position in positions), ()):
+                    yield other
+
+    def _plan(self, schema):
+        """
+        :param schema: The Schema of Scenarios to look up.
+        :return: A list with one pair per group of Scenarios in this Relation.
+        The pair is (positions, index), where index maps the values for the shared keys to
+        Scenarios in the group, and positions are the indexes of these keys in Scenarios with
+        the given Schema. When no keys are shared, the pair is (None, group). Cached.
+        """
+        # Every structure is complete before it is stored, so threads can share the Relation
+        if schema not in self._plans:
+            if self._groups is None:
+                groups = {}
+                for scenario in self:
+                    groups.setdefault(scenario.schema, []).append(scenario)
+                self._groups = groups
+            plan = []
+            for group_schema, group in self._groups.items():
+                shared_keys = tuple(key for key in group_schema.keys if key in schema.positions)
+                if len(shared_keys) == 0:
+                    plan.append((None, group))
+                    continue
+                if (group_schema, shared_keys) not in self._indexes:
+                    index = {}
+                    for scenario in group:
+                        index.setdefault(scenario.project(shared_keys), []).append(scenario)
+                    self._indexes[(group_schema, shared_keys)] = index
+                plan.append((tuple(schema.positions[key] for key in shared_keys),
+                             self._indexes[(group_schema, shared_keys)]))
+            self._plans[schema] = plan
+        return self._plans[schema]
+
+    def pack(self):
+        """
+        :return: A compact representation of this Relation for storage, see unpack().
+        It is a list with one pair (keys, rows) per Schema, where keys is a tuple of keys,
+        and rows is a list with a tuple of values for each Scenario with these keys.
+        Example: [(('x', 'y'), [(0, 1), (1, 2)])]
+        """
+        groups = {}
+        for scenario in self:
+            groups.setdefault(scenario.schema, []).append(scenario.values)
+        return [(schema.keys, rows) for schema, rows in groups.items()]
+
+    @staticmethod
+    def unpack(packed):
+        """
+        :param packed: A compact representation from pack().
+        :return: The Relation that was packed.
+        """
+        scenarios = []
+        for keys, rows in packed:
+            schema = Schema.of(keys)
+            if schema.keys == tuple(keys):
+                scenarios.extend(Scenario.from_values(schema, tuple(row)) for row in rows)
+            else:  # The Schema was interned with the keys in another order
+                order = [keys.index(key) for key in schema.keys]
+                scenarios.extend(Scenario.from_values(schema, tuple(row[index] for index in order))
+                                 for row in rows)
+        return Relation(scenarios)
+
+    def __reduce__(self):
+        # Indexes are cheap to rebuild, so do not pickle them
+        return Relation, (list(self),)
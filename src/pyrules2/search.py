@@ -0,0 +1,108 @@
+from heapq import heappush, heappop
+from itertools import chain, count
+from pyrules2.util import round_robin
+
+__author__ = 'nhc'
+
+
+class SearchStrategy(object):
+    """
+    Abstract superclass of search strategies. A search strategy decides the order
+    in which alternatives are explored, e.g. the Scenarios from the subexpressions
+    of an OrExpression, or the Scenarios found in one step of a RuleBook's
+    fixed-point iteration.
+    """
+    def merge(self, iterables, key=None):
+        """
+        Must be overridden by all subclasses.
+        :param iterables: A list of Iterables of alternatives. Each may be infinite.
+        :param key: None, or a function mapping each value from the iterables to the
+        alternative it represents, e.g. lambda pair: pair[1]
+        :return: An iterator yielding every value from every Iterable.
+        """
+        raise NotImplementedError()
+
+    def order(self, values, key=None):
+        """
+        :param values: A finite Iterable of alternatives.
+        :param key: Like for merge()
+        :return: An iterator yielding every value.
+        """
+        return iter(values)
+
+
+class RoundRobin(SearchStrategy):
+    """
+    Takes one value from each Iterable in turn, which is fair, so every value
+    from an infinite Iterable is reached eventually. This is the default.
+    """
+    def merge(self, iterables, key=None):
+        return round_robin(*iterables)
+
+    def __repr__(self):
+        return 'ROUND_ROBIN'
+
+
+class DepthFirst(SearchStrategy):
+    """
+    Takes every value from the first Iterable before moving on to the next.
+    Never reaches the later Iterables if one is infinite.
+    """
+    def merge(self, iterables, key=None):
+        return chain.from_iterable(iterables)
+
+    def __repr__(self):
+        return 'DEPTH_FIRST'
+
+
+class BestFirst(SearchStrategy):
+    """
+    Orders alternatives by a score, lowest first.
+    """
+    def __init__(self, score):
+        """
+        :param score: A function mapping an alternative to a comparable value,
+        e.g. lambda scenario: scenario['rt'].distance
+        """
+        assert callable(score)
+        self.score = score
+
+    def merge(self, iterables, key=None):
+        """
+        Keeps the next value from every Iterable in a heap, and yields the one with the
+        lowest score. So if every Iterable yields values in order of their scores,
+        the merged values are in order too.
+        """
+        score = self.score if key is None else lambda value: self.score(key(value))
+        heap = []
+        serial_numbers = count()  # Breaks ties, so values are never compared
+        for iterator in map(iter, iterables):
+            for value in iterator:
+                heappush(heap, (score(value), next(serial_numbers), value, iterator))
+                break
+        while heap:
+            _, _, value, iterator = heappop(heap)
+            yield value
+            for next_value in iterator:
+                heappush(heap, (score(next_value), next(serial_numbers), next_value, iterator))
+                break
+
+    def order(self, values, key=None):
+        score = self.score if key is None else lambda value: self.score(key(value))
+        return iter(sorted(values, key=score))
+
+    def __repr__(self):
+        return 'best_first({!r})'.format(self.score)
+
+
+ROUND_ROBIN = RoundRobin()
+DEPTH_FIRST = DepthFirst()
+
+
+def best_first(score):
+    """
+    :param score: A function mapping an alternative to a comparable value,
+    e.g. lambda scenario: scenario['rt'].distance
+    :return: A SearchStrategy exploring the alternatives with the lowest score first.
+    """
+    return BestFirst(score)
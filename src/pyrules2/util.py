@@ -1,5 +1,7 @@
 from collections import deque
 from itertools import repeat, count, product
+from collections import Sized, Iterator
+from operator import itemgetter
 
 __author__ = 'nhc'
 
@@ -19,32 +21,42 @@ def round_robin(*iterables):
             pop()
 
 
-def _enumerated_fair_iterator(iterators):
+def _enumerated_fair_iterator(iterators, strategy=None):
     """
     Combines iterators into one. Example: with input [['a','b'], ['x','y']]
     the returned iterator is equivalent to
     [(1, (0, 'a')), (2, (1, 'x')), (3, (0, 'b')), (4, (1, 'y'))]
     Each original value is paired with the index of the iterator it came from.
     Each pair is annotated with a serial number independent which generator it came from.
-    The iterators are polled using round_robin above.
+    The iterators are polled using round_robin above, or the given strategy.
     :param iterators: Any number of iterators, finite or infinite.
+    :param strategy: None, or a pyrules2.search.SearchStrategy deciding which iterator to poll next.
     :return: The combined iterator.
     """
     indexed_iterators = [zip(repeat(index), g) for index, g in enumerate(iterators)]
-    fair_iterators = round_robin(*indexed_iterators)
+    if strategy is None:
+        fair_iterators = round_robin(*indexed_iterators)
+    else:
+        fair_iterators = strategy.merge(indexed_iterators, key=itemgetter(1))
     enumerated_fair_iterators = zip(count(1), fair_iterators)
     return enumerated_fair_iterators
 
 
-def lazy_product(*iterators):
+def lazy_product(*iterators, strategy=None):
     """
     Akin to itertools.product except
         - works with infinite iterators
         - does not order the generated tuples in the same way
-        - requires every value to be hashable
+        - requires every value from an unbounded input to be hashable
+    An input that is Sized but not an Iterator, e.g. a list or a frozenset, is finite and
+    already materialized, so its values are neither cached nor hashed.
+    If every input is like that, the tuples are streamed by itertools.product.
     For finite iterators, the following should hold:
         set(itertools.product(*iterators)) == set(lazy_product(*iterators))
-    :param iterators: Any number of iterators
+    :param iterators: Any number of iterators or materialized collections
+    :param strategy: None, or a pyrules2.search.SearchStrategy deciding the order in which
+    values are taken from the unbounded iterators. If None, they are taken fairly by round_robin.
+    Note that only round_robin detects an empty iterator next to an infinite one.
     :return: One generator that yields tuples. Each tuple contains
     one value from each of the input iterators.
     """
@@ -52,21 +64,78 @@ def lazy_product(*iterators):
     if tuple_size == 0:  # Special case: Just yield the empty tuple
         yield ()
         return
-    # General case: Keep a cache of every seen value, per iterator
-    cache = [set() for _ in range(tuple_size)]
-    # For each new value from one of the iterators...
-    for counter, (index, value) in _enumerated_fair_iterator(iterators):
-        # Add it to the cache
-        seen_before = value in cache[index]
-        cache[index].add(value)
-        # If every iterator has been polled once and one was empty: Return
-        if counter == tuple_size:
-            if any([len(l) == 0 for l in cache]):
+    materialized = [isinstance(i, Sized) and not isinstance(i, Iterator) for i in iterators]
+    if all(materialized):  # Fast path: Nothing to cache
+        for t in product(*iterators):
+            yield t
+        return
+    # General case: The values to combine, per input. For materialized inputs, every value
+    # as a tuple (which product() does not copy), otherwise a list of every value seen so far
+    values = [tuple(i) if is_materialized else [] for i, is_materialized in zip(iterators, materialized)]
+    if any(len(v) == 0 for v, is_materialized in zip(values, materialized) if is_materialized):
+        return  # Some input is empty
+    unbounded = [index for index in range(tuple_size) if not materialized[index]]
+    seen = [set() for _ in range(tuple_size)]
+    unbounded_iterators = [iterators[index] for index in unbounded]
+    # For each new value from one of the unbounded iterators...
+    for counter, (position, value) in _enumerated_fair_iterator(unbounded_iterators, strategy):
+        index = unbounded[position]
+        # If every iterator has been polled once and one was empty: Return.
+        # Only round_robin guarantees that, other strategies may poll one iterator for ever
+        if counter == len(unbounded) and strategy is None:
+            if any([len(values[i]) == 0 for i in unbounded if i != index]):
                 return  # Some generator did not deliver a value
-        # If every iterator has provided at least one value and this one was new:
-        if counter >= tuple_size and not seen_before:
-            # Generate every tuple possible using the new value
-            x = list(cache)
-            x[index] = [value]
-            for t in product(*x):
-                yield t
+        if value in seen[index]:
+            continue
+        seen[index].add(value)
+        # Generate every tuple possible using the new value, none while another input has no values yet
+        seen_values = values[index]
+        values[index] = (value,)
+        for t in product(*values):
+            yield t
+        values[index] = seen_values
+        values[index].append(value)
+
+
+def strongly_connected_components(graph):
+    """
+    Finds the strongly connected components of a directed graph using
+    Tarjan's algorithm, see
+    https://en.wikipedia.org/wiki/Tarjan%27s_strongly_connected_components_algorithm
+    Example: {'a': ['b'], 'b': ['a'], 'c': ['a']} has the components
+    {'a', 'b'} and {'c'}.
+    :param graph: A dict mapping every node to an iterable of the nodes it has edges to.
+    Every such node must also be a key in the dict.
+    :return: A list of sets of nodes. Every component comes after
+    all the components it has edges to.
+    """
+    index_of = {}
+    low_link = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    def visit(node):
+        index_of[node] = low_link[node] = len(index_of)
+        stack.append(node)
+        on_stack.add(node)
+        for successor in graph[node]:
+            if successor not in index_of:
+                visit(successor)
+                low_link[node] = min(low_link[node], low_link[successor])
+            elif successor in on_stack:
+                low_link[node] = min(low_link[node], index_of[successor])
+        if low_link[node] == index_of[node]:
+            component = set()
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.add(member)
+                if member == node:
+                    break
+            components.append(component)
+
+    for node in sorted(graph):
+        if node not in index_of:
+            visit(node)
+    return components
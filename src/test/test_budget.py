@@ -0,0 +1,92 @@
+import unittest
+from pyrules2 import RuleBook, rule, when, anything
+from pyrules2.budget import Budget, BudgetExceeded, COMPLETE, LIMIT, TIMEOUT, MAX_SCENARIOS, MAX_GENERATIONS, \
+    ERROR
+
+increment = when(f=lambda n: n + 1)
+doubles = when(f=lambda n: (m for m in [2 * n, 2 * n + 1]))
+
+
+class Numbers(RuleBook):
+    @rule
+    def small(self, n=anything):
+        return when(n=0) | when(n=1) | when(n=2)
+
+    @rule
+    def natural(self, n=anything):
+        # Never reaches a fixed point
+        return when(n=0) | increment(self.natural(n))
+
+    @rule
+    def tree(self, n=anything):
+        # Doubles in size with every step
+        return when(n=1) | doubles(self.tree(n))
+
+    @rule
+    def broken(self, n=anything):
+        return when(f=lambda n: 1 // (n - 2))(self.small(n))
+
+
+class Test(unittest.TestCase):
+    def test_budget(self):
+        b = Budget(max_scenarios=2, max_generations=1)
+        b.start_generation()
+        self.assertRaises(BudgetExceeded, b.start_generation)
+        self.assertListEqual([0, 1], list(b.count([0, 1])))
+        with self.assertRaises(BudgetExceeded) as context:
+            list(b.count([2]))
+        self.assertEqual(MAX_SCENARIOS, context.exception.status)
+        with self.assertRaises(BudgetExceeded) as context:
+            list(Budget(timeout=0).count([0]))
+        self.assertEqual(TIMEOUT, context.exception.status)
+
+    def test_complete(self):
+        result = Numbers().query('small')
+        self.assertEqual(COMPLETE, result.status)
+        self.assertTrue(result.is_complete())
+        self.assertSetEqual({0, 1, 2}, {d['n'] for d in result})
+        # Like a call to the rule
+        self.assertEqual(list(Numbers().small(1)), Numbers().query('small', 1).answers)
+
+    def test_limit(self):
+        result = Numbers().query('natural', limit=5)
+        self.assertEqual(LIMIT, result.status)
+        self.assertEqual(5, len(result))
+        self.assertEqual(COMPLETE, Numbers().query('small', limit=5).status)
+        self.assertEqual(LIMIT, Numbers().query('small', limit=0).status)
+
+    def test_max_generations(self):
+        numbers = Numbers()
+        result = numbers.query('natural', max_generations=10)
+        self.assertEqual(MAX_GENERATIONS, result.status)
+        self.assertSetEqual(set(range(10)), {d['n'] for d in result})
+        self.assertEqual(10, result.generations)
+        # The next query continues where this one stopped
+        self.assertSetEqual(set(range(15)), {d['n'] for d in numbers.query('natural', max_generations=5)})
+
+    def test_max_scenarios(self):
+        numbers = Numbers()
+        result = numbers.query('tree', max_scenarios=1000)
+        self.assertEqual(MAX_SCENARIOS, result.status)
+        self.assertLess(len(result), 1000)
+        # The step that went over budget was abandoned
+        for previous, gen in zip(numbers.generations[numbers.stratum_of['tree']],
+                                 numbers.generations[numbers.stratum_of['tree']][1:]):
+            self.assertEqual(2 * previous.sizes['tree'] + 1, gen.sizes['tree'])
+
+    def test_timeout(self):
+        result = Numbers().query('natural', timeout=0.05)
+        self.assertEqual(TIMEOUT, result.status)
+        self.assertLess(result.elapsed, 1)
+        self.assertLess(0, len(result))
+
+    def test_error(self):
+        numbers = Numbers()
+        result = numbers.query('broken')
+        self.assertEqual(ERROR, result.status)
+        self.assertIsInstance(result.error, ZeroDivisionError)
+        # The RuleBook still works
+        self.assertEqual(COMPLETE, numbers.query('small').status)
+
+if __name__ == "__main__":
+    unittest.main()
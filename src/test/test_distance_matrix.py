@@ -0,0 +1,63 @@
+import unittest
+import googlemaps.exceptions
+from pyrules2.route_gmaps import _tiles, _distance_matrix, _fetch_tile, _new_client, MAX_ELEMENTS, MAX_ORIGINS, \
+    MAX_DESTINATIONS, MAX_ATTEMPTS, MAX_WORKERS
+from pyrules2.distance_matrix_server import DistanceMatrixServer, made_up_costs, benchmark, KEY
+
+
+class Test(unittest.TestCase):
+    def test_tiles(self):
+        for origins, destinations in [(1, 1), (3, 40), (40, 3), (30, 30), (101, 7), (0, 5)]:
+            o = ['o{}'.format(i) for i in range(origins)]
+            d = ['d{}'.format(i) for i in range(destinations)]
+            tiles = _tiles(o, d)
+            covered = [(a, b) for tile_origins, tile_destinations in tiles
+                       for a in tile_origins for b in tile_destinations]
+            self.assertEqual(origins * destinations, len(covered))
+            self.assertSetEqual({(a, b) for a in o for b in d}, set(covered))
+            for tile_origins, tile_destinations in tiles:
+                self.assertLessEqual(len(tile_origins), MAX_ORIGINS)
+                self.assertLessEqual(len(tile_destinations), MAX_DESTINATIONS)
+                self.assertLessEqual(len(tile_origins) * len(tile_destinations), MAX_ELEMENTS)
+
+    def test_concurrent(self):
+        addresses = ['Place {}'.format(i) for i in range(30)]
+        with DistanceMatrixServer(latency=0.01) as server:
+            client = _new_client(KEY, base_url=server.url)
+            costs = _distance_matrix(client, 'driving', [(addresses, addresses), (addresses[:2], ['Elsewhere'])])
+            self.assertEqual(30 * 30 + 2, len(costs))
+            self.assertEqual(made_up_costs('Place 3', 'Place 7'), costs[('Place 3', 'Place 7')])
+            self.assertEqual(made_up_costs('Place 1', 'Elsewhere'), costs[('Place 1', 'Elsewhere')])
+            self.assertEqual(len(_tiles(addresses, addresses)) + 1, server.requests)
+            # The threads share the connections of the client
+            self.assertLessEqual(len(server.connections), MAX_WORKERS)
+            connections = set(server.connections)
+            _distance_matrix(client, 'driving', [(addresses, addresses)])
+            self.assertSetEqual(connections, server.connections)
+
+    def test_retry(self):
+        for failure in ('UNKNOWN_ERROR', 'OVER_QUERY_LIMIT'):
+            with DistanceMatrixServer(failures=MAX_ATTEMPTS - 1, failure=failure) as server:
+                client = _new_client(KEY, base_url=server.url)
+                self.assertEqual({('a', 'b'): made_up_costs('a', 'b')},
+                                 _fetch_tile(client, 'driving', ['a'], ['b'], 0))
+                self.assertEqual(MAX_ATTEMPTS, server.requests)
+            with DistanceMatrixServer(failures=MAX_ATTEMPTS, failure=failure) as server:
+                client = _new_client(KEY, base_url=server.url)
+                self.assertRaises(googlemaps.exceptions.ApiError, _fetch_tile, client, 'driving', ['a'], ['b'], 0)
+                self.assertEqual(MAX_ATTEMPTS, server.requests)
+        # Not worth retrying
+        with DistanceMatrixServer(failures=1, failure='REQUEST_DENIED') as server:
+            client = _new_client(KEY, base_url=server.url)
+            self.assertRaises(googlemaps.exceptions.ApiError, _fetch_tile, client, 'driving', ['a'], ['b'], 0)
+            self.assertEqual(1, server.requests)
+        # The server is gone, so connecting fails every time
+        client = _new_client(KEY, base_url=server.url)
+        self.assertRaises(googlemaps.exceptions.TransportError, _fetch_tile, client, 'driving', ['a'], ['b'], 0)
+
+    def test_benchmark(self):
+        results = benchmark(places=12, latency=0.0, workers=(1, 4))
+        self.assertListEqual([1, 4], [workers for workers, _, _ in results])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
 from pyrules2.expression import ConstantExpression, AndExpression, OrExpression, ReferenceExpression, when, \
-    FilterEqExpression, RenameExpression, bind, IterableWrappingExpression, EMPTY
-from pyrules2.scenario import Scenario
+    FilterEqExpression, RenameExpression, bind, IterableWrappingExpression, EMPTY, SelectProjectExpression
+from pyrules2.scenario import Scenario, Relation
+from pyrules2.rules import DIYIterable
+from itertools import count, islice
 
 
 class Test(unittest.TestCase):
@@ -133,6 +135,28 @@ class Test(unittest.TestCase):
         self.assertListEqual([{'a': 'b'}], list(o.all_dicts()))
         self.assertListEqual([{'a': 'b'}], list(o.all_dicts()))
 
+    def test_and_join(self):
+        # Shared key: only matching pairs
+        left = IterableWrappingExpression([Scenario({'x': i, 'y': i % 3}) for i in range(9)])
+        right = IterableWrappingExpression([Scenario({'y': j, 'z': -j}) for j in range(2)])
+        r = list(AndExpression(left, right).all_dicts())
+        self.assertEqual(6, len(r))
+        for d in r:
+            self.assertEqual(d['y'], d['x'] % 3)
+            self.assertEqual(d['z'], -d['y'])
+        # Scenarios with different keys in the same subexpression
+        e = (when(a=0) | when(a=0, b=1) | when(b=2)) & when(a=0, c=3)
+        r = list(e.all_dicts())
+        self.assertEqual(3, len(r))
+        for d in [{'a': 0, 'c': 3}, {'a': 0, 'b': 1, 'c': 3}, {'a': 0, 'b': 2, 'c': 3}]:
+            self.assertIn(d, r)
+        # Infinite subexpressions on both sides
+        evens = IterableWrappingExpression(DIYIterable(lambda: (Scenario({'n': 2 * i}) for i in count())))
+        triples = IterableWrappingExpression(DIYIterable(lambda: (Scenario({'n': 3 * i}) for i in count())))
+        self.assertListEqual([{'n': 6 * i} for i in range(10)], list(islice((evens & triples).all_dicts(), 10)))
+        # Infinite and empty
+        self.assertListEqual([], list((evens & EMPTY).all_dicts()))
+
     def test_when(self):
         w = when(a=0, b=1)
         self.assertListEqual([{'a': 0, 'b': 1}], list(w.all_dicts()))
@@ -198,6 +222,47 @@ class Test(unittest.TestCase):
         r = RenameExpression(when(x=0) | when(x=1), x='a')
         self.assertListEqual([{'a': 0}, {'a': 1}], list(r.all_dicts()))
 
+    def test_select_project(self):
+        e = when(x=0, y=1) | when(x=1, y=1) | when(x=0, y=2)
+        # Select only
+        self.assertListEqual([{'x': 0, 'y': 1}, {'x': 0, 'y': 2}],
+                             list(SelectProjectExpression(e, {'x': 0}).all_dicts()))
+        # Select and rename
+        self.assertListEqual([{'a': 1}, {'a': 2}],
+                             list(SelectProjectExpression(e, {'x': 0}, {'y': 'a'}).all_dicts()))
+        # Clash
+        self.assertListEqual([{'a': 1}],
+                             list(SelectProjectExpression(e, {}, {'x': 'a', 'y': 'a'}).all_dicts()))
+        # Required key missing
+        self.assertRaises(Exception, list, SelectProjectExpression(e, {'z': 0}).scenarios())
+        # Optional key missing
+        self.assertEqual(3, len(list(SelectProjectExpression(e, {'z': 0}, None, set()).scenarios())))
+        # Unknown key to rename
+        self.assertRaises(Exception, list, SelectProjectExpression(e, {}, {'z': 'a'}).scenarios())
+
+    def test_relation_probes(self):
+        scenarios = [Scenario({'x': i, 'y': i % 3}) for i in range(9)]
+        scanned = IterableWrappingExpression(scenarios)
+        indexed = IterableWrappingExpression(Relation(scenarios))
+        self.assertIsNone(scanned.relation())
+        ref = ReferenceExpression()
+        ref.set_expression(indexed)
+        self.assertIs(indexed.scenario_iterable, ref.relation())
+        # Filters probe the Relation, with the same results as a scan
+        for constants, renames, required in [({'y': 1}, None, None), ({'y': 1}, {'x': 'a'}, None),
+                                             ({'x': 4}, {'y': 'a'}, set()), ({}, {'x': 'a', 'y': 'a'}, None)]:
+            self.assertSetEqual(set(SelectProjectExpression(scanned, constants, renames, required).scenarios()),
+                                set(SelectProjectExpression(ref, constants, renames, required).scenarios()))
+        self.assertSetEqual(set(FilterEqExpression('y', 2, scanned).scenarios()),
+                            set(FilterEqExpression('y', 2, ref).scenarios()))
+        # Joins probe the Relation, also through a SelectProjectExpression
+        left = when(y=1, z=0) | when(y=2, z=1) | when(a=5, z=2)
+        for constants, renames in [({}, None), ({}, {'x': 'a', 'y': 'y'}), ({'y': 2}, {'x': 'a'})]:
+            self.assertSetEqual(set((left & SelectProjectExpression(scanned, constants, renames)).scenarios()),
+                                set((left & SelectProjectExpression(ref, constants, renames)).scenarios()))
+        self.assertSetEqual(set((left & scanned).scenarios()), set((left & ref).scenarios()))
+        self.assertListEqual([], list((left & IterableWrappingExpression(Relation())).scenarios()))
+
     def test_or_op(self):
         self.assertListEqual([{'a': 0}, {'a': 1}],
                              list((when(a=0) | when(a=1)).all_dicts()))
@@ -323,6 +388,24 @@ class Test(unittest.TestCase):
         e = IterableWrappingExpression(l)
         self.assertListEqual(l, list(e.scenarios()))
 
+    def test_through(self):
+        r = ReferenceExpression()
+        r.set_expression(when(x=1) | when(x=2))
+        # No references
+        self.assertIs(EMPTY, when(x=0).through({r}))
+        self.assertIs(EMPTY, (when(x=0) | r).through(set()))
+        # Or: only the branch with the reference
+        self.assertListEqual([{'x': 1}, {'x': 2}], list((when(x=0) | r).through({r}).all_dicts()))
+        # And: the other subexpressions still constrain the result
+        e = (when(x=1) & r) | when(x=3)
+        self.assertListEqual([{'x': 1}], list(e.through({r}).all_dicts()))
+        # Filter and rename
+        e = bind(when(x=0) | r, {'x': 2}, {'x': 'y'})
+        self.assertListEqual([{'y': 2}], list(e.through({r}).all_dicts()))
+        # Apply
+        e = when(f=lambda x: x + 1)(when(x=0) | r)
+        self.assertListEqual([{'x': 2}, {'x': 3}], list(e.through({r}).all_dicts()))
+
     def test_empty(self):
         self.assertListEqual([], list(EMPTY.scenarios()))
 
@@ -1,6 +1,10 @@
 import unittest
-from pyrules2 import when, rule, RuleBook, person, no
+from pyrules2 import when, rule, RuleBook, person, no, best_first
+from pyrules2.rules import Generation, _stable_repr
 from itertools import product
+import threading
+import tempfile
+import os
 
 '''Example: Family relations
 
@@ -77,5 +81,201 @@ class Test(unittest.TestCase):
             set((d['aunt_uncle'], d['niece_nephew']) for d in dicts),
             set(expected_pairs))
 
+    def test_semi_naive(self):
+        semi_naive = DanishRoyalFamily()
+        naive = DanishRoyalFamily(semi_naive=False)
+        unplanned = DanishRoyalFamily(plan_joins=False)
+        for key in ['child', 'spouse', 'sibling', 'aunt_uncle']:
+            expected = set(frozenset(d.items()) for d in getattr(naive, key)())
+            self.assertSetEqual(expected, set(frozenset(d.items()) for d in getattr(semi_naive, key)()))
+            self.assertSetEqual(expected, set(frozenset(d.items()) for d in getattr(unplanned, key)()))
+        self.assertIn("ReferenceExpression 'sibling'", semi_naive.explain('aunt_uncle'))
+
+    def test_no_duplicates(self):
+        drf = DanishRoyalFamily()
+        for key in ['child', 'spouse', 'sibling', 'aunt_uncle']:
+            results = [frozenset(d.items()) for d in getattr(drf, key)()]
+            self.assertEqual(len(set(results)), len(results))
+        # Also when another query computes Generations in between
+        drf = DanishRoyalFamily()
+        first = iter(drf.spouse())
+        results = [frozenset(next(first).items())]
+        self.assertEqual(len(list(drf.spouse())), len(set(frozenset(d.items()) for d in drf.spouse())))
+        results.extend(frozenset(d.items()) for d in first)
+        self.assertEqual(len(set(results)), len(results))
+        self.assertSetEqual(set(results), set(frozenset(d.items()) for d in drf.spouse()))
+
+    def test_parallel(self):
+        sequential = DanishRoyalFamily()
+        parallel = DanishRoyalFamily(processes=2)
+        sharded = DanishRoyalFamily(processes=3, min_shard_size=1)
+        naive = DanishRoyalFamily(semi_naive=False, processes=2, min_shard_size=1)
+        for key in ['child', 'spouse', 'sibling', 'aunt_uncle']:
+            expected = set(frozenset(d.items()) for d in getattr(sequential, key)())
+            for drf in [parallel, sharded, naive]:
+                self.assertSetEqual(expected, set(frozenset(d.items()) for d in getattr(drf, key)()))
+        stratum = sharded.stratum_of['aunt_uncle']
+        tasks = sharded._tasks(stratum, sharded._environment_below(stratum))
+        # Shards of the largest call, i.e. child
+        self.assertListEqual([('aunt_uncle', None, (3, n, 3)) for n in range(3)], tasks)
+        # The workers are forked once and reused, until the facts change
+        workers = parallel._workers
+        self.assertEqual(2, len(workers.processes))
+        parallel.insert('sibling', x='MARY', y='ANNA')
+        self.assertIsNone(parallel._workers)
+        sequential.insert('sibling', x='MARY', y='ANNA')
+        self.assertSetEqual(set(frozenset(d.items()) for d in sequential.aunt_uncle()),
+                            set(frozenset(d.items()) for d in parallel.aunt_uncle()))
+        self.assertFalse(any(process.is_alive() for process in workers.processes))
+        for drf in [parallel, sharded, naive]:
+            drf.close()
+
+    def test_strata(self):
+        drf = DanishRoyalFamily()
+        self.assertEqual(frozenset(['spouse']), drf.stratum_of['spouse'])
+        self.assertSetEqual({'child', 'spouse', 'sibling'}, drf.dependencies['aunt_uncle'])
+        self.assertLess(drf.strata.index(drf.stratum_of['sibling']), drf.strata.index(drf.stratum_of['aunt_uncle']))
+        # Querying child should not iterate aunt_uncle, and child needs only one step
+        list(drf.child())
+        self.assertEqual(2, len(drf.generations[drf.stratum_of['child']]))
+        self.assertEqual(1, len(drf.generations[drf.stratum_of['aunt_uncle']]))
+        self.assertEqual(1, len(drf.generations[drf.stratum_of['spouse']]))
+
+    def test_shared(self):
+        first = DanishRoyalFamily(shared=True)
+        expected = set(frozenset(d.items()) for d in first.aunt_uncle())
+        second = DanishRoyalFamily(shared=True)
+        self.assertIs(first.generations, second.generations)
+        self.assertTrue(second.generations[second.stratum_of['aunt_uncle']][-1].fixed_point)
+        self.assertSetEqual(expected, set(frozenset(d.items()) for d in second.aunt_uncle()))
+        self.assertIsNot(first.generations, DanishRoyalFamily().generations)
+        self.assertRaises(AssertionError, second.insert, 'spouse', x='FRED', y='MARY')
+        # Many threads querying new instances
+        results = []
+
+        def query():
+            results.append(set(frozenset(d.items()) for d in DanishRoyalFamily(shared=True).aunt_uncle()))
+        threads = [threading.Thread(target=query) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertListEqual([expected] * 4, results)
+
+    def test_threads(self):
+        keys = ['aunt_uncle', 'child', 'spouse', 'sibling', 'aunt_uncle', 'spouse']
+        sequential = DanishRoyalFamily()
+        expected = [set(frozenset(d.items()) for d in getattr(sequential, key)()) for key in keys]
+        for _ in range(10):
+            drf = DanishRoyalFamily()
+            barrier = threading.Barrier(len(keys))
+            results = [None] * len(keys)
+
+            def query(index):
+                barrier.wait()
+                results[index] = [frozenset(d.items()) for d in getattr(drf, keys[index])()]
+            threads = [threading.Thread(target=query, args=(index,)) for index in range(len(keys))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertListEqual(expected, [set(result) for result in results])
+            # Each answer streamed once, although other threads computed Generations
+            self.assertTrue(all(len(result) == len(set(result)) for result in results))
+            # One Generation per step, although several threads needed the next step
+            for stratum, generations in drf.generations.items():
+                self.assertEqual(len(sequential.generations[stratum]), len(generations))
+
+    def test_checkpoint(self):
+        drf = DanishRoyalFamily()
+        expected = set(frozenset(d.items()) for d in drf.aunt_uncle())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'family.checkpoint')
+            self.assertFalse(DanishRoyalFamily().load(path))
+            drf.save(path)
+            loaded = DanishRoyalFamily(checkpoint=path)
+            lengths = {stratum: len(generations) for stratum, generations in loaded.generations.items()}
+            self.assertTrue(all(generations[-1].fixed_point for generations in loaded.generations.values()))
+            self.assertSetEqual(expected, set(frozenset(d.items()) for d in loaded.aunt_uncle()))
+            # No iteration was needed
+            self.assertDictEqual(lengths, {stratum: len(generations)
+                                           for stratum, generations in loaded.generations.items()})
+            # Changed facts give another fingerprint, so the checkpoint is not loaded
+            changed = DanishRoyalFamily()
+            changed.insert('sibling', x='ANNA', y='MARY')
+            self.assertNotEqual(drf.fingerprint(), changed.fingerprint())
+            changed.save(path)
+            self.assertFalse(DanishRoyalFamily().load(path))
+            # Strata that were not computed are computed after loading
+            partial = DanishRoyalFamily()
+            list(partial.child())
+            partial.save(path)
+            loaded = DanishRoyalFamily(checkpoint=path)
+            self.assertEqual(1, len(loaded.generations[loaded.stratum_of['spouse']]))
+            self.assertSetEqual(expected, set(frozenset(d.items()) for d in loaded.aunt_uncle()))
+        # Constants are fingerprinted by a representation that is the same in every process
+        self.assertEqual(_stable_repr({'b': {2, 1}, 'a': (0,)}), _stable_repr({'a': (0,), 'b': {1, 2}}))
+        self.assertRaises(AssertionError, _stable_repr, [object()])
+
+    def test_convergence(self):
+        drf = DanishRoyalFamily()
+        list(drf.spouse())
+        generations = drf.generations[drf.stratum_of['spouse']]
+        for previous, gen in zip(generations, generations[1:]):
+            self.assertTrue(gen.grew(previous))
+            self.assertEqual(len(gen.frozensets['spouse']), gen.sizes['spouse'])
+            # The incremental content hash agrees with one computed from scratch
+            full = Generation(gen.keys)
+            full.fill(gen.get_expression)
+            self.assertEqual(full.hashes, gen.hashes)
+            self.assertEqual(full, gen)
+            self.assertNotEqual(previous, gen)
+        self.assertTrue(generations[-1].fixed_point)
+
+    def test_strategy(self):
+        by_name = best_first(lambda scenario: scenario['child'])
+        drf = DanishRoyalFamily(strategy={'child': by_name})
+        names = [d['child'] for d in drf.child()]
+        self.assertListEqual(sorted(names), names)
+        # Every answer is still found
+        self.assertEqual(8, len(names))
+
+    def test_plans(self):
+        drf = DanishRoyalFamily()
+        self.assertListEqual(['sibling', 'spouse', 'sibling', 'child'],
+                             [rule_name for rule_name, _ in drf.plans['aunt_uncle'].references])
+        self.assertListEqual([], drf.plans['child'].references)
+        # Evaluating a rule does not parse it again
+        expression = drf.plans['aunt_uncle'].expression
+        list(drf.aunt_uncle())
+        self.assertIs(expression, drf.plans['aunt_uncle'].expression)
+
+    def test_insert_retract(self):
+        def answers(rule_book):
+            return {key: set(frozenset(d.items()) for d in getattr(rule_book, key)())
+                    for key in ['child', 'spouse', 'sibling', 'aunt_uncle']}
+
+        drf = DanishRoyalFamily()
+        answers(drf)
+        changes = [(drf.insert, 'sibling', {'x': 'MARY', 'y': 'ANNA'}),
+                   (drf.retract, 'spouse', {'x': 'FRED', 'y': 'MARY'}),
+                   (drf.retract, 'sibling', {'x': 'FRED', 'y': 'JOE'}),
+                   (drf.insert, 'sibling', {'x': 'FRED', 'y': 'JOE'}),
+                   (drf.retract, 'sibling', {'x': 'MARY', 'y': 'ANNA'})]
+        for method, key, fact in changes:
+            method(key, **fact)
+            # Compare the incrementally updated fixed points to ones computed from scratch
+            fresh = DanishRoyalFamily()
+            fresh.inserted_facts = {k: set(facts) for k, facts in drf.inserted_facts.items()}
+            fresh.retracted_facts = {k: set(facts) for k, facts in drf.retracted_facts.items()}
+            self.assertDictEqual(answers(fresh), answers(drf))
+        self.assertIn((DanishRoyalFamily.JOE, DanishRoyalFamily.CHRIS),
+                      set((d['aunt_uncle'], d['niece_nephew']) for d in drf.aunt_uncle()))
+        self.assertNotIn((DanishRoyalFamily.FRED, DanishRoyalFamily.MARY),
+                         set((d['x'], d['y']) for d in drf.spouse()))
+        # Only facts can be retracted
+        self.assertRaises(Exception, drf.retract, 'spouse', x=DanishRoyalFamily.MARY, y=DanishRoyalFamily.FRED)
+        self.assertRaises(Exception, drf.insert, 'spouse', x=DanishRoyalFamily.MARY)
+
 if __name__ == "__main__":
     unittest.main()
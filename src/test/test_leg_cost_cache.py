@@ -0,0 +1,118 @@
+import unittest
+import tempfile
+from pyrules2 import place, RESET
+from pyrules2.route import Route
+from pyrules2.route_gmaps import LegCostCache, SharedCostMatrix, _google_maps_costs
+
+COP = place('Copenhagen, Denmark')
+MAD = place('Madrid, Spain')
+BER = place('Berlin, Germany')
+LIS = place('Lisbon, Portugal')
+
+
+class StubClient(object):
+    """
+    Answers like the Distance Matrix API, with made-up numbers, and records the elements asked for.
+    """
+    def __init__(self):
+        self.requests = []
+
+    def distance_matrix(self, origins, destinations, mode, units):
+        self.requests.append([(origin, destination) for origin in origins for destination in destinations])
+        return {'status': 'OK',
+                'rows': [{'elements': [{'status': 'OK',
+                                        'distance': {'value': len(origin) * 1000 + len(destination)},
+                                        'duration': {'value': len(origin) + len(destination)}}
+                                       for destination in destinations]}
+                         for origin in origins]}
+
+    def elements(self):
+        return sum(len(request) for request in self.requests)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = LegCostCache(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_cache(self):
+        client = StubClient()
+        addresses = [COP.address, MAD.address, BER.address, COP.address]
+        costs = _google_maps_costs('driving', addresses, (), self.cache, client)
+        self.assertEqual(1, len(client.requests))
+        self.assertEqual(9, client.elements())
+        self.assertEqual(9, len(costs))
+        self.assertEqual(len(COP.address) * 1000 + len(MAD.address), costs[(COP.address, MAD.address)][0])
+        self.assertEqual(len(BER.address) * 2, costs[(BER.address, BER.address)][1])
+        # Known route: No requests at all, also from a new LegCostCache
+        client = StubClient()
+        again = _google_maps_costs('driving', addresses[::-1], (), LegCostCache(self.directory.name), client)
+        self.assertEqual(0, len(client.requests))
+        self.assertEqual(costs, again)
+        # One new place: Only the missing row and column
+        client = StubClient()
+        _google_maps_costs('driving', addresses + [LIS.address], (), self.cache, client)
+        self.assertEqual(7, client.elements())
+        self.assertNotIn((COP.address, MAD.address), [pair for request in client.requests for pair in request])
+        # Another mode is another key
+        client = StubClient()
+        _google_maps_costs('walking', [COP.address, MAD.address], (), self.cache, client)
+        self.assertEqual(4, client.elements())
+        # Costs between known addresses are not wanted, with or without a cache
+        client = StubClient()
+        costs = _google_maps_costs('bicycling', [LIS.address], [COP.address, MAD.address], self.cache, client)
+        self.assertEqual(5, client.elements())
+        self.assertSetEqual({(COP.address, LIS.address), (MAD.address, LIS.address), (LIS.address, LIS.address),
+                             (LIS.address, COP.address), (LIS.address, MAD.address)}, set(costs))
+
+    def test_ttl(self):
+        self.cache.put('driving', {('a', 'b'): (1, 2)})
+        self.assertEqual({('a', 'b'): (1, 2)}, self.cache.get('driving', [('a', 'b'), ('b', 'a')]))
+        self.assertEqual({}, self.cache.get('walking', [('a', 'b')]))
+        expired = LegCostCache(self.directory.name, ttl=0)
+        self.assertEqual({}, expired.get('driving', [('a', 'b')]))
+        self.assertEqual(0, self.cache.evict())
+        self.assertEqual(1, expired.evict())
+        self.assertEqual({}, self.cache.get('driving', [('a', 'b')]))
+
+    def test_shared_matrix(self):
+        client = StubClient()
+        shared = SharedCostMatrix('driving', self.cache, client)
+        matrix = shared.covering((COP, MAD, BER, COP))
+        self.assertEqual(9, client.elements())
+        route = Route((COP, MAD, BER, COP), matrix)
+        distance = route.distance
+        # Known Places, also in another order or fewer of them: The same CostMatrix, no requests
+        self.assertIs(matrix, shared.covering((BER, COP)))
+        self.assertEqual(1, len(client.requests))
+        # One new Place: Only the new row and column, against a fresh cache too
+        client = StubClient()
+        shared.client = client
+        shared.cache = LegCostCache(tempfile.mkdtemp(dir=self.directory.name))
+        grown = shared.covering((COP, MAD, BER, LIS, COP))
+        self.assertEqual(3 + 3 + 1, client.elements())
+        self.assertNotIn((COP.address, MAD.address), [pair for request in client.requests for pair in request])
+        self.assertEqual(tuple(matrix.places) + (LIS,), grown.places)
+        fresh = SharedCostMatrix('driving', LegCostCache(tempfile.mkdtemp(dir=self.directory.name)), StubClient())
+        self.assertEqual(fresh.covering((COP, MAD, BER, LIS)), grown)
+        # Earlier Routes keep their CostMatrix and costs
+        self.assertEqual(3, len(matrix.places))
+        self.assertEqual(distance, route.distance)
+        self.assertEqual(distance, Route((COP, MAD, BER, COP), grown).distance)
+        # ... and equal the same Routes made later
+        self.assertEqual(route, Route((COP, MAD, BER, COP), grown))
+        self.assertEqual(hash(route), hash(Route((COP, MAD, BER, COP), grown)))
+        self.assertEqual(1, len({route, Route((COP, MAD, BER, COP), grown)}))
+        self.assertNotEqual(route, Route((COP, BER, MAD, COP), grown))
+        # A new Place at a known address: No requests, the costs of the known address
+        client = StubClient()
+        shared.client = client
+        depot = place(LIS.address, milk=RESET)
+        self.assertEqual(grown['duration'][(COP, LIS)], shared.covering((COP, depot))['duration'][(COP, depot)])
+        self.assertEqual(0, client.elements())
+
+if __name__ == "__main__":
+    unittest.main()
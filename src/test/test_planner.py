@@ -0,0 +1,84 @@
+import unittest
+from pyrules2.expression import AndExpression, OrExpression, ReferenceExpression, IterableWrappingExpression, \
+    SelectProjectExpression, ConstantExpression, when, bind, EMPTY
+from pyrules2.planner import estimate, plan, explain, push_down, Estimate
+from pyrules2.scenario import Scenario
+
+
+def relation(*pairs):
+    return IterableWrappingExpression(frozenset(Scenario({'x': x, 'y': y}) for x, y in pairs))
+
+
+class Test(unittest.TestCase):
+    def test_estimate(self):
+        r = relation((0, 1), (0, 2), (1, 2))
+        self.assertEqual(Estimate(3, {'x': 2, 'y': 2}), estimate(r))
+        self.assertEqual(0, estimate(EMPTY).size)
+        self.assertEqual(Estimate(1, {'a': 1}), estimate(when(a=0)))
+        # Filter by a key with 2 distinct values
+        self.assertEqual(1.5, estimate(bind(r, {'x': 0}, {'y': 'y'})).size)
+        # Join on y: 3 * 3 / 2
+        self.assertEqual(4.5, estimate(AndExpression(r, bind(r, {}, {'y': 'y', 'x': 'z'}))).size)
+        # Union
+        self.assertEqual(4, estimate(OrExpression(r, when(x=5))).size)
+        # Reference
+        ref = ReferenceExpression('r')
+        ref.set_expression(r)
+        self.assertEqual(3, estimate(ref).size)
+
+    def test_plan(self):
+        big = IterableWrappingExpression(frozenset(Scenario({'a': i, 'b': i}) for i in range(100)))
+        other = IterableWrappingExpression(frozenset(Scenario({'c': i, 'd': i}) for i in range(100)))
+        link = IterableWrappingExpression(frozenset([Scenario({'b': 1, 'c': 2})]))
+        # Nested joins are flattened, and ordered to avoid the cross product of big and other
+        e = AndExpression(AndExpression(big, other), link)
+        planned = plan(e)
+        self.assertIsInstance(planned, AndExpression)
+        self.assertListEqual([link, big, other], planned.subexpressions)
+        self.assertSetEqual(set(e.scenarios()), set(planned.scenarios()))
+        # Joins are distributed over small unions
+        e = AndExpression(big, OrExpression(other, link), when(a=1))
+        planned = plan(e)
+        self.assertIsInstance(planned, OrExpression)
+        self.assertSetEqual(set(e.scenarios()), set(planned.scenarios()))
+        # References are shared, not copied
+        ref = ReferenceExpression('r')
+        planned = plan(AndExpression(ref, ref, when(a=1)))
+        self.assertTrue(all(sub_expr is ref for sub_expr in planned.subexpressions[1:]))
+
+    def test_push_down(self):
+        r = relation((0, 1), (0, 2), (1, 2))
+        # A bind() chain becomes one SelectProjectExpression
+        e = bind(r, {'x': 0}, {'y': 'a'})
+        pushed = push_down(e)
+        self.assertIsInstance(pushed, SelectProjectExpression)
+        self.assertIs(r, pushed.expr)
+        self.assertEqual({'x': 0}, pushed.constants)
+        self.assertListEqual(sorted(d['a'] for d in e.all_dicts()), sorted(d['a'] for d in pushed.all_dicts()))
+        # Constants are evaluated right away
+        self.assertIs(EMPTY, push_down(bind(when(x=1, y=0), {'x': 0}, {})))
+        pushed = push_down(bind(when(x=0, y=5), {'x': 0}, {'y': 'a'}))
+        self.assertIsInstance(pushed, ConstantExpression)
+        self.assertListEqual([{'a': 5}], list(pushed.all_dicts()))
+        # Through OrExpression into each branch
+        e = bind(r | when(x=0, y=7) | when(x=3, y=7), {'x': 0}, {'y': 'a'})
+        pushed = push_down(e)
+        self.assertIsInstance(pushed, OrExpression)
+        self.assertSetEqual(set(e.scenarios()), set(pushed.scenarios()))
+        # Through AndExpression into the subexpressions defining the key
+        e = bind(AndExpression(r, bind(r, {}, {'x': 'y', 'y': 'z'})), {'x': 0}, {'x': 'x', 'z': 'z'})
+        pushed = push_down(e)
+        self.assertIsInstance(pushed.expr, AndExpression)
+        self.assertEqual({'x': 0}, pushed.expr.subexpressions[0].constants)
+        self.assertSetEqual(set(e.scenarios()), set(pushed.scenarios()))
+        # Missing keys are still an error
+        self.assertRaises(Exception, list, push_down(bind(r, {'q': 0}, {})).scenarios())
+
+    def test_explain(self):
+        lines = explain(AndExpression(when(x=0), relation((0, 1)))).split('\n')
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[0].startswith('AndExpression'))
+        self.assertTrue(lines[1].startswith('  '))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+import unittest
+import pickle
+from frozendict import frozendict
+from itertools import permutations
+from pyrules2.route import place, Route, CostMatrix, RESET, reroute, limit, optimize, improve, _Reroute
+from pyrules2.expression import OrExpression, when
+
+A = place('A', milk=RESET)
+B = place('B', milk=3)
+C = place('C', milk=4)
+D = place('D', milk=5)
+PLACES = [A, B, C, D]
+
+
+def distance(origin, destination):
+    return abs(PLACES.index(origin) - PLACES.index(destination)) * 10
+
+
+COSTS = {'distance': {(o, d): distance(o, d) for o in PLACES for d in PLACES},
+         'duration': {(o, d): distance(o, d) / 2.0 for o in PLACES for d in PLACES}}
+
+
+def big_route():
+    """
+    :return: A Route with 11 distinct stops and a depot visited twice, and made-up distances.
+    """
+    places = [place('P{}'.format(i), milk=RESET if i == 0 else i % 4 + 1) for i in range(12)]
+    costs = {'distance': {(o, d): (places.index(o) * 7 + places.index(d) * 13) % 17 + 1
+                          for o in places for d in places}}
+    return Route(tuple(places[:6] + [places[0]] + places[6:] + [places[0]]), CostMatrix(places, costs))
+
+
+class Test(unittest.TestCase):
+    def test_cost_matrix(self):
+        m = CostMatrix([A, B, A, C, D], COSTS)
+        self.assertEqual((A, B, C, D), m.places)
+        self.assertEqual(2, m.index(C))
+        self.assertEqual(20, m['distance'][(B, D)])
+        self.assertEqual(10.0, m['duration'][(C, A)])
+        self.assertSetEqual({'distance', 'duration'}, set(m))
+        self.assertEqual(16, len(m['distance']))
+        self.assertEqual(60, m.total('distance', (0, 3, 0)))
+        self.assertEqual(m, CostMatrix(PLACES, COSTS))
+        self.assertEqual(hash(m), hash(CostMatrix(PLACES, COSTS)))
+        self.assertEqual(m, pickle.loads(pickle.dumps(m)))
+
+    def test_extended(self):
+        small = CostMatrix([A, B], COSTS)
+        m = small.extended([B, C, D], COSTS)
+        self.assertEqual(CostMatrix(PLACES, COSTS), m)
+        self.assertEqual((A, B), small.places)
+        self.assertEqual(1, m.index(B))
+        self.assertEqual(['q', 'd'], [m.rows[name][0].typecode for name in ('distance', 'duration')])
+        self.assertIs(m, m.extended([D, A], COSTS))
+        # A Route is fingerprinted by its own Places and legs, not the growing CostMatrix
+        r = Route((A, B, A), small)
+        self.assertEqual(r.fingerprint(), Route((A, B, A), m).fingerprint())
+        self.assertNotEqual(r.fingerprint(), Route((B, A, B), m).fingerprint())
+
+    def test_costs(self):
+        m = CostMatrix(PLACES, COSTS)
+        r = Route((A, C, B, A, D, A), m)
+        self.assertEqual(20 + 10 + 10 + 30 + 30, r.distance)
+        self.assertEqual(50.0, r.duration)
+        self.assertEqual(7, r.milk)
+        self.assertEqual((0, 2, 1, 0, 3, 0), r.indexes())
+        # Same results with frozendicts
+        old = Route((A, C, B, A, D, A), frozendict({key: frozendict(value) for key, value in COSTS.items()}))
+        self.assertEqual(r.distance, old.distance)
+        self.assertEqual(r.milk, old.milk)
+        # Routes with frozendicts of only their own legs, like in the Route docstring, compare by those
+        legs = frozendict({'distance': frozendict({(A, B): 7, (B, A): 8}),
+                           'duration': frozendict({(A, B): 1, (B, A): 2})})
+        first, second = Route((A, B, A), legs), Route((A, B, A), frozendict(legs))
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertNotEqual(first, Route((A, B, A), frozendict(legs, distance=frozendict({(A, B): 7, (B, A): 9}))))
+        self.assertEqual(first.fingerprint(), second.fingerprint())
+        tour = Route((A, B, C, A), frozendict({'distance': frozendict({(A, B): 1, (B, C): 2, (C, A): 3})}))
+        self.assertListEqual([(A, C, B, A)], [a.places for a in tour.alternatives(milk=10)])
+        # Costs are cached
+        self.assertIn('distance', r.__dict__)
+        self.assertRaises(AttributeError, getattr, r, '_no_such_cost')
+        # Routes survive pickling, e.g. to another process
+        self.assertEqual(r, pickle.loads(pickle.dumps(r)))
+        self.assertEqual(r.distance, pickle.loads(pickle.dumps(r)).distance)
+
+    def test_alternatives(self):
+        m = CostMatrix(PLACES, COSTS)
+        r = Route((A, B, C, A, D, B, A), m)
+        # Every distinct reordering of the intermediate stops, except r itself
+        expected = {(A,) + alt + (A,) for alt in permutations(r.places[1:-1])} - {r.places}
+        alternatives = list(r.alternatives())
+        self.assertSetEqual(expected, {a.places for a in alternatives})
+        self.assertEqual(len(expected), len(alternatives))
+        for a in alternatives:
+            self.assertEqual(tuple(m.index(p) for p in a.places), a.indexes())
+            self.assertIs(m, a.leg_costs)
+        # The same with frozendicts
+        old = Route(r.places, frozendict({key: frozendict(value) for key, value in COSTS.items()}))
+        self.assertSetEqual(expected, {a.places for a in old.alternatives()})
+        # Bounds
+        for bounds in [{'milk': 8}, {'distance': 120}, {'milk': 9, 'duration': 60}, {'milk': 2}]:
+            bounded = list(r.alternatives(**bounds))
+            self.assertSetEqual({a.places for a in alternatives
+                                 if all(getattr(a, name) <= lim for name, lim in bounds.items())},
+                                {a.places for a in bounded})
+            for a in bounded:
+                for name in bounds:
+                    self.assertEqual(getattr(Route(a.places, m), name), getattr(a, name))
+        self.assertListEqual([], list(Route((A,), m).alternatives()))
+        self.assertListEqual([], list(Route((A, B, A), m).alternatives()))
+
+    def test_limit_pushdown(self):
+        m = CostMatrix(PLACES, COSTS)
+        r = Route((A, B, C, A, D, B, A), m)
+        e = limit(milk=8)(reroute(when(rt=r)))
+        self.assertIsInstance(e.callable_expression.scenario['f'], _Reroute)
+        self.assertEqual({'milk': 8}, e.callable_expression.scenario['f'].bounds)
+        expected = [d for d in reroute(when(rt=r)).all_dicts() if d['rt'].milk <= 8]
+        self.assertSetEqual({d['rt'] for d in expected}, {d['rt'] for d in e.all_dicts()})
+        # Nested limits, and unions
+        e = limit(milk=9)(limit(milk=8, distance=130)(reroute(when(rt=r)) | when(rt=r)))
+        self.assertIsInstance(e, OrExpression)
+        self.assertSetEqual({d['rt'] for d in expected if d['rt'].distance <= 130},
+                            {d['rt'] for d in e.subexpressions[0].all_dicts()})
+        self.assertEqual({'milk': 8, 'distance': 130}, e.subexpressions[0].callable_expression.scenario['f'].bounds)
+        # Anything else is filtered as before
+        self.assertListEqual([], list(limit(milk=2)(when(rt=r)).all_dicts()))
+
+    def test_best(self):
+        m = CostMatrix(PLACES, COSTS)
+        r = Route((A, C, B, A, D, B, A), m)
+        candidates = [r] + list(r.alternatives())
+        for bounds in [{}, {'milk': 8}, {'milk': 9, 'distance': 120}, {'milk': 2}]:
+            feasible = sorted((a.distance, a.places) for a in candidates
+                              if all(getattr(a, name) <= lim for name, lim in bounds.items()))
+            for k in [1, 3, 100]:
+                best = r.best('distance', k, **bounds)
+                self.assertListEqual([distance for distance, _ in feasible[:k]], [a.distance for a in best])
+                self.assertEqual(len(best), len({a.places for a in best}))
+                for a in best:
+                    self.assertEqual(Route(a.places, m).distance, a.distance)
+                    self.assertIn((a.distance, a.places), feasible)
+        # Fixed ends
+        best = Route((B, A, C, D), m).best('duration')[0]
+        self.assertEqual((B, A, C, D), best.places)
+        self.assertEqual(Route((B, A, C, D), m).duration, best.duration)
+        s = Route((A,), m)
+        self.assertListEqual([s], s.best())
+        # As an Expression
+        e = optimize('distance', k=2, milk=8)(when(rt=r))
+        self.assertListEqual([a.places for a in r.best('distance', 2, milk=8)], [d['rt'].places for d in e.all_dicts()])
+
+    def test_best_big(self):
+        r = big_route()
+        places = r.places
+        best = r.best('distance', 2, milk=15)
+        self.assertEqual(2, len(best))
+        self.assertLessEqual(best[0].distance, best[1].distance)
+        self.assertLessEqual(best[1].milk, 15)
+        self.assertEqual(2, len([p for p in best[0].places if p is places[0]]) - 1)
+
+    def test_improvements(self):
+        r = big_route()
+        m = r.leg_costs
+        improved = list(r.improvements('distance'))
+        self.assertLess(0, len(improved))
+        distances = [r.distance] + [a.distance for a in improved]
+        self.assertListEqual(sorted(distances, reverse=True), distances)
+        self.assertEqual(len(distances), len(set(distances)))
+        for a in improved:
+            self.assertEqual(Route(a.places, m).distance, a.distance)
+            self.assertEqual(sorted(r.places), sorted(a.places))
+            self.assertEqual((r.places[0], r.places[-1]), (a.places[0], a.places[-1]))
+        # A local optimum for 2-opt and relocate
+        final = improved[-1]
+        for i in range(1, len(final.places) - 2):
+            for j in range(i + 1, len(final.places) - 1):
+                reversed_places = final.places[:i] + final.places[i:j + 1][::-1] + final.places[j + 1:]
+                self.assertLessEqual(final.distance, Route(reversed_places, m).distance)
+        # Capacities: The search first gets within them, from a Route exceeding them
+        self.assertLess(15, r.milk)
+        capped = list(r.improvements('distance', milk=15))
+        self.assertLess(0, len(capped))
+        for a in capped:
+            self.assertLessEqual(Route(a.places, m).milk, 15)
+        self.assertLessEqual(r.best('distance', milk=15)[0].distance, capped[-1].distance)
+        # Time budget
+        self.assertListEqual([], list(r.improvements('distance', timeout=0)))
+        # As an Expression
+        e = improve('distance', timeout=None)(when(rt=r))
+        self.assertListEqual([a.places for a in improved], [d['rt'].places for d in e.all_dicts()])
+
+
+if __name__ == "__main__":
+    unittest.main()
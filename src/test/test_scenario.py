@@ -0,0 +1,52 @@
+import unittest
+import pickle
+from pyrules2.scenario import Scenario, Schema, Relation
+
+
+class Test(unittest.TestCase):
+    def test_schema(self):
+        # One interned Schema per set of keys, whatever the order
+        self.assertIs(Schema.of(['a', 'b']), Schema.of(('b', 'a')))
+        self.assertIs(Scenario({'a': 0, 'b': 1}).schema, Scenario({'b': 2, 'a': 3}).schema)
+        self.assertIsNot(Schema.of(['a']), Schema.of(['a', 'b']))
+        schema, sources, checks = Schema.of(['a', 'b']).union(Schema.of(['b', 'c']))
+        self.assertIs(Schema.of(['a', 'b', 'c']), schema)
+        self.assertEqual(1, len(checks))
+
+    def test_scenario(self):
+        s = Scenario({'a': 0, 'b': 1})
+        self.assertEqual(s, Scenario({'b': 1, 'a': 0}))
+        self.assertEqual(hash(s), hash(Scenario({'b': 1, 'a': 0})))
+        self.assertNotEqual(s, Scenario({'a': 1, 'b': 0}))
+        self.assertNotEqual(s, Scenario({'a': 0}))
+        self.assertEqual({'a': 0, 'b': 1}, s.as_dict())
+        self.assertEqual({'a': 0, 'b': 1}, dict(s))
+        self.assertEqual(2, len(s))
+        self.assertIn('a', s)
+        self.assertNotIn('c', s)
+        self.assertEqual(1, s['b'])
+        self.assertEqual((1, 0), s.project(('b', 'a')))
+        self.assertEqual(frozenset(['a', 'b']), s.key_set())
+        self.assertEqual(('a', 0), Scenario({'a': 0}).get_only_item())
+        self.assertRaises(AssertionError, s.get_only_item)
+        self.assertFalse(hasattr(s, '__dict__'))
+        # Survives pickling, e.g. to another process
+        self.assertEqual(s, pickle.loads(pickle.dumps(s)))
+
+    def test_unite(self):
+        s = Scenario.unite([Scenario({'a': 0, 'b': 1}), Scenario({'b': 1, 'c': 2}), Scenario({})])
+        self.assertEqual(Scenario({'a': 0, 'b': 1, 'c': 2}), s)
+        self.assertRaises(AssertionError, Scenario.unite, [Scenario({'a': 0}), Scenario({'a': 1})])
+
+    def test_relation(self):
+        r = Relation([Scenario({'x': 0, 'y': 1}), Scenario({'x': 1, 'y': 1}), Scenario({'y': 2}), Scenario({'z': 3})])
+        self.assertEqual(4, len(r))
+        self.assertSetEqual({Scenario({'x': 0, 'y': 1}), Scenario({'y': 2}), Scenario({'z': 3})},
+                            set(r.compatible(Scenario({'x': 0}))))
+        self.assertSetEqual({Scenario({'x': 0, 'y': 1})}, set(r.compatible(Scenario({'x': 0, 'y': 1, 'z': 4}))))
+        self.assertSetEqual(set(r), set(r.compatible(Scenario({}))))
+        self.assertEqual(r, pickle.loads(pickle.dumps(r)))
+        self.assertSetEqual(set(), set(Relation().compatible(Scenario({'x': 0}))))
+
+if __name__ == "__main__":
+    unittest.main()
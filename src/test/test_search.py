@@ -0,0 +1,58 @@
+import unittest
+from pyrules2.search import ROUND_ROBIN, DEPTH_FIRST, best_first
+from pyrules2.expression import OrExpression, ApplyExpression, IterableWrappingExpression, when
+from pyrules2.scenario import Scenario
+from pyrules2.rules import DIYIterable
+from pyrules2.util import lazy_product
+from pyrules2.planner import push_down
+from itertools import count, islice
+
+
+def numbers(start, step):
+    return IterableWrappingExpression(DIYIterable(lambda: (Scenario({'n': start + step * i}) for i in count())))
+
+
+class Test(unittest.TestCase):
+    def test_merge(self):
+        self.assertListEqual([0, 'a', 1, 'b', 2], list(ROUND_ROBIN.merge([[0, 1, 2], 'ab'])))
+        self.assertListEqual([0, 1, 2, 'a', 'b'], list(DEPTH_FIRST.merge([[0, 1, 2], 'ab'])))
+        shortest = best_first(len)
+        self.assertListEqual(['a', 'b', 'cc', 'ddd', 'eeee'],
+                             list(shortest.merge([['a', 'cc', 'eeee'], ['b', 'ddd']])))
+        self.assertListEqual(['a', 'cc', 'eee'], list(shortest.order(['eee', 'a', 'cc'])))
+        # Values with equal scores are never compared
+        self.assertEqual(2, len(list(best_first(lambda _: 0).merge([[{}], [{}]]))))
+        # Infinite Iterables
+        self.assertListEqual([0, 1, 2, 3, 4], list(islice(best_first(abs).merge([count(0, 2), count(1, 2)]), 5)))
+        self.assertListEqual([], list(best_first(abs).merge([])))
+
+    def test_or(self):
+        evens, odds = numbers(0, 2), numbers(1, 2)
+
+        def first_five(strategy):
+            dicts = OrExpression(evens, odds, strategy=strategy).all_dicts()
+            return [d['n'] for d in islice(dicts, 5)]
+
+        self.assertListEqual([0, 1, 2, 3, 4], first_five(None))
+        self.assertListEqual([0, 2, 4, 6, 8], first_five(DEPTH_FIRST))
+        # Best-first prefers odd numbers, so it never gets to the even ones
+        self.assertListEqual([1, 3, 5, 7, 9], first_five(best_first(lambda s: s['n'] % 2 == 0)))
+        merged = OrExpression(numbers(0, 3), numbers(1, 2), strategy=best_first(lambda s: s['n']))
+        self.assertListEqual([0, 1, 3, 3, 5], [d['n'] for d in islice(merged.all_dicts(), 5)])
+        # The planner keeps the strategy
+        o = OrExpression(when(n=2), when(n=1), strategy=best_first(lambda s: s['n']))
+        self.assertListEqual([1, 2], [d['n'] for d in o.all_dicts()])
+        self.assertIs(o.strategy, push_down(o).strategy)
+
+    def test_apply(self):
+        # Depth-first exhausts the finite input before the infinite one
+        self.assertListEqual([('a', 0), ('b', 0), ('c', 0)],
+                             list(islice(lazy_product(iter('abc'), count(0), strategy=DEPTH_FIRST), 3)))
+        # Every value is still reached by a fair strategy
+        self.assertSetEqual({(i, c) for i in range(3) for c in 'abc'},
+                            set(lazy_product(iter(range(3)), iter('abc'), strategy=best_first(lambda _: 0))))
+        e = ApplyExpression(when(f=lambda n: n * 10), numbers(0, 1), strategy=DEPTH_FIRST)
+        self.assertListEqual([0, 10, 20], [d['n'] for d in islice(e.all_dicts(), 3)])
+
+if __name__ == "__main__":
+    unittest.main()
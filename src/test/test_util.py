@@ -1,5 +1,5 @@
 import unittest
-from pyrules2.util import lazy_product
+from pyrules2.util import lazy_product, strongly_connected_components
 from itertools import product, count, islice
 
 
@@ -12,6 +12,21 @@ class Test(unittest.TestCase):
 
     def _test_product(self, case):
         self.assertSetEqual(set(product(*case)), set(lazy_product(*case)))
+        # As iterators, which take the caching path
+        self.assertSetEqual(set(product(*case)), set(lazy_product(*[iter(i) for i in case])))
+        # Mixed
+        mixed = [iter(i) if n % 2 == 0 else i for n, i in enumerate(case)]
+        self.assertSetEqual(set(product(*case)), set(lazy_product(*mixed)))
+
+    def test_materialized_product(self):
+        # Values from materialized inputs need not be hashable, and are not repeated
+        self.assertListEqual([([0], 'a'), ([0], 'b'), ([1], 'a'), ([1], 'b')],
+                             list(lazy_product([[0], [1]], ('a', 'b'))))
+        self.assertEqual(4, len(list(lazy_product([[0], [1]], iter('ab')))))
+        # Empty inputs
+        self.assertListEqual([], list(lazy_product(count(0), [])))
+        self.assertListEqual([], list(lazy_product(count(0), iter([]))))
+        self.assertListEqual([(0, 'a')], list(lazy_product(iter([0, 0]), iter(['a', 'a']))))
 
     def test_infinite_product(self):
         g = lazy_product(count(0), [1])
@@ -19,5 +34,16 @@ class Test(unittest.TestCase):
         slice_as_set = set(sliced)
         self.assertSetEqual(set((i, 1) for i in range(100)), slice_as_set)
 
+    def test_strongly_connected_components(self):
+        self.assertListEqual([], strongly_connected_components({}))
+        # Self-loop
+        self.assertListEqual([{'a'}], strongly_connected_components({'a': ['a']}))
+        # Chain: Callees come first
+        self.assertListEqual([{'c'}, {'b'}, {'a'}],
+                             strongly_connected_components({'a': ['b'], 'b': ['c'], 'c': []}))
+        # Cycle plus a node calling into it
+        components = strongly_connected_components({'a': ['b'], 'b': ['a'], 'c': ['a', 'c']})
+        self.assertListEqual([{'a', 'b'}, {'c'}], components)
+
 if __name__ == "__main__":
     unittest.main()